@@ -1,27 +1,87 @@
 import requests
+import ijson
 import json
-import paho.mqtt.client as mqtt
+import mmap
 import time
 import sys
 import os
 
+from publisher import WIRE_FORMAT_NAME, PublisherPool, connect_client
+from replay import ReplayStats, make_pacer
+
 DATA_URL = "https://github.com/ncl-iot-team/CSC8112/raw/refs/heads/main/data/uo_data.min.json"
 
+# Optional local copy of the dump (read through mmap instead of downloading)
+DATA_FILE = os.getenv("DATA_FILE", "")
+
+# "stream" parses the dump incrementally, "full" loads the whole document first
+INGEST_MODE = os.getenv("INGEST_MODE", "stream").lower()
+PREVIEW_CHARS = int(os.getenv("PREVIEW_CHARS", "500"))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+
+PM25_ITEMS_PREFIX = "sensors.item.data.PM2.5.item"
+PM25_FIELD_PREFIXES = {
+    PM25_ITEMS_PREFIX + ".Sensor Name": "Sensor Name",
+    PM25_ITEMS_PREFIX + ".Timestamp": "Timestamp",
+    PM25_ITEMS_PREFIX + ".Value": "Value",
+}
+SENSOR_NAME_PREFIXES = ("sensors.item.Sensor Name", "sensors.item.Sensor Name.0")
+
 MQTT_BROKER = os.getenv("MQTT_BROKER", "emqx")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "uo/pm25")
+MQTT_QOS = int(os.getenv("MQTT_QOS", "0"))
+
+# Publish each sensor to <MQTT_TOPIC>/<sensor> instead of one shared topic
+PER_SENSOR_TOPICS = os.getenv("PER_SENSOR_TOPICS", "true").lower() == "true"
+
+# Publisher pool: worker count, "thread" or "process", bounded inbox per worker
+# and how many readings the producer hands over at once
+PUBLISHER_WORKERS = int(os.getenv("PUBLISHER_WORKERS", "1"))
+PUBLISHER_MODE = os.getenv("PUBLISHER_MODE", "thread").lower()
+PUBLISHER_QUEUE_SIZE = int(os.getenv("PUBLISHER_QUEUE_SIZE", "1000"))
+DISPATCH_CHUNK = int(os.getenv("DISPATCH_CHUNK", "1"))
+
+# Replay pacing: "rate" (fixed msg/s), "timewarp" (original spacing / speed-up)
+# or "max" (as fast as each publisher's in-flight window allows)
+REPLAY_MODE = os.getenv("REPLAY_MODE", "rate")
+REPLAY_RATE = float(os.getenv("REPLAY_RATE", "10"))
+REPLAY_BURST = int(os.getenv("REPLAY_BURST", "1"))
+REPLAY_SPEEDUP = float(os.getenv("REPLAY_SPEEDUP", "3600"))
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "20"))
+
+# Wire format: "json" (one reading per message), "binary" (packed batches)
+# or "auto" (binary only if every advertised consumer supports it)
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json").lower()
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+BATCH_MAX_DELAY_MS = float(os.getenv("BATCH_MAX_DELAY_MS", "200"))
+MQTT_CAPS_TOPIC = os.getenv("MQTT_CAPS_TOPIC", "uo/caps")
+CAPS_WAIT = float(os.getenv("CAPS_WAIT", "2"))
+
+# Print every Nth payload (0 disables per-message logging)
+LOG_EVERY = int(os.getenv("LOG_EVERY", "10000"))
+STATS_EVERY = int(os.getenv("STATS_EVERY", "10000"))
+
+
+def sensor_id(reading_name, sensor_name, index):
+    """Best available identity: reading-level name, sensor-level name, position."""
+    return reading_name or sensor_name or f"sensor-{index}"
 
 
 def extract_pm25_data(json_data):
     pm25_readings = []
     sensors = json_data.get("sensors", [])
 
-    for sensor in sensors:
+    for index, sensor in enumerate(sensors):
+        name = sensor.get("Sensor Name")
+        if isinstance(name, dict):
+            name = name.get("0")
         data = sensor.get("data", {})
         if "PM2.5" in data:
             readings = data["PM2.5"]
             for reading in readings:
                 payload = {
+                    "Sensor": sensor_id(reading.get("Sensor Name"), name, index),
                     "Timestamp": reading.get("Timestamp"),
                     "Value": reading.get("Value"),
                 }
@@ -29,69 +89,229 @@ def extract_pm25_data(json_data):
     return pm25_readings
 
 
-def on_connect(client, userdata, flags, reason_code, properties):
-    if reason_code == 0:
-        print("Connected to MQTT Broker!")
-    else:
-        print(f"Failed to connect, reason code {reason_code}")
+class PrefixedStream(object):
+    """File-like wrapper that replays already-read bytes before the stream."""
 
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
 
-def main():
-    # Fetch source data
-    try:
+    def read(self, size=-1):
+        if self._prefix:
+            if size is None or size < 0:
+                chunk = self._prefix + self._stream.read()
+                self._prefix = b""
+                return chunk
+            chunk = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return chunk
+        return self._stream.read(size)
+
+
+def open_source_stream():
+    """Return (stream, closer) for the raw JSON dump, without buffering it."""
+    if DATA_FILE:
+        f = open(DATA_FILE, "rb")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def close():
+            mapped.close()
+            f.close()
+
+        return mapped, close
+
+    response = requests.get(DATA_URL, stream=True)
+    response.raise_for_status()
+    # Let urllib3 undo any gzip/deflate transfer encoding while we read
+    response.raw.decode_content = True
+    return response.raw, response.close
+
+
+def preview_stream(stream, limit=PREVIEW_CHARS):
+    """Print the first `limit` bytes and return a stream that still yields them."""
+    head = stream.read(limit)
+    print(f"Printing first {limit} characters from the raw data stream..")
+    print(head.decode("utf-8", errors="replace"))
+    return PrefixedStream(head, stream)
+
+
+def stream_pm25_data(stream):
+    """
+    Yield PM2.5 readings, tagged with their sensor, as they are parsed.
+
+    A sensor's readings are held until its object closes, so they get the
+    sensor-level name whether "Sensor Name" comes before or after "data".
+    """
+    sensor_index = -1
+    sensor_name = None
+    readings = []
+    fields = None
+
+    events = ijson.parse(stream, use_float=True, buf_size=STREAM_CHUNK_SIZE)
+    for prefix, event, value in events:
+        if fields is not None:
+            key = PM25_FIELD_PREFIXES.get(prefix)
+            if key is not None:
+                fields[key] = value
+            elif prefix == PM25_ITEMS_PREFIX and event == "end_map":
+                readings.append(fields)
+                fields = None
+        elif prefix == PM25_ITEMS_PREFIX and event == "start_map":
+            fields = {}
+        elif prefix == "sensors.item" and event == "start_map":
+            sensor_index += 1
+            sensor_name = None
+        elif prefix == "sensors.item" and event == "end_map":
+            for reading in readings:
+                yield {
+                    "Sensor": sensor_id(reading.get("Sensor Name"), sensor_name, sensor_index),
+                    "Timestamp": reading.get("Timestamp"),
+                    "Value": reading.get("Value"),
+                }
+            readings = []
+        elif prefix in SENSOR_NAME_PREFIXES and event == "string":
+            sensor_name = value
+
+
+def load_pm25_data():
+    """Legacy path: download and decode the whole document before extracting."""
+    if DATA_FILE:
+        with open(DATA_FILE, "rb") as f:
+            json_response = json.load(f)
+    else:
         response = requests.get(DATA_URL)
         response.raise_for_status()
-    except Exception as e:
-        print(f"Failed to download data: {e}")
-        sys.exit(1)
-
-    json_response = response.json()
+        json_response = response.json()
 
     # Debug preview for report
-    print("Printing first 500 characters from the raw data stream..")
-    preview = json.dumps(json_response, indent=2)[:500]
+    print(f"Printing first {PREVIEW_CHARS} characters from the raw data stream..")
+    preview = json.dumps(json_response, indent=2)[:PREVIEW_CHARS]
     print(preview)
 
     # Extract PM2.5 readings
     pm25_data = extract_pm25_data(json_response)
     print(f"Extracted {len(pm25_data)} PM2.5 readings")
+    return pm25_data
 
-    # MQTT client setup (paho-mqtt v2 API)
-    client = mqtt.Client(
-        client_id="DataInjector",
-        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
-    )
-    client.on_connect = on_connect
 
+def negotiate_payload_format(client):
+    """Pick the wire format, asking consumers for their capabilities if needed."""
+    if PAYLOAD_FORMAT != "auto":
+        return PAYLOAD_FORMAT
+
+    caps_filter = f"{MQTT_CAPS_TOPIC}/+"
+    advertised = {}
+
+    def on_caps(client, userdata, msg):
+        if not msg.payload:
+            # Empty retained message: that consumer has gone away
+            advertised.pop(msg.topic, None)
+            return
+        try:
+            advertised[msg.topic] = json.loads(msg.payload).get("Formats", [])
+        except Exception:
+            advertised[msg.topic] = []
+
+    client.message_callback_add(caps_filter, on_caps)
+    client.subscribe(caps_filter)
+    time.sleep(CAPS_WAIT)
+    client.unsubscribe(caps_filter)
+    client.message_callback_remove(caps_filter)
+
+    print(f"Consumer capabilities: {advertised or 'none advertised'}")
+    if advertised and all(WIRE_FORMAT_NAME in f for f in advertised.values()):
+        return "binary"
+    return "json"
+
+
+def main():
+    # Fetch source data
+    close_source = None
+    try:
+        if INGEST_MODE == "full":
+            pm25_data = load_pm25_data()
+        else:
+            stream, close_source = open_source_stream()
+            pm25_data = stream_pm25_data(preview_stream(stream))
+    except Exception as e:
+        print(f"Failed to download data: {e}")
+        sys.exit(1)
+
+    try:
+        pacer = make_pacer(
+            REPLAY_MODE,
+            rate=REPLAY_RATE,
+            burst=REPLAY_BURST,
+            speedup=REPLAY_SPEEDUP,
+        )
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    stats = ReplayStats()
+
+    # Control client (paho-mqtt v2 API): capability negotiation and END signal
     try:
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        client = connect_client("DataInjector", MQTT_BROKER, MQTT_PORT)
     except Exception as e:
         print(f"Could not connect to MQTT broker: {e}")
         sys.exit(1)
+    print("Connected to MQTT Broker!")
 
-    client.loop_start()
+    payload_format = negotiate_payload_format(client)
 
-    # Wait for connection (up to 10 seconds)
-    connection_start_time = time.time()
-    while (not client.is_connected()) and (time.time() - connection_start_time < 10):
-        time.sleep(0.1)
+    pool = PublisherPool(
+        PUBLISHER_WORKERS,
+        {
+            "client_id": "DataInjector",
+            "broker": MQTT_BROKER,
+            "port": MQTT_PORT,
+            "topic": MQTT_TOPIC,
+            "per_sensor": PER_SENSOR_TOPICS,
+            "qos": MQTT_QOS,
+            "max_inflight": MAX_INFLIGHT,
+            "payload_format": payload_format,
+            "batch_size": BATCH_SIZE,
+            "batch_max_delay_ms": BATCH_MAX_DELAY_MS,
+        },
+        mode=PUBLISHER_MODE,
+        queue_size=PUBLISHER_QUEUE_SIZE,
+        chunk_size=DISPATCH_CHUNK,
+        max_delay_ms=BATCH_MAX_DELAY_MS,
+    ).start()
 
-    if not client.is_connected():
-        print("Failed to connect to MQTT broker in 10 seconds. Exiting.")
-        client.loop_stop()
-        sys.exit(1)
+    # Publish all PM2.5 readings (in stream mode they are parsed on the fly)
+    print(
+        f"Replaying in '{REPLAY_MODE}' mode using '{payload_format}' payloads "
+        f"over {pool.size} {PUBLISHER_MODE} publisher(s)"
+    )
+    try:
+        for reading in pm25_data:
+            due = pacer.wait(reading)
+            if LOG_EVERY and stats.count % LOG_EVERY == 0:
+                print("Sending:", json.dumps(reading))
+            pool.dispatch(reading.get("Sensor"), reading)
+            stats.record(due, time.monotonic())
+            if STATS_EVERY and stats.count % STATS_EVERY == 0:
+                print("[REPLAY]", stats.summary())
+    except Exception as e:
+        print(f"Injection stopped early: {e}")
+    finally:
+        if close_source is not None:
+            close_source()
+
+    # Publishers flush their batches and wait for in-flight messages first,
+    # so END is only sent once every reading has left the injector
+    messages, published, failed, failed_readings = pool.close()
 
-    # Publish all PM2.5 readings
-    for reading in pm25_data:
-        message = json.dumps(reading)
-        print("Sending:", message)
-        client.publish(MQTT_TOPIC, message)
-        time.sleep(0.1)  # small delay just to slow the stream for demo/logs
+    print(f"Published {published} PM2.5 readings in {messages} messages")
+    if failed:
+        print(f"Failed to publish {failed_readings} readings in {failed} messages")
+    print("[REPLAY]", stats.summary())
 
     # Send END control message so the preprocessor knows we're done
     end_message = json.dumps({"Type": "END"})
     print("Sending END signal:", end_message)
-    client.publish(MQTT_TOPIC, end_message)
+    client.publish(MQTT_TOPIC, end_message, qos=MQTT_QOS).wait_for_publish(timeout=10)
 
     print("Finished publishing data.")
 
@@ -0,0 +1,283 @@
+'''
+    Publisher pool for the data injector.
+
+    Readings are routed to a worker by a stable hash of their sensor ID, so
+    every sensor's readings stay in order on a single MQTT connection. Each
+    worker owns its own paho client, in-flight window and (for binary
+    payloads) per-topic batches. Workers run as threads or, to spread JSON
+    encoding and socket work over several cores, as processes.
+'''
+
+import json
+import multiprocessing
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+
+import paho.mqtt.client as mqtt
+
+from replay import InflightWindow
+
+# Binary batch: 10-byte header (magic, version, pad, count, sensor length),
+# the sensor ID (UTF-8, same string as a JSON reading's "Sensor"; empty if
+# unknown), then `count` little-endian (int64 Timestamp, float32 Value)
+# records. One batch holds one sensor's readings, so consumers key them
+# exactly like JSON readings whatever topic they arrive on.
+WIRE_MAGIC = b"PM25"
+WIRE_VERSION = 2
+WIRE_FORMAT_NAME = "pm25-batch/2"
+WIRE_HEADER = struct.Struct("<4sBxHH")
+WIRE_RECORD = struct.Struct("<qf")
+WIRE_MAX_BATCH = 65535
+
+# Characters that cannot appear in a single MQTT topic level
+TOPIC_UNSAFE = re.compile(r"[/+#\s]")
+
+
+def encode_batch(readings, sensor=None):
+    """Pack one sensor's readings into a binary message, skipping unparseable ones."""
+    sensor_id = str(sensor).encode("utf-8") if sensor else b""
+    if len(sensor_id) > 0xFFFF:
+        raise ValueError(f"sensor ID too long for a batch header: {len(sensor_id)} bytes")
+    records = []
+    for reading in readings:
+        try:
+            records.append((int(reading["Timestamp"]), float(reading["Value"])))
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    offset = WIRE_HEADER.size + len(sensor_id)
+    buf = bytearray(offset + WIRE_RECORD.size * len(records))
+    WIRE_HEADER.pack_into(buf, 0, WIRE_MAGIC, WIRE_VERSION, len(records), len(sensor_id))
+    buf[WIRE_HEADER.size:offset] = sensor_id
+    for ts, value in records:
+        WIRE_RECORD.pack_into(buf, offset, ts, value)
+        offset += WIRE_RECORD.size
+    return bytes(buf)
+
+
+def sensor_topic(base_topic, sensor, per_sensor=True):
+    """Topic for one sensor's readings, e.g. uo/pm25/<sensor>."""
+    if not per_sensor or not sensor:
+        return base_topic
+    return f"{base_topic}/{TOPIC_UNSAFE.sub('_', str(sensor))}"
+
+
+def connect_client(client_id, broker, port, on_publish=None, max_inflight=20, timeout=10):
+    """Connect a paho v2 client, start its network loop and wait for CONNACK."""
+    client = mqtt.Client(
+        client_id=client_id,
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+    )
+    if on_publish is not None:
+        client.on_publish = on_publish
+    client.max_inflight_messages_set(max_inflight)
+    client.connect(broker, port, 60)
+    client.loop_start()
+
+    deadline = time.time() + timeout
+    while not client.is_connected() and time.time() < deadline:
+        time.sleep(0.1)
+    if not client.is_connected():
+        client.loop_stop()
+        raise ConnectionError(f"{client_id} could not connect within {timeout}s")
+    return client
+
+
+def run_publisher(index, inbox, results, settings):
+    '''
+    Worker loop: publish chunks of (sensor, reading) pairs from `inbox`
+    until a None sentinel arrives, then flush, wait for in-flight messages
+    and report (index, messages, readings, failed messages, failed readings)
+    on `results`. A message the client refuses to queue (no connection,
+    full queue) is counted as failed, not as sent.
+    '''
+    window = InflightWindow(settings["max_inflight"])
+
+    def on_publish(client, userdata, mid, reason_code, properties):
+        window.release()
+
+    try:
+        client = connect_client(
+            f"{settings['client_id']}-{index}",
+            settings["broker"],
+            settings["port"],
+            on_publish=on_publish,
+            max_inflight=settings["max_inflight"],
+        )
+    except Exception as e:
+        print(f"Publisher {index}: could not connect to MQTT broker: {e}")
+        results.put((index, -1, 0, 0, 0))
+        return
+
+    qos = settings["qos"]
+    binary = settings["payload_format"] == "binary"
+    batch_size = max(1, min(settings["batch_size"], WIRE_MAX_BATCH))
+    max_delay = settings["batch_max_delay_ms"] / 1000.0
+    counts = {"messages": 0, "readings": 0, "failed": 0, "failed_readings": 0}
+    batches = {}
+
+    def publish(topic, payload, count=1):
+        window.acquire()
+        info = client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            window.release()
+            counts["failed"] += 1
+            counts["failed_readings"] += count
+            return
+        counts["messages"] += 1
+        counts["readings"] += count
+
+    def flush(key):
+        batch, _ = batches.pop(key)
+        topic, sensor = key
+        publish(topic, encode_batch(batch, sensor), len(batch))
+
+    while True:
+        try:
+            chunk = inbox.get(timeout=max_delay if batches else None)
+        except queue.Empty:
+            chunk = ()
+        if chunk is None:
+            break
+
+        for sensor, reading in chunk:
+            topic = sensor_topic(settings["topic"], sensor, settings["per_sensor"])
+            if binary:
+                # Batched per sensor even on a shared topic: the header
+                # carries a single sensor ID
+                key = (topic, sensor)
+                batch, _ = batches.setdefault(key, ([], time.monotonic()))
+                batch.append(reading)
+                if len(batch) >= batch_size:
+                    flush(key)
+            else:
+                publish(topic, json.dumps(reading))
+
+        if batches:
+            now = time.monotonic()
+            aged = [k for k, (_, since) in batches.items() if now - since >= max_delay]
+            for key in aged:
+                flush(key)
+
+    for key in list(batches):
+        flush(key)
+
+    window.drain(timeout=10)
+    client.loop_stop()
+    client.disconnect()
+    results.put((index, counts["messages"], counts["readings"],
+                 counts["failed"], counts["failed_readings"]))
+
+
+class PublisherPool(object):
+    '''
+    Fan readings out to `size` publisher workers ("thread" or "process").
+
+    The producer hands over readings in chunks of up to `chunk_size` per
+    worker (flushed after `max_delay_ms` at the latest) to keep queue and
+    pickling overhead low; inboxes are bounded so a slow broker pushes
+    back on the producer instead of buffering without limit.
+    '''
+
+    def __init__(self, size, settings, mode="thread", queue_size=1000,
+                 chunk_size=1, max_delay_ms=200):
+        self.size = max(int(size), 1)
+        self.settings = settings
+        self.mode = mode
+        self.chunk_size = max(int(chunk_size), 1)
+        self.max_delay = max_delay_ms / 1000.0
+
+        if mode == "process":
+            ctx = multiprocessing.get_context("spawn")
+            make_queue, make_worker = ctx.Queue, ctx.Process
+        elif mode == "thread":
+            make_queue, make_worker = queue.Queue, threading.Thread
+        else:
+            raise ValueError(f"Unknown publisher mode: {mode}")
+
+        self._results = make_queue()
+        self._inboxes = [make_queue(maxsize=queue_size) for _ in range(self.size)]
+        self._workers = [
+            make_worker(
+                target=run_publisher,
+                args=(i, self._inboxes[i], self._results, settings),
+                daemon=True,
+            )
+            for i in range(self.size)
+        ]
+        self._pending = [[] for _ in range(self.size)]
+        self._pending_since = [0.0] * self.size
+        self._last_sweep = time.monotonic()
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def worker_for(self, sensor):
+        if self.size == 1:
+            return 0
+        return zlib.crc32(str(sensor).encode("utf-8")) % self.size
+
+    def dispatch(self, sensor, reading):
+        i = self.worker_for(sensor)
+        pending = self._pending[i]
+        if not pending:
+            self._pending_since[i] = time.monotonic()
+        pending.append((sensor, reading))
+        if len(pending) >= self.chunk_size:
+            self._send(i)
+
+        now = time.monotonic()
+        if self.chunk_size > 1 and now - self._last_sweep >= self.max_delay:
+            self._last_sweep = now
+            for j in range(self.size):
+                if self._pending[j] and now - self._pending_since[j] >= self.max_delay:
+                    self._send(j)
+
+    def _send(self, i, item=None):
+        if item is None:
+            item, self._pending[i] = self._pending[i], []
+        while True:
+            try:
+                self._inboxes[i].put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self._workers[i].is_alive():
+                    raise RuntimeError(f"publisher {i} stopped unexpectedly")
+
+    def close(self):
+        """
+        Flush and stop all workers; return (messages, readings, failed
+        messages, failed readings) totals. Failed ones were never accepted
+        by the client and are not part of the sent totals.
+        """
+        for i in range(self.size):
+            if self._pending[i]:
+                self._send(i)
+        for i in range(self.size):
+            if self._workers[i].is_alive():
+                self._inboxes[i].put(None)
+
+        messages = readings = failed = failed_readings = 0
+        for _ in range(self.size):
+            try:
+                index, sent, count, lost, lost_readings = self._results.get(timeout=60)
+            except queue.Empty:
+                print("Timed out waiting for publishers to finish")
+                break
+            if sent < 0:
+                print(f"Publisher {index} failed")
+                continue
+            messages += sent
+            readings += count
+            failed += lost
+            failed_readings += lost_readings
+
+        for worker in self._workers:
+            worker.join(timeout=10)
+        return messages, readings, failed, failed_readings
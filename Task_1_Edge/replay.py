@@ -0,0 +1,208 @@
+'''
+    Replay scheduling for the data injector.
+
+    A pacer decides *when* the next reading may be published:
+
+        timewarp - original Timestamp spacing divided by a speed-up factor
+        rate     - fixed messages/second, token bucket anchored to a schedule
+        max      - no pacing; publishers are limited only by their
+                   InflightWindow (unacknowledged MQTT messages)
+
+    ReplayStats keeps running (constant memory) numbers about what was
+    actually achieved so load tests can report rate and jitter.
+'''
+
+import math
+import threading
+import time
+
+
+def timestamp_seconds(ts):
+    """Convert a reading Timestamp (seconds or milliseconds) to float seconds."""
+    try:
+        ts = float(ts)
+    except (TypeError, ValueError):
+        return None
+    if ts > 1_000_000_000_000:  # heuristic: milliseconds
+        return ts / 1000.0
+    return ts
+
+
+def sleep_until(deadline):
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+class TimeWarpPacer(object):
+    '''
+    Replays readings at their original spacing, `speedup` times faster.
+
+    The first reading anchors the replay clock. Readings whose due time
+    has already passed (out-of-order data, or a second sensor starting
+    earlier in time) are sent immediately.
+    '''
+
+    def __init__(self, speedup=1.0):
+        self.speedup = max(float(speedup), 1e-9)
+        self._ts0 = None
+        self._start = None
+
+    def wait(self, reading):
+        now = time.monotonic()
+        ts = timestamp_seconds(reading.get("Timestamp"))
+        if ts is None:
+            return now
+        if self._ts0 is None:
+            self._ts0 = ts
+            self._start = now
+            return now
+
+        due = self._start + (ts - self._ts0) / self.speedup
+        if due <= now:
+            return now
+        sleep_until(due)
+        return due
+
+
+class TokenBucketPacer(object):
+    '''
+    Holds a target rate of `rate` messages/second.
+
+    Send times follow an absolute schedule (start + n / rate) so sleep
+    overshoot does not accumulate as drift. If the producer falls behind,
+    at most `burst` messages of credit are kept to catch up.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = max(float(rate), 1e-9)
+        self.burst = max(int(burst), 1)
+        self._next = None
+
+    def wait(self, reading):
+        now = time.monotonic()
+        if self._next is None:
+            self._next = now
+        self._next = max(self._next, now - self.burst / self.rate)
+
+        due = self._next
+        sleep_until(due)
+        self._next = due + 1.0 / self.rate
+        return due
+
+
+class MaxPacer(object):
+    '''Never waits: throughput is bounded by the publishers' in-flight windows.'''
+
+    def wait(self, reading):
+        return time.monotonic()
+
+
+class InflightWindow(object):
+    '''
+    Keeps at most `window` messages in flight for one MQTT client.
+    `release()` must be called from the client's on_publish callback
+    (or when a publish fails) to hand a slot back.
+    '''
+
+    def __init__(self, window=20):
+        self.window = max(int(window), 1)
+        self._slots = threading.BoundedSemaphore(self.window)
+
+    def acquire(self):
+        self._slots.acquire()
+
+    def release(self):
+        try:
+            self._slots.release()
+        except ValueError:
+            # More acks than publishes (e.g. a reconnect); ignore
+            pass
+
+    def drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        taken = 0
+        try:
+            for _ in range(self.window):
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0)
+                if not self._slots.acquire(timeout=remaining):
+                    break
+                taken += 1
+        finally:
+            for _ in range(taken):
+                self._slots.release()
+
+
+def make_pacer(mode, rate=10.0, burst=1, speedup=1.0):
+    mode = (mode or "rate").lower()
+    if mode == "timewarp":
+        return TimeWarpPacer(speedup)
+    if mode == "max":
+        return MaxPacer()
+    if mode == "rate":
+        return TokenBucketPacer(rate, burst)
+    raise ValueError(f"Unknown replay mode: {mode}")
+
+
+class ReplayStats(object):
+    '''
+    Running statistics of a replay: achieved rate, inter-send jitter and
+    lateness against the pacer's schedule (Welford, O(1) memory).
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._first = None
+        self._last = None
+        self._gap_n = 0
+        self._gap_mean = 0.0
+        self._gap_m2 = 0.0
+        self._late_sum = 0.0
+        self._late_max = 0.0
+
+    def record(self, due, sent_at):
+        if self._last is not None:
+            gap = sent_at - self._last
+            self._gap_n += 1
+            delta = gap - self._gap_mean
+            self._gap_mean += delta / self._gap_n
+            self._gap_m2 += delta * (gap - self._gap_mean)
+        else:
+            self._first = sent_at
+        self._last = sent_at
+
+        late = max(sent_at - due, 0.0)
+        self._late_sum += late
+        self._late_max = max(self._late_max, late)
+        self.count += 1
+
+    @property
+    def elapsed(self):
+        if self._first is None:
+            return 0.0
+        return self._last - self._first
+
+    @property
+    def rate(self):
+        if self._gap_n == 0 or self.elapsed <= 0:
+            return 0.0
+        return self._gap_n / self.elapsed
+
+    @property
+    def jitter(self):
+        """Standard deviation of the interval between consecutive sends."""
+        if self._gap_n < 2:
+            return 0.0
+        return math.sqrt(self._gap_m2 / (self._gap_n - 1))
+
+    def summary(self):
+        mean_late = self._late_sum / self.count if self.count else 0.0
+        return (
+            f"sent={self.count} elapsed={self.elapsed:.3f}s "
+            f"rate={self.rate:.1f} msg/s "
+            f"interval={self._gap_mean * 1000:.3f}ms "
+            f"jitter={self.jitter * 1000:.3f}ms "
+            f"lateness(mean/max)={mean_late * 1000:.3f}/{self._late_max * 1000:.3f}ms"
+        )
@@ -0,0 +1,42 @@
+'''
+    The streaming parser must label readings exactly as the full-document
+    extraction does, wherever "Sensor Name" sits in the sensor object.
+
+    Usage: python -m pytest test_ingest.py
+'''
+
+import io
+import json
+
+import pytest
+
+from data_injector import extract_pm25_data, stream_pm25_data
+
+
+def sensor(name, name_first, with_reading_names=False):
+    readings = [
+        dict({"Sensor Name": f"{name}-reading"} if with_reading_names else {},
+             Timestamp=1_601_510_400_000 + i * 900_000, Value=5.0 + i)
+        for i in range(3)
+    ]
+    items = [("data", {"PM2.5": readings, "NO2": [{"Timestamp": 1, "Value": 2.0}]})]
+    if name is not None:
+        items.insert(0 if name_first else 1, ("Sensor Name", name))
+    return dict(items)
+
+
+def document(name_first):
+    return {"sensors": [
+        sensor("plain", name_first),
+        sensor({"0": "nested"}, name_first),
+        sensor(None, name_first),
+        sensor("named-readings", name_first, with_reading_names=True),
+    ]}
+
+
+@pytest.mark.parametrize("name_first", [True, False])
+def test_stream_matches_full(name_first):
+    doc = document(name_first)
+    streamed = list(stream_pm25_data(io.BytesIO(json.dumps(doc).encode("utf-8"))))
+    assert streamed == extract_pm25_data(doc)
+    assert {r["Sensor"] for r in streamed} == {"plain", "nested", "sensor-2", "named-readings-reading"}
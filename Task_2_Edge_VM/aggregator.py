@@ -0,0 +1,266 @@
+'''
+    Keyed, windowed aggregation for the preprocessor.
+
+    State is held per (key, window start) in a dict, so adding a reading is
+    O(size / slide) dict operations no matter how many windows are open.
+    Each key (normally a sensor) has its own watermark:
+
+        watermark = max event time seen for the key - allowed lateness
+
+    and a window [start, start + size) is emitted once the watermark
+    reaches its end. Readings for windows that have already been emitted
+    are counted as late and dropped, so a window is emitted exactly once.
+    Per-key watermarks let sensors that are replayed one after another (or
+    whose clocks disagree) progress independently.
+'''
+
+import heapq
+import math
+import re
+
+from sketches import KllSketch
+
+WINDOW_UNITS = {
+    "s": 1,
+    "second": 1,
+    "m": 60,
+    "minute": 60,
+    "h": 3600,
+    "hour": 3600,
+    "d": 86400,
+    "day": 86400,
+}
+
+
+def parse_duration(text):
+    """Parse "day", "hour", "15m", "2h", "3600" ... into whole seconds."""
+    text = str(text).strip().lower()
+    match = re.fullmatch(r"(\d*)\s*([a-z]*)", text)
+    if not match or not text:
+        raise ValueError(f"Invalid duration: {text!r}")
+    number, unit = match.groups()
+    if unit and unit not in WINDOW_UNITS:
+        raise ValueError(f"Invalid duration unit: {unit!r}")
+    return int(number or 1) * WINDOW_UNITS.get(unit, 1)
+
+
+def epoch_seconds(ts):
+    """Normalise an integer Timestamp in seconds or milliseconds to seconds."""
+    ts = int(ts)
+    if ts > 1_000_000_000_000:  # heuristic: milliseconds
+        return ts // 1000
+    return ts
+
+
+class WindowState(object):
+    '''
+    Running aggregate of one window: sum and count for the mean, min/max,
+    Welford's M2 for the variance and a KLL sketch for quantiles. Partial
+    aggregates are merged with Chan et al.'s parallel variance formula.
+    '''
+
+    __slots__ = ("sum", "count", "min", "max", "m2", "sketch")
+
+    def __init__(self, sketch_k=200):
+        self.sum = 0.0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.m2 = 0.0
+        self.sketch = KllSketch(sketch_k)
+
+    def add(self, value):
+        old_mean = self.sum / self.count if self.count else 0.0
+        self.sum += value
+        self.count += 1
+        self.m2 += (value - old_mean) * (value - self.sum / self.count)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sketch.update(value)
+
+    def merge(self, total, count, vmin, vmax, m2, values):
+        """Fold in the aggregate of `count` readings (`values` feed the sketch)."""
+        if not count:
+            return
+        if self.count:
+            delta = total / count - self.sum / self.count
+            self.m2 += m2 + delta * delta * self.count * count / (self.count + count)
+        else:
+            self.m2 = m2
+        self.sum += total
+        self.count += count
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+        self.sketch.update_many(values)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    @property
+    def variance(self):
+        """Sample variance (n - 1 denominator); 0 for a single reading."""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_list(self):
+        return [self.sum, self.count, self.min, self.max, self.m2, self.sketch.to_state()]
+
+    @classmethod
+    def from_list(cls, fields):
+        state = cls.__new__(cls)
+        state.sum, state.count, state.min, state.max, state.m2, sketch = fields
+        state.sketch = KllSketch.from_state(sketch)
+        return state
+
+
+class WindowAggregator(object):
+    '''
+    Tumbling (slide == size) or sliding (slide < size) event-time windows.
+
+    `add()` returns the windows its reading closed, and `flush()` closes
+    everything still open, both as (key, start, state) tuples ordered by
+    window end.
+    '''
+
+    def __init__(self, size=86400, slide=None, allowed_lateness=0, sketch_k=200):
+        self.size = int(size)
+        self.slide = int(slide or size)
+        self.allowed_lateness = int(allowed_lateness)
+        self.sketch_k = sketch_k
+        if self.size <= 0 or self.slide <= 0 or self.size % self.slide:
+            raise ValueError("window size must be a positive multiple of the slide")
+
+        self._windows = {}    # (key, start) -> WindowState
+        self._deadlines = {}  # key -> heap of (end, start) for open windows
+        self._max_ts = {}     # key -> max event time seen
+        self.late_dropped = 0
+
+        # After a restore: key -> event time up to which readings were already
+        # folded into the restored state, so a replayed source is not counted twice
+        self.replay_guard = {}
+        self.replayed_skipped = 0
+
+    def watermark(self, key):
+        max_ts = self._max_ts.get(key)
+        if max_ts is None:
+            return None
+        return max_ts - self.allowed_lateness
+
+    @property
+    def open_windows(self):
+        return len(self._windows)
+
+    def add(self, key, ts, value):
+        """Fold one reading (event time `ts` in seconds) into its windows."""
+        if self.replay_guard and self._replayed(key, ts):
+            return []
+        watermark = self.watermark(key)
+        last_start = ts - ts % self.slide
+        accepted = False
+
+        for start in range(last_start - self.size + self.slide, last_start + 1, self.slide):
+            end = start + self.size
+            if watermark is not None and end <= watermark:
+                continue  # already emitted
+            state = self._windows.get((key, start))
+            if state is None:
+                state = self._windows[(key, start)] = WindowState(self.sketch_k)
+                heapq.heappush(self._deadlines.setdefault(key, []), (end, start))
+            state.add(value)
+            accepted = True
+
+        if not accepted:
+            self.late_dropped += 1
+
+        if watermark is None or ts > self._max_ts[key]:
+            self._max_ts[key] = ts
+            return self._advance(key)
+        return []
+
+    def _replayed(self, key, ts):
+        guard = self.replay_guard.get(key)
+        if guard is None:
+            return False
+        if ts <= guard:
+            self.replayed_skipped += 1
+            return True
+        # First reading past the checkpoint: live data from here on
+        del self.replay_guard[key]
+        return False
+
+    def add_partial(self, key, start, total, count, vmin, vmax, m2, values):
+        """
+        Fold a pre-reduced partial aggregate into one window.
+
+        Returns False if that window has already been emitted. The key's
+        watermark is not moved; call `observe()` once the batch is applied.
+        """
+        end = start + self.size
+        watermark = self.watermark(key)
+        if watermark is not None and end <= watermark:
+            return False
+        state = self._windows.get((key, start))
+        if state is None:
+            state = self._windows[(key, start)] = WindowState(self.sketch_k)
+            heapq.heappush(self._deadlines.setdefault(key, []), (end, start))
+        state.merge(total, count, vmin, vmax, m2, values)
+        return True
+
+    def observe(self, key, ts):
+        """Advance the key's event-time clock to `ts`; return windows that closed."""
+        max_ts = self._max_ts.get(key)
+        if max_ts is None or ts > max_ts:
+            self._max_ts[key] = ts
+            return self._advance(key)
+        return []
+
+    def _advance(self, key):
+        watermark = self.watermark(key)
+        heap = self._deadlines.get(key)
+        emitted = []
+        while heap and heap[0][0] <= watermark:
+            _, start = heapq.heappop(heap)
+            emitted.append((key, start, self._windows.pop((key, start))))
+        return emitted
+
+    def flush(self):
+        """Emit every open window, e.g. when the input stream has ended."""
+        emitted = []
+        for key, heap in self._deadlines.items():
+            while heap:
+                end, start = heapq.heappop(heap)
+                emitted.append((key, start, self._windows.pop((key, start))))
+                # Move the watermark past the window so it cannot reopen
+                self._max_ts[key] = max(self._max_ts[key], end + self.allowed_lateness)
+        emitted.sort(key=lambda item: item[1])
+        return emitted
+
+    def snapshot(self):
+        """JSON-serialisable copy of the aggregation state."""
+        return {
+            "size": self.size,
+            "slide": self.slide,
+            "windows": [
+                [key, start, state.to_list()]
+                for (key, start), state in self._windows.items()
+            ],
+            "max_ts": [[key, ts] for key, ts in self._max_ts.items()],
+            "late_dropped": self.late_dropped,
+        }
+
+    def restore(self, snapshot):
+        """Load a snapshot taken with the same window size and slide."""
+        if snapshot["size"] != self.size or snapshot["slide"] != self.slide:
+            raise ValueError("snapshot was taken with a different window configuration")
+        self._windows = {}
+        self._deadlines = {}
+        for key, start, fields in snapshot["windows"]:
+            self._windows[(key, start)] = WindowState.from_list(fields)
+            self._deadlines.setdefault(key, []).append((start + self.size, start))
+        for heap in self._deadlines.values():
+            heapq.heapify(heap)
+        self._max_ts = {key: ts for key, ts in snapshot["max_ts"]}
+        self.late_dropped = snapshot["late_dropped"]
+        self.replay_guard = dict(self._max_ts)
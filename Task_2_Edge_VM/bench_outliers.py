@@ -0,0 +1,55 @@
+'''
+    Benchmark: streaming outlier detector throughput.
+
+    Runs each detector over the same synthetic PM2.5 series (gamma noise,
+    a seasonal baseline and injected spikes) and reports readings/s and
+    the share of readings flagged.
+
+    Usage: python bench_outliers.py [readings] [hampel windows, comma separated]
+'''
+
+import sys
+import time
+
+import numpy as np
+
+from outliers import EwmaDetector, FixedThresholdDetector, HampelDetector
+
+
+def make_series(n, seed=7):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n)
+    baseline = 12 + 8 * np.sin(2 * np.pi * t / (96 * 30))  # monthly swing at 15-min sampling
+    values = baseline + rng.gamma(2.0, 2.0, size=n)
+    spikes = rng.random(n) < 0.01
+    values[spikes] += rng.uniform(30, 120, size=spikes.sum())
+    return values.tolist()
+
+
+def bench(name, detector, values):
+    is_outlier = detector.is_outlier
+    started = time.perf_counter()
+    flagged = 0
+    for v in values:
+        if is_outlier(v):
+            flagged += 1
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24}{len(values) / elapsed:>14,.0f}{elapsed / len(values) * 1e6:>12.3f}"
+          f"{flagged / len(values) * 100:>10.2f}%")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    windows = [int(w) for w in (sys.argv[2] if len(sys.argv) > 2 else "16,96,512,4096").split(",")]
+    values = make_series(n)
+
+    print(f"{n} readings")
+    print(f"{'detector':<24}{'readings/s':>14}{'us/reading':>12}{'flagged':>11}")
+    bench("fixed (> 50)", FixedThresholdDetector(50.0), values)
+    bench("ewma (alpha=0.05, z=3)", EwmaDetector(alpha=0.05, z=3.0), values)
+    for w in windows:
+        bench(f"hampel (w={w}, k=3)", HampelDetector(window=w, n_sigmas=3.0), values)
+
+
+if __name__ == "__main__":
+    main()
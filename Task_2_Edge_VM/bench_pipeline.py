@@ -0,0 +1,134 @@
+'''
+    Benchmark: ingest latency with a slow RabbitMQ uplink.
+
+    Replays the same binary batches at a fixed message rate twice, once
+    processing and publishing inside the MQTT callback (the old design) and
+    once through the receive / aggregate / publish pipeline, with a
+    publisher that takes UPLINK_DELAY_MS per confirmed publish round. It
+    reports how long the MQTT callback held the network loop, queueing
+    latency, drops and whether both runs sent the same windows.
+
+    Usage: python bench_pipeline.py [messages] [rate msg/s] [uplink delay ms] [policy]
+'''
+
+import contextlib
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import preprocessor
+from bench_preprocessor import Message, binary_messages, make_readings
+from pipeline import PipelineMetrics, PublishStage, Receiver
+
+
+class SlowPublisher(object):
+    '''Stand-in for RabbitPublisher: every non-empty flush takes `delay` seconds.'''
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.records = []
+        self.on_confirmed = None
+        self._pending = []
+
+    @property
+    def pending(self):
+        return list(self._pending)
+
+    def publish(self, record):
+        self._pending.append(record)
+
+    def flush(self):
+        if self._pending:
+            time.sleep(self.delay)
+            self.records.extend(self._pending)
+            self._pending = []
+
+    def idle(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class FakeClient(object):
+    def publish(self, topic, payload, retain=False):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def replay(messages, rate, callback):
+    """Call `callback(msg)` at `rate` messages/s; return callback durations."""
+    durations = np.empty(len(messages))
+    started = time.monotonic()
+    for i, msg in enumerate(messages):
+        due = started + i / rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        t0 = time.perf_counter()
+        callback(msg)
+        durations[i] = time.perf_counter() - t0
+    return durations
+
+
+def run_inline(messages, rate, delay):
+    publisher = SlowPublisher(delay)
+    userdata = preprocessor.build_userdata(publisher, 0)
+    client = FakeClient()
+    durations = replay(messages, rate, lambda msg: preprocessor.process_message(client, userdata, msg))
+    return durations, publisher.records, ""
+
+
+def run_pipeline(messages, rate, delay, policy):
+    metrics = PipelineMetrics()
+    slow = SlowPublisher(delay)
+    publisher = PublishStage(slow, maxsize=100, metrics=metrics).start()
+    userdata = preprocessor.build_userdata(publisher, 0)
+    userdata["receiver"] = Receiver(
+        maxsize=10000, policy=policy, metrics=metrics, keep=preprocessor.is_control
+    )
+    client = FakeClient()
+    worker = threading.Thread(
+        target=preprocessor.run_aggregate_stage, args=(client, userdata), daemon=True
+    )
+    worker.start()
+    receiver = userdata["receiver"]
+    durations = replay(messages, rate, lambda msg: receiver.on_message(client, None, msg))
+    worker.join()
+    return durations, slow.records, metrics.summary()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    delay = float(sys.argv[3]) / 1000.0 if len(sys.argv) > 3 else 0.05
+    policy = sys.argv[4] if len(sys.argv) > 4 else "drop"
+
+    ts, values = make_readings(n * 10, 20)
+    messages = binary_messages(ts, values, batch=10)[:n]
+    messages.append(Message(preprocessor.MQTT_TOPIC, b'{"Type": "END"}'))
+    preprocessor.PIPELINE_METRICS_INTERVAL = 0
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        inline = run_inline(messages, rate, delay)
+        piped = run_pipeline(messages, rate, delay, policy)
+
+    print(f"{len(messages)} messages at {rate:.0f} msg/s, uplink {delay * 1000:.0f} ms per publish round")
+    print(f"{'path':<12}{'callback p50 ms':>16}{'p99 ms':>10}{'max ms':>10}{'windows':>10}")
+    for name, (durations, records, _) in (("inline", inline), ("pipeline", piped)):
+        p50, p99 = np.percentile(durations, [50, 99]) * 1000
+        print(f"{name:<12}{p50:>16.3f}{p99:>10.3f}{durations.max() * 1000:>10.3f}{len(records):>10}")
+    same = {(r["Sensor"], r["Timestamp"]) for r in inline[1]} == {
+        (r["Sensor"], r["Timestamp"]) for r in piped[1]
+    }
+    print(f"pipeline metrics: {piped[2]}")
+    print(f"same windows sent: {same}")
+
+
+if __name__ == "__main__":
+    main()
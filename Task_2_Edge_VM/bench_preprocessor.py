@@ -0,0 +1,126 @@
+'''
+    Benchmark: per-message preprocessing vs the vectorized micro-batch path.
+
+    Feeds the same synthetic readings through process_message() three ways
+    (JSON per message, JSON micro-batched, binary batches micro-batched)
+    with a no-op publisher, checks that all paths produce the same
+    windows and reports the cost per reading.
+
+    Usage: python bench_preprocessor.py [readings] [sensors] [batch]
+'''
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import preprocessor
+
+
+class NullPublisher(object):
+    def __init__(self):
+        self.records = []
+
+    def publish(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_readings(n, sensors, seed=42):
+    rng = np.random.default_rng(seed)
+    per_sensor = n // sensors
+    start_ms = 1_601_510_400_000
+    ts = start_ms + np.arange(per_sensor, dtype=np.int64) * 900_000  # 15 minutes
+    values = rng.gamma(2.0, 5.0, size=(sensors, per_sensor)).astype(np.float32)
+    return ts, values
+
+
+def json_messages(ts, values):
+    messages = []
+    for s in range(values.shape[0]):
+        topic = f"{preprocessor.MQTT_TOPIC}/sensor-{s}"
+        for t, v in zip(ts.tolist(), values[s].tolist()):
+            payload = json.dumps({"Sensor": f"sensor-{s}", "Timestamp": t, "Value": v})
+            messages.append(Message(topic, payload.encode("utf-8")))
+    return messages
+
+
+def binary_messages(ts, values, batch=100):
+    records = np.empty(ts.size, dtype=preprocessor.WIRE_DTYPE)
+    records["Timestamp"] = ts
+    messages = []
+    for s in range(values.shape[0]):
+        topic = f"{preprocessor.MQTT_TOPIC}/sensor-{s}"
+        records["Value"] = values[s]
+        sensor = f"sensor-{s}".encode("utf-8")
+        for i in range(0, ts.size, batch):
+            chunk = records[i:i + batch]
+            header = preprocessor.WIRE_HEADER.pack(
+                preprocessor.WIRE_MAGIC, preprocessor.WIRE_VERSION, chunk.size, len(sensor)
+            )
+            messages.append(Message(topic, header + sensor + chunk.tobytes()))
+    return messages
+
+
+def run(messages, microbatch_readings):
+    publisher = NullPublisher()
+    userdata = preprocessor.build_userdata(publisher, microbatch_readings)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for msg in messages:
+            preprocessor.process_message(None, userdata, msg)
+        if userdata["batcher"] is not None:
+            preprocessor.flush_batch(userdata)
+        preprocessor.send_windows(userdata, userdata["aggregator"].flush())
+        elapsed = time.perf_counter() - started
+    return elapsed, publisher.records
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 10_000
+
+    ts, values = make_readings(n, sensors)
+    n = values.size
+    as_json = json_messages(ts, values)
+    as_binary = binary_messages(ts, values)
+
+    results = [
+        ("per-message (JSON)", *run(as_json, 0)),
+        (f"micro-batch {batch} (JSON)", *run(as_json, batch)),
+        (f"micro-batch {batch} (binary)", *run(as_binary, batch)),
+    ]
+
+    baseline = {(r["Sensor"], r["Timestamp"]): r for r in results[0][2]}
+    print(f"{n} readings, {sensors} sensors, {len(baseline)} windows")
+    print(f"{'path':<32}{'total s':>10}{'us/reading':>12}{'readings/s':>14}  match")
+    for name, elapsed, records in results:
+        got = {(r["Sensor"], r["Timestamp"]): r for r in records}
+        match = got.keys() == baseline.keys() and all(
+            got[k]["Count"] == baseline[k]["Count"]
+            and all(
+                abs(got[k][field] - baseline[k][field]) < 1e-6
+                for field in ("Value", "Min", "Max", "Variance", "P50", "P95", "P99")
+            )
+            for k in baseline
+        )
+        print(f"{name:<32}{elapsed:>10.3f}{elapsed / n * 1e6:>12.3f}{n / elapsed:>14,.0f}  {match}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+'''
+    Benchmark: preprocessor replicas behind an in-process stand-in broker.
+
+    The parent process plays the broker: it routes per-sensor MQTT messages
+    to N replica processes over multiprocessing queues, either like an MQTT
+    shared subscription with a hash-by-topic strategy ("shared": each
+    message goes to one replica chosen by hashing its topic) or to every
+    replica, which then keeps only its own sensors ("partition":
+    PARTITION_COUNT / PARTITION_INDEX). END goes to every replica.
+
+    Each replica runs the real process_message() path. The merged windows
+    must equal those of a single instance, and throughput should grow
+    close to linearly with the number of replicas (up to the number of
+    free cores). Exits with status 1 if any run's windows differ;
+    test_replicas.py checks the same on a small input.
+
+    Usage: python bench_replicas.py [readings] [sensors] [max replicas] [shared|partition]
+'''
+
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+
+import preprocessor
+from bench_preprocessor import Message, json_messages, make_readings
+
+CHUNK = 500
+
+
+class CollectingPublisher(object):
+    def __init__(self):
+        self.records = []
+
+    def publish(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullClient(object):
+    def publish(self, topic, payload, retain=False):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def run_replica(index, count, mode, inbox, results):
+    if mode == "partition":
+        preprocessor.PARTITION_COUNT = count
+        preprocessor.PARTITION_INDEX = index
+    publisher = CollectingPublisher()
+    userdata = preprocessor.build_userdata(publisher, 0)
+    client = NullClient()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = None
+        while not userdata["ended"]:
+            chunk = inbox.get()
+            if started is None:
+                started = time.perf_counter()
+            for topic, payload in chunk:
+                preprocessor.process_message(client, userdata, Message(topic, payload))
+        elapsed = time.perf_counter() - started
+    results.put((index, elapsed, publisher.records))
+
+
+def broker(messages, count, mode):
+    """Route `messages` to `count` replica processes; return (seconds, records)."""
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(count)]
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(target=run_replica, args=(i, count, mode, inboxes[i], results))
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+
+    end = (preprocessor.MQTT_TOPIC, json.dumps({"Type": "END"}).encode("utf-8"))
+    started = time.perf_counter()
+    pending = [[] for _ in range(count)]
+    for msg in messages:
+        if mode == "shared":
+            targets = [zlib.crc32(msg.topic.encode("utf-8")) % count]
+        else:
+            targets = range(count)
+        for i in targets:
+            pending[i].append((msg.topic, msg.payload))
+            if len(pending[i]) >= CHUNK:
+                inboxes[i].put(pending[i])
+                pending[i] = []
+    for i in range(count):
+        pending[i].append(end)
+        inboxes[i].put(pending[i])
+
+    records = []
+    for _ in range(count):
+        _, _, replica_records = results.get()
+        records.extend(replica_records)
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+    return elapsed, records
+
+
+def window_map(records):
+    return {
+        (r["Sensor"], r["Timestamp"]): (r["Count"], round(r["Value"], 9), r["Min"], r["Max"])
+        for r in records
+    }
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    max_replicas = int(sys.argv[3]) if len(sys.argv) > 3 else min(os.cpu_count() or 1, 4)
+    mode = sys.argv[4] if len(sys.argv) > 4 else "shared"
+
+    ts, values = make_readings(n, sensors)
+    messages = json_messages(ts, values)
+    # Interleave sensors the way a live feed would arrive
+    messages.sort(key=lambda m: json.loads(m.payload)["Timestamp"])
+
+    print(f"{len(messages)} messages, {sensors} sensors, mode={mode}, {os.cpu_count()} CPUs")
+    print(f"{'replicas':>8}{'seconds':>10}{'msg/s':>12}{'speed-up':>10}  match")
+    baseline = None
+    base_elapsed = None
+    all_match = True
+    replicas = 1
+    while replicas <= max_replicas:
+        elapsed, records = broker(messages, replicas, mode)
+        got = window_map(records)
+        if baseline is None:
+            baseline, base_elapsed = got, elapsed
+        match = got == baseline and len(got) == len(records)
+        all_match = all_match and match
+        print(
+            f"{replicas:>8}{elapsed:>10.3f}{len(messages) / elapsed:>12,.0f}"
+            f"{base_elapsed / elapsed:>10.2f}  {match}"
+        )
+        replicas *= 2
+    if not all_match:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
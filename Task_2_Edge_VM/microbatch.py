@@ -0,0 +1,216 @@
+'''
+    Vectorized micro-batch path for the preprocessor.
+
+    Instead of parsing, normalising and bucketing every reading as Python
+    objects, readings are collected for up to N readings or T milliseconds
+    into NumPy arrays (binary MQTT batches are appended without copying)
+    and reduced in one go:
+
+        ms -> s normalisation, outlier mask  - integer / boolean array ops
+        window bucketing                     - ts - ts % slide
+        per (sensor, bucket) sum, count, M2  - np.unique + np.bincount
+        per (sensor, bucket) min, max        - ufunc.reduceat on grouped values
+
+    The aggregator then only sees one pre-reduced partial per
+    (sensor, window) instead of one update per reading.
+'''
+
+import time
+
+import numpy as np
+
+MS_THRESHOLD = 1_000_000_000_000  # heuristic: larger timestamps are milliseconds
+
+
+def reduce_batch(ts, values, codes, size, slide, threshold=None, outliers=None):
+    '''
+    Reduce a batch of readings into per-(sensor code, slide bucket) partials.
+
+    Outliers are either values above `threshold` or, for adaptive
+    detectors, the readings flagged in the boolean `outliers` mask.
+
+    Returns (clean_count, partials, max_ts). `partials` is a tuple of
+    arrays (codes, starts, sums, counts, mins, maxs, m2s) plus a list with
+    each group's values, one entry per (sensor, bucket) where `starts` is
+    the latest window a reading falls into (ts - ts % slide). With sliding
+    windows the same partial also belongs to the size / slide - 1 windows
+    starting one slide, two slides ... earlier. `max_ts` is (codes, latest
+    clean event time).
+    '''
+    ts = np.asarray(ts, dtype=np.int64)
+    ts = np.where(ts > MS_THRESHOLD, ts // 1000, ts)
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.int64)
+
+    clean = np.isfinite(values)
+    if outliers is not None:
+        clean &= ~outliers
+    if threshold is not None:
+        clean &= values <= threshold
+    ts, values, codes = ts[clean], values[clean], codes[clean]
+    if ts.size == 0:
+        return 0, None, (codes, ts)
+
+    # Composite int64 key: sensor code in the high bits, bucket below
+    buckets = ts // slide
+    base = int(buckets.min())
+    keys = (codes << 32) | (buckets - base)
+    uniq, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=values)
+    means = sums / counts
+    m2s = np.bincount(inverse, weights=(values - means[inverse]) ** 2)
+
+    # Values grouped contiguously for min/max and the quantile sketches
+    grouped = values[np.argsort(inverse, kind="stable")]
+    bounds = np.cumsum(counts)[:-1]
+    offsets = np.concatenate(([0], bounds))
+    mins = np.minimum.reduceat(grouped, offsets)
+    maxs = np.maximum.reduceat(grouped, offsets)
+    starts = ((uniq & 0xFFFFFFFF) + base) * slide
+
+    partials = (uniq >> 32, starts, sums, counts, mins, maxs, m2s, np.split(grouped, bounds))
+
+    present = np.unique(codes)
+    max_ts = np.full(int(present.max()) + 1, np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(max_ts, codes, ts)
+    return int(ts.size), partials, (present, max_ts[present])
+
+
+class MicroBatcher(object):
+    '''
+    Collects readings until `max_readings` are pending or the oldest has
+    waited `max_delay_ms`, then folds them into a WindowAggregator.
+
+    Outliers come from a DetectorBank: a plain fixed threshold is applied
+    as one array comparison, adaptive detectors are run per reading in
+    arrival order (they are stateful) before the vectorized reduction.
+    '''
+
+    def __init__(self, aggregator, detectors, max_readings=10000, max_delay_ms=100):
+        self.aggregator = aggregator
+        self.detectors = detectors
+        self.max_readings = max(int(max_readings), 1)
+        self.max_delay = max_delay_ms / 1000.0
+
+        self._codes = {}    # sensor -> small int code
+        self._sensors = []  # code -> sensor
+        self._chunks = []   # (ts array, value array, code array)
+        self._ts = []
+        self._values = []
+        self._scalar_codes = []
+        self._pending = 0
+        self._since = None
+
+    def __len__(self):
+        return self._pending
+
+    def _code(self, sensor):
+        code = self._codes.get(sensor)
+        if code is None:
+            code = self._codes[sensor] = len(self._sensors)
+            self._sensors.append(sensor)
+        return code
+
+    def _touch(self, n):
+        if self._pending == 0:
+            self._since = time.monotonic()
+        self._pending += n
+
+    def add_reading(self, sensor, ts, value):
+        self._ts.append(ts)
+        self._values.append(value)
+        self._scalar_codes.append(self._code(sensor))
+        self._touch(1)
+
+    def add_arrays(self, sensor, ts, values):
+        """Append a whole decoded binary batch (arrays are not copied here)."""
+        if len(ts) == 0:
+            return
+        self._chunks.append((ts, values, np.full(len(ts), self._code(sensor), dtype=np.int64)))
+        self._touch(len(ts))
+
+    def due(self):
+        if self._pending == 0:
+            return False
+        if self._pending >= self.max_readings:
+            return True
+        return time.monotonic() - self._since >= self.max_delay
+
+    def _drain(self):
+        chunks = self._chunks
+        if self._ts:
+            chunks.append((
+                np.array(self._ts, dtype=np.int64),
+                np.array(self._values, dtype=np.float64),
+                np.array(self._scalar_codes, dtype=np.int64),
+            ))
+        self._chunks, self._ts, self._values, self._scalar_codes = [], [], [], []
+        self._pending = 0
+        if len(chunks) == 1:
+            return chunks[0]
+        return tuple(np.concatenate(column) for column in zip(*chunks))
+
+    def _skip_replayed(self, ts, values, codes, outliers):
+        """Drop readings a restored checkpoint already contains (see WindowAggregator)."""
+        agg = self.aggregator
+        guard = np.full(len(self._sensors), np.iinfo(np.int64).min, dtype=np.int64)
+        for code, sensor in enumerate(self._sensors):
+            if sensor in agg.replay_guard:
+                guard[code] = agg.replay_guard[sensor]
+        seconds = np.where(ts > MS_THRESHOLD, ts // 1000, ts)
+        keep = seconds > guard[codes]
+        agg.replayed_skipped += int(keep.size - np.count_nonzero(keep))
+
+        # Sensors that have reached live data no longer need the guard
+        for code in np.unique(codes[keep]).tolist():
+            agg.replay_guard.pop(self._sensors[code], None)
+        if outliers is not None:
+            outliers = outliers[keep]
+        return ts[keep], values[keep], codes[keep], outliers
+
+    def flush(self):
+        """
+        Reduce everything pending into the aggregator.
+
+        Returns (raw_count, clean_count, emitted windows).
+        """
+        if self._pending == 0:
+            return 0, 0, []
+        ts, values, codes = self._drain()
+        agg = self.aggregator
+        sensors = self._sensors
+
+        threshold = self.detectors.fixed_threshold
+        outliers = None
+        if threshold is None:
+            is_outlier = self.detectors.is_outlier
+            outliers = np.fromiter(
+                (is_outlier(sensors[c], v) for c, v in zip(codes.tolist(), values.tolist())),
+                dtype=bool,
+                count=len(ts),
+            )
+        if agg.replay_guard:
+            ts, values, codes, outliers = self._skip_replayed(ts, values, codes, outliers)
+        clean, partials, (present, max_ts) = reduce_batch(
+            ts, values, codes, agg.size, agg.slide, threshold, outliers
+        )
+
+        if partials is not None:
+            p_codes, p_starts, p_sums, p_counts, p_mins, p_maxs, p_m2s, p_values = partials
+            for code, last_start, total, count, vmin, vmax, m2, group in zip(
+                p_codes.tolist(), p_starts.tolist(), p_sums.tolist(), p_counts.tolist(),
+                p_mins.tolist(), p_maxs.tolist(), p_m2s.tolist(), p_values,
+            ):
+                group = group.tolist()
+                sensor = sensors[code]
+                for start in range(last_start, last_start - agg.size, -agg.slide):
+                    accepted = agg.add_partial(sensor, start, total, count, vmin, vmax, m2, group)
+                    if not accepted and start == last_start:
+                        # Latest window already closed: every one of them is
+                        agg.late_dropped += count
+                        break
+
+        emitted = []
+        for code, latest in zip(present.tolist(), max_ts.tolist()):
+            emitted.extend(agg.observe(sensors[code], latest))
+        return len(ts), clean, emitted
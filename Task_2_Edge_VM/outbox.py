@@ -0,0 +1,286 @@
+'''
+    Store-and-forward outbox between the preprocessor and RabbitMQ.
+
+    Records are appended (and fsync'ed) as JSON lines to numbered segment
+    files before anything is sent. A drain thread reads them back in
+    batches, compresses each batch into a single AMQP message
+    (content_type application/x-ndjson, content_encoding gzip or zstd)
+    and only advances the read cursor in index.json once the broker has
+    confirmed it. An outage therefore just grows the outbox on disk;
+    nothing is lost, and fully delivered segments are deleted.
+
+    Every batch is published with message_id "outbox:<segment>:<offset>",
+    so if we crash between the confirm and the index update, the resent
+    batch can be recognised by the consumer.
+'''
+
+import gzip
+import json
+import os
+import threading
+
+from checkpoint import atomic_write_json, fsync_dir
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return body
+
+
+def resolve_encoding(encoding):
+    """"zstd", "gzip" or "identity"; zstd falls back to gzip if unavailable."""
+    encoding = (encoding or "identity").lower()
+    if encoding == "none":
+        encoding = "identity"
+    if encoding == "zstd" and zstandard is None:
+        print("zstandard is not installed; compressing outbox batches with gzip")
+        encoding = "gzip"
+    if encoding not in ("zstd", "gzip", "identity"):
+        raise ValueError(f"Unknown outbox compression: {encoding}")
+    return encoding
+
+
+class Outbox(object):
+    '''
+    Append-only segment files plus an index of the delivered position.
+
+    Segments are named <sequence>.seg and hold one JSON record per line;
+    a new one is started once the current one exceeds `segment_bytes`.
+    index.json records (segment, byte offset) of the first record not yet
+    confirmed. `append()` may be called from one thread while another
+    uses `read()` / `ack()`.
+    '''
+
+    def __init__(self, directory, segment_bytes=1 << 20):
+        self.directory = directory
+        self.segment_bytes = max(int(segment_bytes), 1)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+
+        segments = self._segments()
+        self._cursor = self._load_index(segments)
+        if segments:
+            self._active = segments[-1]
+            self._recover(self._active)
+        else:
+            self._active = self._cursor[0]
+        self._writer = open(self._segment_path(self._active), "ab")
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}.seg")
+
+    def _segments(self):
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg")
+        )
+
+    def _load_index(self, segments):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+            return index["segment"], index["offset"]
+        except FileNotFoundError:
+            return (segments[0] if segments else 0), 0
+        except (OSError, ValueError, KeyError) as e:
+            # Resending from the oldest segment is safe, consumers dedupe
+            print(f"Outbox index unreadable ({e}); resending from the oldest segment")
+            return (segments[0] if segments else 0), 0
+
+    def _recover(self, seq):
+        """Cut a record that was only partly written when we crashed."""
+        path = self._segment_path(seq)
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                print(f"Outbox: dropping {len(data) - end} bytes of a torn write in {path}")
+                f.truncate(end)
+
+    def append(self, records):
+        """Durably append records; returns once they are on disk."""
+        if not records:
+            return
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        with self._lock:
+            self._writer.write(data.encode("utf-8"))
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            if self._writer.tell() >= self.segment_bytes:
+                self._writer.close()
+                self._active += 1
+                self._writer = open(self._segment_path(self._active), "ab")
+                fsync_dir(self._segment_path(self._active))
+
+    def read(self, max_records=500):
+        """
+        Up to `max_records` undelivered records from one segment, and the
+        position to `ack()` once they have been delivered.
+        """
+        while True:
+            with self._lock:
+                seq, offset = self._cursor
+                active = self._active
+            records = []
+            try:
+                with open(self._segment_path(seq), "rb") as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # being written right now
+                        offset += len(line)
+                        records.append(json.loads(line))
+                        if len(records) >= max_records:
+                            break
+            except FileNotFoundError:
+                pass
+
+            if records or seq >= active:
+                return records, (seq, offset)
+            # Everything in this segment is delivered: move on to the next one
+            self.ack((seq + 1, 0))
+
+    def ack(self, position):
+        """Mark everything before `position` as delivered."""
+        with self._lock:
+            previous = self._cursor[0]
+            self._cursor = position
+            atomic_write_json(self._index_path, {"segment": position[0], "offset": position[1]})
+            for seq in range(previous, position[0]):
+                try:
+                    os.remove(self._segment_path(seq))
+                except FileNotFoundError:
+                    pass
+
+    def backlog_bytes(self):
+        """Bytes written but not yet delivered."""
+        with self._lock:
+            seq, offset = self._cursor
+            active = self._active
+        total = -offset
+        for s in range(seq, active + 1):
+            try:
+                total += os.path.getsize(self._segment_path(s))
+            except OSError:
+                pass
+        return max(total, 0)
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+
+
+class OutboxStage(object):
+    '''
+    Publish stage backed by an Outbox.
+
+    Same publish/flush/pending/close interface as PublishStage: `flush()`
+    appends the buffered records to the outbox (so it never waits on the
+    uplink) and wakes a drain thread that sends compressed batches through
+    `publisher.send_batch()`, which retries until the broker confirms.
+    `on_confirmed` is called once records are durable in the outbox.
+    '''
+
+    def __init__(self, outbox, publisher, batch_records=500, encoding="gzip",
+                 idle_interval=5.0, metrics=None):
+        self.outbox = outbox
+        self.publisher = publisher
+        self.batch_records = max(int(batch_records), 1)
+        self.encoding = resolve_encoding(encoding)
+        self.idle_interval = idle_interval
+        self.metrics = metrics
+        self.on_confirmed = None
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.sent_records = 0
+
+    def start(self):
+        self._thread.start()
+        self._wake.set()  # deliver whatever an earlier run left behind
+        return self
+
+    @property
+    def pending(self):
+        with self._lock:
+            return list(self._buffer)
+
+    def publish(self, record):
+        with self._lock:
+            self._buffer.append(record)
+
+    def flush(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        self.outbox.append(batch)
+        if self.metrics is not None:
+            self.metrics.count("outbox_appended", len(batch))
+        if self.on_confirmed is not None:
+            self.on_confirmed()
+        self._wake.set()
+
+    def _drain(self):
+        while True:
+            records, position = self.outbox.read(self.batch_records)
+            if not records:
+                return
+            raw = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode("utf-8")
+            body = compress(raw, self.encoding)
+            self.publisher.send_batch(
+                body,
+                content_type=NDJSON_CONTENT_TYPE,
+                content_encoding=None if self.encoding == "identity" else self.encoding,
+                message_id=f"outbox:{position[0]}:{position[1]}",
+                records=len(records),
+            )
+            self.outbox.ack(position)
+            self.raw_bytes += len(raw)
+            self.sent_bytes += len(body)
+            self.sent_records += len(records)
+            if self.metrics is not None:
+                self.metrics.count("published", len(records))
+                self.metrics.count("publish_rounds")
+                self.metrics.depth("outbox_bytes", self.outbox.backlog_bytes())
+
+    def _run(self):
+        while True:
+            woken = self._wake.wait(timeout=self.idle_interval)
+            self._wake.clear()
+            if woken:
+                self._drain()
+            else:
+                self.publisher.idle()
+            if self._closing:
+                self._drain()
+                return
+
+    def close(self):
+        """Deliver everything in the outbox, then close the publisher."""
+        self.flush()
+        self._closing = True
+        self._wake.set()
+        self._thread.join()
+        self.outbox.close()
+        self.publisher.close()
+        if self.sent_records:
+            print(
+                f"Outbox: {self.sent_records} records in {self.sent_bytes} bytes "
+                f"({self.sent_bytes / self.sent_records:.1f} B/record on the uplink, "
+                f"{self.raw_bytes / self.sent_records:.1f} B/record as JSON, {self.encoding})"
+            )
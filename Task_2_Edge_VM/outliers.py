@@ -0,0 +1,298 @@
+'''
+    Streaming outlier detectors for PM2.5 readings.
+
+        fixed  - value > threshold (the original rule)
+        hampel - |x - median| > k * 1.4826 * MAD over the last `window` readings
+        ewma   - |x - mean| > z * std, exponentially weighted
+
+    Detectors are kept per sensor by a DetectorBank, so every site is
+    judged against its own recent baseline. Until a detector has seen
+    `min_periods` readings it falls back to the fixed threshold.
+'''
+
+import math
+from collections import deque
+from random import getrandbits
+
+# Scale factor turning a MAD into a consistent estimate of a normal std
+MAD_SCALE = 1.4826
+
+
+class FixedThresholdDetector(object):
+    def __init__(self, threshold=50.0):
+        self.threshold = threshold
+
+    def is_outlier(self, value):
+        return value > self.threshold
+
+
+class _Node(object):
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value, levels):
+        self.value = value
+        self.next = [None] * levels
+        # width[level]: how many positions next[level] is ahead of this node
+        self.width = [1] * levels
+
+
+class SortedWindow(object):
+    '''
+    Sliding window of the last `size` values, also kept in sorted order.
+
+    The sorted order is an indexable skiplist: every link records how
+    many values it skips, so inserting, evicting, the k-th value and the
+    rank of a value are all O(log w) expected, with no shifting of the
+    other w values. An evicted node is unlinked and relinked for the new
+    value, so a full window allocates nothing per reading.
+    '''
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self._fifo = deque()
+        # Links skip ~4x as far per level up: log4(w) levels
+        self._levels = (self.size.bit_length() + 1) // 2 + 1
+        self._head = _Node(None, self._levels)
+        tail = _Node(math.inf, 0)
+        self._head.next = [tail] * self._levels
+        self._chain = [None] * self._levels
+        self._steps = [0] * self._levels
+        self._top = range(self._levels - 1, -1, -1)
+
+    def __len__(self):
+        return len(self._fifo)
+
+    def push(self, value):
+        if len(self._fifo) == self.size:
+            node = self._unlink(self._fifo.popleft())
+            node.value = value
+        else:
+            # Geometric height: level i+1 with probability 4^-i
+            bits = getrandbits(2 * self._levels) | (1 << (2 * self._levels - 2))
+            node = _Node(value, ((bits & -bits).bit_length() + 1) // 2)
+        self._fifo.append(value)
+        self._link(node)
+
+    def _link(self, new):
+        value = new.value
+        chain = self._chain
+        steps = self._steps
+        node = self._head
+        for level in self._top:
+            width = node.width
+            nxt = node.next[level]
+            step = 0
+            while nxt.value <= value:
+                step += width[level]
+                node = nxt
+                width = node.width
+                nxt = node.next[level]
+            chain[level] = node
+            steps[level] = step
+
+        height = len(new.next)
+        skipped = 0
+        for level in range(height):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - skipped
+            prev.width[level] = skipped + 1
+            skipped += steps[level]
+        for level in range(height, self._levels):
+            chain[level].width[level] += 1
+
+    def _unlink(self, value):
+        """Unlink the first node holding `value` and return it."""
+        chain = self._chain
+        node = self._head
+        for level in self._top:
+            nxt = node.next[level]
+            while nxt.value < value:
+                node = nxt
+                nxt = node.next[level]
+            chain[level] = node
+
+        old = chain[0].next[0]
+        height = len(old.next)
+        for level in range(height):
+            prev = chain[level]
+            prev.width[level] += old.width[level] - 1
+            prev.next[level] = old.next[level]
+        for level in range(height, self._levels):
+            chain[level].width[level] -= 1
+        return old
+
+    def _node_at(self, index):
+        """Node holding the value at sorted position `index` (0-based)."""
+        node = self._head
+        remaining = index + 1
+        for level in self._top:
+            width = node.width[level]
+            while width <= remaining:
+                remaining -= width
+                node = node.next[level]
+                width = node.width[level]
+        return node
+
+    def _count_below(self, value):
+        """Number of values < `value`."""
+        node = self._head
+        rank = 0
+        for level in self._top:
+            nxt = node.next[level]
+            while nxt.value < value:
+                rank += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+        return rank
+
+    def _count_up_to(self, value):
+        """Number of values <= `value`."""
+        node = self._head
+        rank = 0
+        for level in self._top:
+            nxt = node.next[level]
+            while nxt.value <= value:
+                rank += node.width[level]
+                node = nxt
+                nxt = node.next[level]
+        return rank
+
+    def median(self):
+        n = len(self._fifo)
+        node = self._node_at((n - 1) // 2)
+        if n % 2:
+            return node.value
+        return (node.value + node.next[0].value) / 2.0
+
+    def count_within(self, low, high):
+        """Number of values v with low < v < high."""
+        if high <= low:
+            return 0
+        return self._count_below(high) - self._count_up_to(low)
+
+
+class HampelDetector(object):
+    '''
+    Rolling Hampel filter over the previous `window` readings.
+
+    The MAD is never materialised: x is an outlier when
+    |x - m| > k * 1.4826 * MAD, i.e. when MAD < D = |x - m| / (k * 1.4826),
+    which holds exactly when at least half of the window lies strictly
+    within (m - D, m + D). That is two rank queries on the sorted window.
+    (For even windows this uses the upper median of the deviations.)
+    `min_mad` stops a perfectly flat window from flagging every change.
+    '''
+
+    def __init__(self, window=96, n_sigmas=3.0, min_periods=24, min_mad=0.5,
+                 fallback_threshold=50.0):
+        self.window = SortedWindow(window)
+        self.n_sigmas = n_sigmas
+        self.min_periods = max(int(min_periods), 1)
+        self.min_mad = min_mad
+        self.fallback_threshold = fallback_threshold
+
+    def is_outlier(self, value):
+        if not math.isfinite(value):
+            # Kept out of the window: NaN has no place in the sorted order
+            return True
+        window = self.window
+        n = len(window)
+        if n < self.min_periods:
+            outlier = value > self.fallback_threshold
+        else:
+            median = window.median()
+            limit = abs(value - median) / (self.n_sigmas * MAD_SCALE)
+            if limit <= self.min_mad:
+                outlier = False
+            else:
+                outlier = window.count_within(median - limit, median + limit) >= n // 2 + 1
+        window.push(value)
+        return outlier
+
+
+class EwmaDetector(object):
+    '''
+    Exponentially weighted z-score: O(1) time and memory per reading.
+    `alpha` is the weight of the newest reading in the running mean and
+    variance; `min_std` keeps a flat series from flagging every change.
+    '''
+
+    def __init__(self, alpha=0.05, z=3.0, min_periods=24, min_std=0.5,
+                 fallback_threshold=50.0):
+        self.alpha = alpha
+        self.z = z
+        self.min_periods = max(int(min_periods), 1)
+        self.min_std = min_std
+        self.fallback_threshold = fallback_threshold
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def is_outlier(self, value):
+        if self.count < self.min_periods:
+            outlier = value > self.fallback_threshold
+        else:
+            std = max(math.sqrt(self.var), self.min_std)
+            outlier = abs(value - self.mean) > self.z * std
+
+        if self.count == 0:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            self.mean += self.alpha * delta
+            self.var = (1 - self.alpha) * (self.var + self.alpha * delta * delta)
+        self.count += 1
+        return outlier
+
+
+def parse_overrides(text):
+    """Parse "sensorA:hampel,sensorB:ewma" into a dict."""
+    overrides = {}
+    for item in (text or "").split(","):
+        if ":" in item:
+            sensor, kind = item.rsplit(":", 1)
+            overrides[sensor.strip()] = kind.strip().lower()
+    return overrides
+
+
+class DetectorBank(object):
+    '''
+    One detector per sensor, created on first use. `default` names the
+    detector kind for every sensor not listed in `overrides`, and
+    `settings` holds the keyword arguments for each kind.
+    '''
+
+    FACTORIES = {
+        "fixed": FixedThresholdDetector,
+        "hampel": HampelDetector,
+        "ewma": EwmaDetector,
+    }
+
+    def __init__(self, default="fixed", overrides=None, settings=None):
+        self.default = default
+        self.overrides = overrides or {}
+        self.settings = settings or {}
+        for kind in [default] + list(self.overrides.values()):
+            if kind not in self.FACTORIES:
+                raise ValueError(f"Unknown outlier detector: {kind}")
+        self._detectors = {}
+
+    @property
+    def fixed_threshold(self):
+        """The shared threshold if every sensor uses the fixed rule, else None."""
+        if self.default != "fixed" or any(k != "fixed" for k in self.overrides.values()):
+            return None
+        return self.settings.get("fixed", {}).get("threshold", 50.0)
+
+    def detector(self, sensor):
+        detector = self._detectors.get(sensor)
+        if detector is None:
+            kind = self.overrides.get(sensor, self.default)
+            detector = self.FACTORIES[kind](**self.settings.get(kind, {}))
+            self._detectors[sensor] = detector
+        return detector
+
+    def is_outlier(self, sensor, value):
+        return self.detector(sensor).is_outlier(value)
@@ -0,0 +1,223 @@
+'''
+    Staged pipeline for the preprocessor.
+
+        receive   - paho's network thread; on_message only enqueues the raw
+                    message, so keepalives never wait on processing
+        aggregate - one worker thread: parse, detect outliers, window
+        publish   - one thread owning the RabbitMQ connection
+
+    The stages are connected by bounded queues. When the uplink is slow the
+    publish queue fills, the aggregate stage blocks on it, the ingest queue
+    fills, and the receive stage applies the backpressure policy:
+
+        drop  - discard the message and count it
+        pause - stop reading from the broker (block the network loop)
+                until the ingest queue has drained below `resume_fraction`
+                of its capacity; the subscription stays in place
+
+    PipelineMetrics keeps queue depths, drops and queueing latency.
+'''
+
+import queue
+import threading
+import time
+
+
+class PipelineMetrics(object):
+    '''Thread-safe counters and running queue-depth / latency numbers.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self._depths = {}   # name -> [samples, sum, max]
+        self._latency = [0, 0.0, 0.0]
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def depth(self, name, depth):
+        with self._lock:
+            stats = self._depths.setdefault(name, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += depth
+            stats[2] = max(stats[2], depth)
+
+    def latency(self, seconds):
+        with self._lock:
+            self._latency[0] += 1
+            self._latency[1] += seconds
+            self._latency[2] = max(self._latency[2], seconds)
+
+    def summary(self):
+        with self._lock:
+            parts = [f"{name}={value}" for name, value in sorted(self.counters.items())]
+            for name, (samples, total, peak) in sorted(self._depths.items()):
+                mean = total / samples if samples else 0.0
+                parts.append(f"{name}_depth(mean/max)={mean:.1f}/{peak}")
+            samples, total, peak = self._latency
+            if samples:
+                parts.append(
+                    f"queue_latency(mean/max)={total / samples * 1000:.3f}/{peak * 1000:.3f}ms"
+                )
+        return " ".join(parts)
+
+
+class Receiver(object):
+    '''
+    Receive stage: the paho on_message callback.
+
+    `get()` is called by the aggregate stage and hands messages out in
+    arrival order. When the ingest queue is full:
+
+        drop  - the message is discarded and counted ("dropped")
+        pause - the callback waits, up to `max_pause` seconds, for the
+                aggregate stage to drain the queue to `resume_fraction` of
+                its size. paho's network loop is not serviced meanwhile,
+                so the broker holds further messages (in the TCP window,
+                or in the session queue for QoS 1) and they arrive, in
+                order, once we resume. A message still without room after
+                `max_pause` is dropped and counted ("dropped") so the
+                connection's keepalive is never starved; messages the
+                broker itself discards for a slow QoS 0 subscriber show up
+                in the broker's metrics, not here.
+
+    Messages matching `keep` (END) are never dropped: they wait for room.
+    '''
+
+    def __init__(self, maxsize=10000, policy="drop", resume_fraction=0.5,
+                 metrics=None, keep=None, max_pause=20.0):
+        if policy not in ("drop", "pause"):
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.policy = policy
+        self.metrics = metrics or PipelineMetrics()
+        self.keep = keep  # predicate for messages that must never be dropped
+        self.max_pause = max_pause
+        self._queue = queue.Queue(maxsize=max(int(maxsize), 1))
+        self._resume_depth = int(self._queue.maxsize * resume_fraction)
+        self._drained = threading.Event()
+        self.paused = False
+
+    def on_message(self, client, userdata, msg):
+        item = (msg, time.monotonic())
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        if self.policy == "pause":
+            self._drained.clear()
+            self.paused = True
+            started = time.monotonic()
+            self._drained.wait(self.max_pause)
+            self.paused = False
+            self.metrics.count("paused")
+            self.metrics.count("paused_ms", int((time.monotonic() - started) * 1000))
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+
+        if self.keep is not None and self.keep(msg):
+            # The aggregate stage keeps draining, so this wait is short
+            self._queue.put(item)
+        else:
+            self.metrics.count("dropped")
+
+    def get(self, timeout=None):
+        """Next (msg, enqueued_at), or None if nothing arrived within `timeout`."""
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        else:
+            self.metrics.depth("ingest", self._queue.qsize())
+            self.metrics.latency(time.monotonic() - item[1])
+        if self.paused and self._queue.qsize() <= self._resume_depth:
+            self._drained.set()
+        return item
+
+
+class PublishStage(object):
+    '''
+    Publish stage: hands batches of records to a thread that owns the
+    (blocking) RabbitPublisher.
+
+    It has the same publish/flush/pending/close interface as the
+    publisher it wraps, so the aggregate stage does not care whether it
+    publishes inline or through the pipeline. `flush()` blocks only when
+    `maxsize` batches are already waiting, which is what propagates
+    backpressure upstream. `on_confirmed` is called from the publish
+    thread after each batch has been confirmed.
+    '''
+
+    def __init__(self, publisher, maxsize=100, idle_interval=5.0, metrics=None):
+        self.publisher = publisher
+        self.metrics = metrics or PipelineMetrics()
+        self.idle_interval = idle_interval
+        self.on_confirmed = None
+        self._queue = queue.Queue(maxsize=max(int(maxsize), 1))
+        self._buffer = []
+        self._unconfirmed = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self._unconfirmed + self._buffer
+
+    def publish(self, record):
+        with self._lock:
+            self._buffer.append(record)
+
+    def flush(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._unconfirmed.extend(batch)
+        if batch:
+            self._queue.put(batch)
+            self.metrics.depth("publish", self._queue.qsize())
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                self.publisher.idle()
+                continue
+            # Coalesce whatever else is waiting into the same confirm round
+            batches = [batch]
+            while batches[-1] is not None:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batches[-1] is None
+            records = [record for batch in batches if batch is not None for record in batch]
+
+            for record in records:
+                self.publisher.publish(record)
+            self.publisher.flush()
+            with self._lock:
+                del self._unconfirmed[:len(records)]
+            if records:
+                self.metrics.count("published", len(records))
+                self.metrics.count("publish_rounds")
+                if self.on_confirmed is not None:
+                    self.on_confirmed()
+            if stop:
+                break
+
+    def close(self):
+        """Publish everything still queued, then close the publisher."""
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self.publisher.close()
@@ -1,15 +1,41 @@
 import json
 import os
+import socket
+import struct
 import sys
+import threading
+import time
+import zlib
+from collections import deque
 from datetime import datetime, timezone
 
+import numpy as np
 import paho.mqtt.client as mqtt
 import pika
 
+from aggregator import WindowAggregator, epoch_seconds, parse_duration
+from checkpoint import Checkpointer
+from microbatch import MicroBatcher
+from outbox import Outbox, OutboxStage
+from outliers import DetectorBank, parse_overrides
+from pipeline import PipelineMetrics, PublishStage, Receiver
+
 # MQTT (Edge / EMQX)
 MQTT_BROKER = os.getenv("MQTT_BROKER", "emqx")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "uo/pm25")
+# Subscription QoS; with 1 (and the injector publishing at QoS 1) the broker
+# queues readings for us while backpressure pauses the network loop
+MQTT_QOS = int(os.getenv("MQTT_QOS", "0"))
+
+# Running several replicas. Either join an MQTT v5 shared subscription
+# group (the broker spreads the per-sensor topics over the group; use a
+# hash-by-topic strategy so a sensor always lands on the same replica), or
+# give every replica PARTITION_COUNT and its own PARTITION_INDEX so each
+# keeps only the sensors that hash to it. Both need AGG_BY_SENSOR.
+MQTT_SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "")
+PARTITION_COUNT = int(os.getenv("PARTITION_COUNT", "1"))
+PARTITION_INDEX = int(os.getenv("PARTITION_INDEX", "0"))
 
 # RabbitMQ (Cloud)
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
@@ -17,181 +43,816 @@ RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "pm25_daily_avg")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "student")
 RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "student")
+# Records buffered before a confirmed publish round, and reconnect backoff cap
+RABBITMQ_BATCH_SIZE = int(os.getenv("RABBITMQ_BATCH_SIZE", "100"))
+RABBITMQ_MAX_BACKOFF = float(os.getenv("RABBITMQ_MAX_BACKOFF", "30"))
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+# Print every record as it is published (debugging; slow at high rates)
+RABBITMQ_LOG_RECORDS = os.getenv("RABBITMQ_LOG_RECORDS", "false").lower() == "true"
+
+# Windowed aggregation: window length and slide ("day", "hour", "15m", seconds),
+# how late a reading may arrive, and whether windows are kept per sensor
+AGG_WINDOW = parse_duration(os.getenv("AGG_WINDOW", "day"))
+AGG_SLIDE = parse_duration(os.getenv("AGG_SLIDE", str(AGG_WINDOW)))
+AGG_ALLOWED_LATENESS = parse_duration(os.getenv("AGG_ALLOWED_LATENESS", "0"))
+AGG_BY_SENSOR = os.getenv("AGG_BY_SENSOR", "true").lower() == "true"
+# Per-window quantiles come from a KLL sketch of this size (memory per
+# window stays around 3 * k values; rank error roughly 1.7 / k)
+QUANTILE_SKETCH_K = int(os.getenv("QUANTILE_SKETCH_K", "200"))
+
+# Outlier detection per sensor: "fixed" (value > OUTLIER_THRESHOLD), "hampel"
+# (rolling median/MAD) or "ewma" (exponentially weighted z-score).
+# OUTLIER_DETECTOR_OVERRIDES picks a different one per sensor, e.g.
+# "sensorA:hampel,sensorB:fixed". Adaptive detectors use the fixed
+# threshold until they have seen OUTLIER_MIN_PERIODS readings.
+OUTLIER_THRESHOLD = float(os.getenv("OUTLIER_THRESHOLD", "50"))
+OUTLIER_DETECTOR = os.getenv("OUTLIER_DETECTOR", "fixed").lower()
+OUTLIER_DETECTOR_OVERRIDES = parse_overrides(os.getenv("OUTLIER_DETECTOR_OVERRIDES", ""))
+OUTLIER_MIN_PERIODS = int(os.getenv("OUTLIER_MIN_PERIODS", "24"))
+HAMPEL_WINDOW = int(os.getenv("HAMPEL_WINDOW", "96"))
+HAMPEL_SIGMAS = float(os.getenv("HAMPEL_SIGMAS", "3"))
+EWMA_ALPHA = float(os.getenv("EWMA_ALPHA", "0.05"))
+EWMA_Z = float(os.getenv("EWMA_Z", "3"))
+
+# Vectorized micro-batch path: reduce up to MICROBATCH_READINGS readings (or
+# whatever arrived within MICROBATCH_MAX_DELAY_MS) at once; 0 = per message
+MICROBATCH_READINGS = int(os.getenv("MICROBATCH_READINGS", "0"))
+MICROBATCH_MAX_DELAY_MS = float(os.getenv("MICROBATCH_MAX_DELAY_MS", "100"))
+
+# Bounded bookkeeping: how many recent readings to keep in memory (0 = none),
+# an optional append-only JSON-lines log of every raw reading, and how many
+# finalized daily averages to keep for the end-of-run summary
+RECENT_READINGS = int(os.getenv("RECENT_READINGS", "0"))
+RAW_LOG_PATH = os.getenv("RAW_LOG_PATH", "")
+SUMMARY_MAX_DAYS = int(os.getenv("SUMMARY_MAX_DAYS", "1000"))
+
+# Pipeline between the MQTT network loop and RabbitMQ: bounded queues of
+# messages and of record batches, and what to do when the ingest queue is
+# full: "drop" (count and discard) or "pause" (stop reading from the broker
+# until it has drained to BACKPRESSURE_RESUME of its size, for at most
+# BACKPRESSURE_MAX_PAUSE seconds at a time, then count and discard; keep
+# this below the 60 s keepalive). Metrics are printed every
+# PIPELINE_METRICS_INTERVAL seconds (0 = only at the end).
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", "100"))
+BACKPRESSURE_POLICY = os.getenv("BACKPRESSURE_POLICY", "drop").lower()
+BACKPRESSURE_RESUME = float(os.getenv("BACKPRESSURE_RESUME", "0.5"))
+BACKPRESSURE_MAX_PAUSE = float(os.getenv("BACKPRESSURE_MAX_PAUSE", "20"))
+PIPELINE_METRICS_INTERVAL = float(os.getenv("PIPELINE_METRICS_INTERVAL", "30"))
+
+# Store-and-forward: when OUTBOX_DIR is set, records are first appended to
+# segment files there and drained to RabbitMQ as compressed NDJSON batches
+# of up to OUTBOX_BATCH_RECORDS (OUTBOX_COMPRESSION: gzip, zstd or none)
+OUTBOX_DIR = os.getenv("OUTBOX_DIR", "")
+OUTBOX_SEGMENT_BYTES = int(os.getenv("OUTBOX_SEGMENT_BYTES", str(1 << 20)))
+OUTBOX_BATCH_RECORDS = int(os.getenv("OUTBOX_BATCH_RECORDS", "500"))
+OUTBOX_COMPRESSION = os.getenv("OUTBOX_COMPRESSION", "gzip")
+
+# Crash-safe state: when CHECKPOINT_PATH is set, open windows, counters and
+# the windows already handed to RabbitMQ are snapshotted there at most every
+# CHECKPOINT_INTERVAL seconds; in between, the windows about to be published
+# are appended to a small delta log. Both are restored at startup
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "5"))
+
+# Wire formats we accept; advertised (retained) under MQTT_CAPS_TOPIC so the
+# injector can switch to binary batches. JSON is always understood.
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "")
+if not MQTT_CLIENT_ID:
+    # Replicas need distinct client IDs or the broker disconnects all but one
+    if PARTITION_COUNT > 1:
+        MQTT_CLIENT_ID = f"Preprocessor-{PARTITION_INDEX}"
+    elif MQTT_SHARE_GROUP:
+        MQTT_CLIENT_ID = f"Preprocessor-{socket.gethostname()}"
+    else:
+        MQTT_CLIENT_ID = "Preprocessor"
+MQTT_CAPS_TOPIC = os.getenv("MQTT_CAPS_TOPIC", "uo/caps")
+SUPPORTED_FORMATS = ["pm25-batch/2", "pm25-batch/1", "json"]
+
+# Binary batches: version 2 carries the sensor ID after the header (see the
+# injector's publisher.py); version 1 has none and is keyed by topic
+WIRE_MAGIC = b"PM25"
+WIRE_VERSION = 2
+WIRE_HEADER = struct.Struct("<4sBxHH")
+WIRE_HEADER_V1 = struct.Struct("<4sBxH")
+WIRE_RECORD = struct.Struct("<qf")
+WIRE_DTYPE = np.dtype([("Timestamp", "<i8"), ("Value", "<f4")])
 
 
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
         print("Preprocessor connected to MQTT broker")
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe(data_topic(), qos=MQTT_QOS)
+        print(f"Subscribed to topic: {data_topic()}")
+        # END (and readings without a per-sensor topic) arrive on the base
+        # topic; a subscription of its own so it reaches every replica
+        client.subscribe(MQTT_TOPIC, qos=MQTT_QOS)
         print(f"Subscribed to topic: {MQTT_TOPIC}")
+        advertise_formats(client)
     else:
         print(f"Failed to connect to MQTT broker, reason code: {reason_code}")
 
 
-def send_to_rabbitmq(daily_avgs):
-    """Send one or more daily average records to RabbitMQ."""
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                virtual_host="/",
-                credentials=credentials,
-            )
+def data_topic():
+    """
+    Subscription for the injector's per-sensor topics (<topic>/<sensor>,
+    one level: the injector sanitizes "/" out of sensor IDs). The base
+    topic has its own subscription; "<topic>/#" would match it too and
+    deliver its messages twice.
+    """
+    if MQTT_SHARE_GROUP:
+        return f"$share/{MQTT_SHARE_GROUP}/{MQTT_TOPIC}/+"
+    return f"{MQTT_TOPIC}/+"
+
+
+def owns(key):
+    """Whether this replica aggregates sensor `key` (PARTITION_COUNT / INDEX)."""
+    if PARTITION_COUNT <= 1:
+        return True
+    return zlib.crc32(str(key).encode("utf-8")) % PARTITION_COUNT == PARTITION_INDEX
+
+
+def caps_topic():
+    return f"{MQTT_CAPS_TOPIC}/{MQTT_CLIENT_ID}"
+
+
+def advertise_formats(client):
+    caps = {"Client": MQTT_CLIENT_ID, "Formats": SUPPORTED_FORMATS}
+    client.publish(caps_topic(), json.dumps(caps), retain=True)
+
+
+def withdraw_formats(client):
+    # An empty retained message clears our advertisement on the broker
+    client.publish(caps_topic(), b"", retain=True)
+
+
+def batch_header(payload):
+    """(sensor ID or None, record count, offset of the first record) of a binary batch."""
+    version = payload[4]
+    if version == 1:
+        _, _, count = WIRE_HEADER_V1.unpack_from(payload)
+        return None, count, WIRE_HEADER_V1.size
+    if version != WIRE_VERSION:
+        raise ValueError(f"unsupported batch version {version}")
+    _, _, count, sensor_length = WIRE_HEADER.unpack_from(payload)
+    offset = WIRE_HEADER.size + sensor_length
+    sensor = bytes(payload[WIRE_HEADER.size:offset]).decode("utf-8")
+    return sensor or None, count, offset
+
+
+def decode_payload(payload):
+    """
+    Decode an MQTT payload into a list of readings.
+
+    Binary batches (WIRE_MAGIC header) are unpacked into reading dicts,
+    with the batch's sensor ID as "Sensor" like a JSON reading; anything
+    else is treated as a single JSON document (reading or control).
+    """
+    if payload[:4] == WIRE_MAGIC:
+        sensor, count, offset = batch_header(payload)
+        body = memoryview(payload)[offset:offset + count * WIRE_RECORD.size]
+        if sensor is None:
+            return [{"Timestamp": ts, "Value": v} for ts, v in WIRE_RECORD.iter_unpack(body)]
+        return [{"Sensor": sensor, "Timestamp": ts, "Value": v} for ts, v in WIRE_RECORD.iter_unpack(body)]
+
+    return [json.loads(payload.decode("utf-8"))]
+
+
+def decode_batch_arrays(payload):
+    """View a binary batch as (sensor ID or None, Timestamp, Value arrays) without copying."""
+    sensor, count, offset = batch_header(payload)
+    batch = np.frombuffer(payload, dtype=WIRE_DTYPE, count=count, offset=offset)
+    return sensor, batch["Timestamp"], batch["Value"]
+
+
+class RabbitPublisher(object):
+    '''
+    Long-lived RabbitMQ publisher.
+
+    Keeps one connection and channel open, declares the queue once and
+    publishes in AMQP transactions: `flush()` publishes up to `batch_size`
+    buffered records and commits them together, so a whole batch costs
+    one broker round trip and its records only leave the buffer once the
+    commit has returned. A batch interrupted by a connection error is not
+    committed and is sent again in full after reconnecting (with
+    exponential backoff).
+    Every message carries a stable message_id ("<sensor>:<window start>")
+    so consumers can drop a window that is re-sent after a crash.
+    '''
+
+    def __init__(self, host, port, queue, user, password, batch_size=100,
+                 max_backoff=30.0, heartbeat=60, log_records=False):
+        self.queue = queue
+        self.batch_size = max(int(batch_size), 1)
+        self.log_records = log_records
+        self.max_backoff = max_backoff
+        self._params = pika.ConnectionParameters(
+            host=host,
+            port=port,
+            virtual_host="/",
+            credentials=pika.PlainCredentials(user, password),
+            heartbeat=heartbeat,
         )
-    except Exception as e:
-        print(f"Could not connect to RabbitMQ: {e}")
-        sys.exit(1)
-
-    channel = connection.channel()
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-
-    for record in daily_avgs:
-        body = json.dumps(record)
-        print("Sending daily avg to RabbitMQ:", body)
-        channel.basic_publish(
-            exchange="",
-            routing_key=RABBITMQ_QUEUE,
-            body=body,
+        self._connection = None
+        self._channel = None
+        self._pending = []
+        self.on_confirmed = None
+        self.published = 0
+        self.publish_seconds = 0.0
+        self.reconnects = 0
+
+    def _connect(self):
+        backoff = 0.5
+        while True:
+            try:
+                self._connection = pika.BlockingConnection(self._params)
+                self._channel = self._connection.channel()
+                self._channel.queue_declare(queue=self.queue, durable=True)
+                self._channel.tx_select()
+                print(f"Connected to RabbitMQ queue '{self.queue}'")
+                return
+            except pika.exceptions.AMQPError as e:
+                self.reconnects += 1
+                print(f"Could not connect to RabbitMQ ({e}); retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _reset(self):
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self._connection = None
+        self._channel = None
+
+    @property
+    def pending(self):
+        """Records buffered but not yet confirmed by the broker."""
+        return list(self._pending)
+
+    def publish(self, record):
+        """Buffer a record; sends a batch once `batch_size` records are pending."""
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def idle(self):
+        """Service heartbeats while there is nothing to publish."""
+        if self._connection is None or not self._connection.is_open:
+            return
+        try:
+            self._connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as e:
+            print(f"RabbitMQ connection lost while idle ({e})")
+            self._reset()
+
+    def flush(self):
+        """Publish all buffered records, one committed batch at a time, until all are committed."""
+        confirmed = bool(self._pending)
+        while self._pending:
+            if self._channel is None or not self._channel.is_open:
+                self._connect()
+            batch = self._pending[:self.batch_size]
+            try:
+                # Service heartbeats that accumulated while we were idle
+                self._connection.process_data_events(time_limit=0)
+                started = time.perf_counter()
+                for record in batch:
+                    body = json.dumps(record)
+                    if self.log_records:
+                        print("Sending daily avg to RabbitMQ:", body)
+                    self._channel.basic_publish(
+                        exchange="",
+                        routing_key=self.queue,
+                        body=body,
+                        properties=pika.BasicProperties(
+                            content_type="application/json",
+                            delivery_mode=2,  # persistent
+                            message_id=f"{record['Sensor']}:{record['Timestamp']}",
+                        ),
+                    )
+                # The only round trip for the batch
+                self._channel.tx_commit()
+                self.publish_seconds += time.perf_counter() - started
+            except pika.exceptions.AMQPError as e:
+                # Nothing of an uncommitted batch was delivered; if the
+                # commit went through but its reply was lost, consumers
+                # drop the resent copies by message_id
+                print(f"RabbitMQ publish failed ({e}); reconnecting")
+                self._reset()
+                continue
+            del self._pending[:len(batch)]
+            self.published += len(batch)
+        if confirmed and self.on_confirmed is not None:
+            self.on_confirmed()
+
+    def send_batch(self, body, content_type, content_encoding=None, message_id=None, records=1):
+        """Publish one pre-encoded message, reconnecting until it is confirmed."""
+        properties = pika.BasicProperties(
+            content_type=content_type,
+            content_encoding=content_encoding,
+            delivery_mode=2,  # persistent
+            message_id=message_id,
+            headers={"Records": records},
         )
+        backoff = 0.5
+        while True:
+            if self._channel is None or not self._channel.is_open:
+                self._connect()
+            try:
+                self._connection.process_data_events(time_limit=0)
+                started = time.perf_counter()
+                self._channel.basic_publish(
+                    exchange="",
+                    routing_key=self.queue,
+                    body=body,
+                    properties=properties,
+                )
+                self._channel.tx_commit()
+                self.publish_seconds += time.perf_counter() - started
+                self.published += records
+                print(f"Sent batch of {records} records to RabbitMQ ({len(body)} bytes)")
+                return
+            except pika.exceptions.AMQPError as e:
+                print(f"RabbitMQ publish failed ({e}); retrying in {backoff:.1f}s")
+                self._reset()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def close(self):
+        self.flush()
+        self._reset()
+        if self.published:
+            avg_ms = self.publish_seconds / self.published * 1000
+            print(
+                f"RabbitMQ: {self.published} records published "
+                f"({avg_ms:.3f} ms/record, {self.reconnects} reconnects)"
+            )
 
-    connection.close()
-
-
-def finalize_and_send_day(userdata):
-    """Finalize current day stats -> print and send to RabbitMQ, then reset."""
-    day_ts = userdata.get("current_day_ts")
-    count = userdata.get("current_count", 0)
-    total = userdata.get("current_sum", 0.0)
-
-    if day_ts is None or count == 0:
-        return
-
-    avg = total / count
-    record = {"Timestamp": day_ts, "Value": avg}
-
-    # Log nicely
-    dt = datetime.fromtimestamp(day_ts, tz=timezone.utc)
-    print(f"[DAILY AVG] {dt.date()} -> {avg:.2f}")
 
-    # Send to RabbitMQ
-    send_to_rabbitmq([record])
+def topic_sensor(topic):
+    """Sensor ID from a per-sensor topic (<MQTT_TOPIC>/<sensor>), if any."""
+    prefix = MQTT_TOPIC + "/"
+    if topic.startswith(prefix):
+        return topic[len(prefix):]
+    return None
+
+
+def send_windows(userdata, emitted):
+    """Turn closed windows into records -> print and queue them for RabbitMQ."""
+    last_emitted = userdata["emitted"]
+    for key, start, state in emitted:
+        avg = state.mean
+        if avg is None:
+            continue
+        # Windows close in start order per key, so one mark per key is enough
+        # to recognise a window already sent before a restart
+        if start <= last_emitted.get(key, float("-inf")):
+            print(f"[WINDOW AVG] {key} {start} already sent, skipping")
+            continue
+        last_emitted[key] = start
+        userdata["emitted_new"][key] = start
+        p50, p95, p99 = state.sketch.quantiles([0.5, 0.95, 0.99])
+        record = {
+            "Timestamp": start,
+            "Value": avg,
+            "Sensor": key,
+            "Count": state.count,
+            "Min": state.min,
+            "Max": state.max,
+            "Variance": state.variance,
+            "P50": p50,
+            "P95": p95,
+            "P99": p99,
+        }
+
+        # Log nicely
+        dt = datetime.fromtimestamp(start, tz=timezone.utc)
+        print(
+            f"[WINDOW AVG] {key} {dt.isoformat()} -> {avg:.2f} "
+            f"(n={state.count}, min={state.min:.2f}, max={state.max:.2f}, p95={p95:.2f})"
+        )
 
-    # Store for summary at the end
-    userdata.setdefault("daily_avgs", []).append(record)
+        # Queue for RabbitMQ; sent when the current MQTT message is done
+        userdata["publisher"].publish(record)
 
-    # Reset current-day stats; next message will set a new day_ts
-    userdata["current_day_ts"] = None
-    userdata["current_sum"] = 0.0
-    userdata["current_count"] = 0
+        # Store for summary at the end
+        userdata["daily_avgs"].append(record)
 
 
-def update_daily_stats(userdata, reading):
-    """Incrementally update per-day stats for a non-outlier reading."""
+def update_window_stats(userdata, reading, sensor=None):
+    """Fold a non-outlier reading into its windows and send any that closed."""
     ts = reading.get("Timestamp")
     value = reading.get("Value")
     if ts is None or value is None:
         return
 
     try:
-        ts_raw = int(ts)
+        ts_sec = epoch_seconds(ts)
         v = float(value)
     except (TypeError, ValueError):
         return
 
-    # Detect ms vs seconds and normalise
-    if ts_raw > 1_000_000_000_000:  # heuristic: milliseconds
-        ts_sec = ts_raw / 1000.0
-    else:
-        ts_sec = ts_raw
+    key = sensor_key(reading, sensor)
+    send_windows(userdata, userdata["aggregator"].add(key, ts_sec, v))
+
+
+def sensor_key(reading, sensor):
+    """Aggregation key: the reading's sensor when keyed per sensor."""
+    if not AGG_BY_SENSOR:
+        return "all"
+    return reading.get("Sensor") or sensor or "all"
+
+
+def flush_batch(userdata):
+    """Reduce the pending micro-batch and send any windows it closed."""
+    raw, clean, emitted = userdata["batcher"].flush()
+    if raw:
+        userdata["clean_count"] += clean
+        print(f"[BATCH] {raw} readings, {raw - clean} outliers, {len(emitted)} windows closed")
+        send_windows(userdata, emitted)
+
+
+def batch_message(userdata, msg, sensor):
+    """Micro-batch path: append the message's readings to the pending batch."""
+    batcher = userdata["batcher"]
+    if msg.payload[:4] == WIRE_MAGIC:
+        batch_sensor, ts, values = decode_batch_arrays(msg.payload)
+        if sensor is None and not owns(batch_sensor or "all"):
+            return None
+        key = sensor_key({"Sensor": batch_sensor}, sensor)
+        batcher.add_arrays(key, ts, values)
+        userdata["raw_count"] += len(ts)
+        if userdata["recent"] is not None or userdata["raw_log"] is not None:
+            for t, v in zip(ts.tolist(), values.tolist()):
+                record_raw(userdata, {"Sensor": key, "Timestamp": t, "Value": v})
+        return None
+
+    data = json.loads(msg.payload.decode("utf-8"))
+    if isinstance(data, dict) and data.get("Type") == "END":
+        return data
+    if sensor is None and not owns(data.get("Sensor") or "all"):
+        return None
 
-    dt = datetime.fromtimestamp(ts_sec, tz=timezone.utc)
-    day_start = datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
-    day_ts = int(day_start.timestamp())
+    userdata["raw_count"] += 1
+    record_raw(userdata, data)
+    try:
+        ts, value = int(data["Timestamp"]), float(data["Value"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    batcher.add_reading(sensor_key(data, sensor), ts, value)
+    return None
+
+
+def is_control(msg):
+    """END and other control messages must never be dropped by backpressure."""
+    return msg.payload[:1] == b"{" and b'"Type"' in msg.payload
+
+
+def process_message(client, userdata, msg):
+    """Aggregate stage: handle one PM2.5 message (single JSON or binary batch)."""
+    sensor = topic_sensor(msg.topic)
+    if sensor is not None and not owns(sensor):
+        return  # another replica's sensor
+    with userdata["lock"]:
+        if userdata["batcher"] is not None:
+            try:
+                control = batch_message(userdata, msg, sensor)
+            except Exception as e:
+                print(f"Failed to parse MQTT message: {e}")
+                return
+            if control is not None:
+                handle_reading(client, userdata, control, sensor)
+            elif userdata["batcher"].due():
+                flush_batch(userdata)
+        else:
+            try:
+                readings = decode_payload(msg.payload)
+            except Exception as e:
+                print(f"Failed to parse MQTT message: {e}")
+                return
+            for data in readings:
+                handle_reading(client, userdata, data, sensor)
+
+    # Hand whatever this message finalized to the publisher
+    publish_round(userdata)
+    if userdata["ended"]:
+        finish_stream(client, userdata)
+
+
+def checkpoint_state(userdata):
+    return {
+        "aggregator": userdata["aggregator"].snapshot(),
+        "emitted": userdata["emitted"],
+        "pending": userdata["publisher"].pending,
+        "raw_count": userdata["raw_count"],
+        "clean_count": userdata["clean_count"],
+    }
 
-    current_day_ts = userdata.get("current_day_ts")
 
-    # If we already have a day and this reading is from a new day,
-    # finalize the previous one.
-    if current_day_ts is not None and day_ts != current_day_ts:
-        finalize_and_send_day(userdata)
-        current_day_ts = None
+def checkpoint_delta(userdata):
+    """What changed for publishing since the last save/append: cheap to log."""
+    return {
+        "emitted": userdata["emitted_new"],
+        "pending": userdata["publisher"].pending,
+        "raw_count": userdata["raw_count"],
+        "clean_count": userdata["clean_count"],
+    }
 
-    # Start a new day bucket if needed
-    if current_day_ts is None:
-        userdata["current_day_ts"] = day_ts
-        userdata["current_sum"] = 0.0
-        userdata["current_count"] = 0
 
-    # Update running stats
-    userdata["current_sum"] += v
-    userdata["current_count"] += 1
+def publish_round(userdata):
+    """
+    Send what the last message(s) finalized, checkpointing around it.
+
+    Newly closed windows are logged *before* they are published, as a
+    delta with their emitted marks and the unconfirmed records, so a crash
+    mid-publish resends exactly those records on restart instead of
+    recomputing and sending their windows a second time. Once the broker
+    has confirmed them another delta drops them (checkpoint_confirmed);
+    only a crash between those two steps resends a record, under the same
+    message_id. The full window state is only snapshotted when due.
+
+    Must be called without userdata["lock"] held: flushing may block on a
+    full publish queue, and the publish stage needs the lock to checkpoint.
+    """
+    checkpointer = userdata["checkpointer"]
+    if checkpointer is not None:
+        with userdata["lock"]:
+            checkpointer.mark_dirty()
+            if checkpointer.due():
+                checkpointer.save(checkpoint_state(userdata))
+            elif userdata["emitted_new"]:
+                checkpointer.append(checkpoint_delta(userdata))
+            userdata["emitted_new"] = {}
+    userdata["publisher"].flush()
+
+
+def checkpoint_confirmed(userdata):
+    """Publisher callback: drop confirmed records from the checkpoint."""
+    with userdata["lock"]:
+        userdata["checkpointer"].append(checkpoint_delta(userdata))
+        userdata["emitted_new"] = {}
+
+
+def restore_checkpoint(userdata):
+    """Load the last checkpoint into fresh userdata; returns True if one was used."""
+    checkpointer = userdata["checkpointer"]
+    state, deltas = checkpointer.load() if checkpointer is not None else (None, [])
+    if state is None and not deltas:
+        return False
+    if state is None:
+        # Crashed before the first snapshot: no window state, but the logged
+        # emitted marks and unconfirmed records still apply
+        state = {"emitted": {}, "pending": [], "raw_count": 0, "clean_count": 0}
+    else:
+        try:
+            userdata["aggregator"].restore(state["aggregator"])
+        except (KeyError, ValueError) as e:
+            print(f"Ignoring checkpoint {checkpointer.path}: {e}")
+            return False
+
+    userdata["emitted"].update(state["emitted"])
+    userdata["raw_count"] = state["raw_count"]
+    userdata["clean_count"] = state["clean_count"]
+    for delta in deltas:
+        userdata["emitted"].update(delta["emitted"])
+        userdata["raw_count"] = delta["raw_count"]
+        userdata["clean_count"] = delta["clean_count"]
+        state["pending"] = delta["pending"]
+    for record in state["pending"]:
+        userdata["publisher"].publish(record)
+    print(
+        f"Restored checkpoint from {checkpointer.path}: "
+        f"{userdata['aggregator'].open_windows} open windows, "
+        f"{len(deltas)} deltas replayed, {len(state['pending'])} records to resend"
+    )
+    return True
+
+
+def run_aggregate_stage(client, userdata):
+    """
+    Worker thread: take messages from the receive stage and process them
+    until END. While idle, flushes micro-batches that have waited long
+    enough and reports pipeline metrics.
+    """
+    receiver = userdata["receiver"]
+    metrics = receiver.metrics
+    timeout = 1.0
+    if userdata["batcher"] is not None:
+        timeout = max(MICROBATCH_MAX_DELAY_MS / 2000.0, 0.001)
+    last_report = time.monotonic()
+
+    while not userdata["ended"]:
+        item = receiver.get(timeout=timeout)
+        if item is not None:
+            process_message(client, userdata, item[0])
+        elif userdata["batcher"] is not None:
+            with userdata["lock"]:
+                if userdata["batcher"].due():
+                    flush_batch(userdata)
+            publish_round(userdata)
+
+        if PIPELINE_METRICS_INTERVAL > 0 and time.monotonic() - last_report >= PIPELINE_METRICS_INTERVAL:
+            last_report = time.monotonic()
+            print(f"[PIPELINE] {metrics.summary()}")
+
+
+def finish_stream(client, userdata):
+    """After END: wait for every record to be confirmed, summarise, disconnect."""
+    userdata["publisher"].close()
+    if userdata["checkpointer"] is not None:
+        # Everything is confirmed; a later run starts afresh
+        userdata["checkpointer"].remove()
+
+    # Print summary for the logs
+    if userdata.get("daily_avgs"):
+        print("Window averaged PM2.5 data (sent to RabbitMQ):")
+        for rec in userdata["daily_avgs"]:
+            dt = datetime.fromtimestamp(rec["Timestamp"], tz=timezone.utc)
+            print(f"{rec['Sensor']} {dt.isoformat()} -> {rec['Value']:.2f}")
+    else:
+        print("No daily averages computed.")
 
+    # Disconnect so loop_forever() returns and container exits
+    if client is not None:
+        withdraw_formats(client)
+        client.disconnect()
 
-def on_message(client, userdata, msg):
-    """Handle incoming PM2.5 readings from MQTT."""
-    try:
-        payload = msg.payload.decode("utf-8")
-        data = json.loads(payload)
-    except Exception as e:
-        print(f"Failed to parse MQTT message: {e}")
-        return
 
+def record_raw(userdata, data):
+    if userdata["recent"] is not None:
+        userdata["recent"].append(data)
+    if userdata["raw_log"] is not None:
+        userdata["raw_log"].write(json.dumps(data) + "\n")
+
+
+def handle_reading(client, userdata, data, sensor=None):
     # Handle END control message from injector
     if isinstance(data, dict) and data.get("Type") == "END":
         print("Received END signal from injector")
 
-        # Finalise and send the last day's average
-        finalize_and_send_day(userdata)
-
-        # Print summary for the logs
-        if userdata.get("daily_avgs"):
-            print("Daily averaged PM2.5 data (sent to RabbitMQ):")
-            for rec in userdata["daily_avgs"]:
-                dt = datetime.fromtimestamp(rec["Timestamp"], tz=timezone.utc)
-                print(f"{dt.date()} -> {rec['Value']:.2f}")
-        else:
-            print("No daily averages computed.")
+        # Finalise every window that is still open; finish_stream() sends
+        # them once the lock is released
+        if userdata["batcher"] is not None:
+            flush_batch(userdata)
+        send_windows(userdata, userdata["aggregator"].flush())
+        userdata["ended"] = True
+        return
 
-        # Disconnect so loop_forever() returns and container exits
-        client.disconnect()
+    # Readings on the base topic carry their sensor in the payload
+    if sensor is None and not owns(data.get("Sensor") or "all"):
         return
 
-    # Normal reading path
-    userdata["raw"].append(data)
+    # Normal reading path: O(1) bookkeeping, nothing grows with uptime
+    userdata["raw_count"] += 1
+    record_raw(userdata, data)
 
     try:
         value = float(data.get("Value"))
     except (TypeError, ValueError):
         return
 
-    if value > 50:
+    if userdata["detectors"].is_outlier(sensor_key(data, sensor), value):
         print("Received PM2.5 (OUTLIER):", data)
     else:
         print("Received PM2.5 (NORMAL):", data)
-        userdata["clean"].append(data)
-        # Incremental per-day stats and possibly send a finished day
-        update_daily_stats(userdata, data)
+        userdata["clean_count"] += 1
+        # Incremental per-window stats and possibly send finished windows
+        update_window_stats(userdata, data, sensor)
+
+
+def build_detectors():
+    return DetectorBank(
+        default=OUTLIER_DETECTOR,
+        overrides=OUTLIER_DETECTOR_OVERRIDES,
+        settings={
+            "fixed": {"threshold": OUTLIER_THRESHOLD},
+            "hampel": {
+                "window": HAMPEL_WINDOW,
+                "n_sigmas": HAMPEL_SIGMAS,
+                "min_periods": OUTLIER_MIN_PERIODS,
+                "fallback_threshold": OUTLIER_THRESHOLD,
+            },
+            "ewma": {
+                "alpha": EWMA_ALPHA,
+                "z": EWMA_Z,
+                "min_periods": OUTLIER_MIN_PERIODS,
+                "fallback_threshold": OUTLIER_THRESHOLD,
+            },
+        },
+    )
 
 
-def main():
+def build_userdata(publisher, microbatch_readings=MICROBATCH_READINGS, checkpointer=None):
+    """Fresh processing state shared by the MQTT callbacks."""
+    detectors = build_detectors()
+    aggregator = WindowAggregator(
+        size=AGG_WINDOW,
+        slide=AGG_SLIDE,
+        allowed_lateness=AGG_ALLOWED_LATENESS,
+        sketch_k=QUANTILE_SKETCH_K,
+    )
+    batcher = None
+    if microbatch_readings > 0:
+        batcher = MicroBatcher(
+            aggregator,
+            detectors,
+            max_readings=microbatch_readings,
+            max_delay_ms=MICROBATCH_MAX_DELAY_MS,
+        )
+
+    if checkpointer is not None:
+        publisher.on_confirmed = lambda: checkpoint_confirmed(userdata)
+
     userdata = {
-        "raw": [],
-        "clean": [],
-        "current_day_ts": None,
-        "current_sum": 0.0,
-        "current_count": 0,
-        "daily_avgs": [],
+        "raw_count": 0,
+        "clean_count": 0,
+        "recent": deque(maxlen=RECENT_READINGS) if RECENT_READINGS > 0 else None,
+        "raw_log": open(RAW_LOG_PATH, "a", buffering=1 << 16) if RAW_LOG_PATH else None,
+        "aggregator": aggregator,
+        "detectors": detectors,
+        "batcher": batcher,
+        "lock": threading.Lock(),
+        "daily_avgs": deque(maxlen=SUMMARY_MAX_DAYS),
+        "publisher": publisher,
+        "emitted": {},  # key -> start of the last window handed to RabbitMQ
+        "emitted_new": {},  # emitted marks not yet in the checkpoint
+        "ended": False,
+        "checkpointer": checkpointer,
     }
+    return userdata
+
+
+def main():
+    if (PARTITION_COUNT > 1 or MQTT_SHARE_GROUP) and not AGG_BY_SENSOR:
+        print("Running replicas needs AGG_BY_SENSOR=true: a combined window would be split")
+        sys.exit(1)
+    if not 0 <= PARTITION_INDEX < PARTITION_COUNT:
+        print(f"PARTITION_INDEX must be in [0, {PARTITION_COUNT})")
+        sys.exit(1)
+
+    metrics = PipelineMetrics()
+    rabbit = RabbitPublisher(
+        RABBITMQ_HOST,
+        RABBITMQ_PORT,
+        RABBITMQ_QUEUE,
+        RABBITMQ_USER,
+        RABBITMQ_PASSWORD,
+        batch_size=RABBITMQ_BATCH_SIZE,
+        max_backoff=RABBITMQ_MAX_BACKOFF,
+        heartbeat=RABBITMQ_HEARTBEAT,
+        log_records=RABBITMQ_LOG_RECORDS,
+    )
+    if OUTBOX_DIR:
+        publisher = OutboxStage(
+            Outbox(OUTBOX_DIR, segment_bytes=OUTBOX_SEGMENT_BYTES),
+            rabbit,
+            batch_records=OUTBOX_BATCH_RECORDS,
+            encoding=OUTBOX_COMPRESSION,
+            idle_interval=max(RABBITMQ_HEARTBEAT / 2.0, 1.0),
+            metrics=metrics,
+        )
+    else:
+        publisher = PublishStage(
+            rabbit,
+            maxsize=PUBLISH_QUEUE_SIZE,
+            idle_interval=max(RABBITMQ_HEARTBEAT / 2.0, 1.0),
+            metrics=metrics,
+        )
+    userdata = build_userdata(
+        publisher,
+        checkpointer=Checkpointer(CHECKPOINT_PATH, CHECKPOINT_INTERVAL) if CHECKPOINT_PATH else None,
+    )
+    userdata["receiver"] = Receiver(
+        maxsize=INGEST_QUEUE_SIZE,
+        policy=BACKPRESSURE_POLICY,
+        resume_fraction=BACKPRESSURE_RESUME,
+        metrics=metrics,
+        keep=is_control,
+        max_pause=BACKPRESSURE_MAX_PAUSE,
+    )
+    publisher.start()
+    restored = restore_checkpoint(userdata)
+    if userdata["checkpointer"] is not None:
+        # Snapshot before anything is received or published, so every delta
+        # logged from here on follows a snapshot
+        with userdata["lock"]:
+            userdata["checkpointer"].save(checkpoint_state(userdata))
+    if restored:
+        # Resend whatever was not confirmed before the crash
+        publisher.flush()
 
     client = mqtt.Client(
-        client_id="Preprocessor",
+        client_id=MQTT_CLIENT_ID,
         userdata=userdata,
         callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
     )
     client.on_connect = on_connect
-    client.on_message = on_message
+    # Receive stage: only enqueues, so the network loop never waits on us
+    client.on_message = userdata["receiver"].on_message
+    # Clear our format advertisement if we drop off without saying goodbye
+    client.will_set(caps_topic(), None, retain=True)
 
     print(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT} ...")
     try:
@@ -200,6 +861,8 @@ def main():
         print(f"Could not connect to MQTT broker: {e}")
         sys.exit(1)
 
+    threading.Thread(target=run_aggregate_stage, args=(client, userdata), daemon=True).start()
+
     # Run until we receive the END signal and call client.disconnect()
     print("Waiting for PM2.5 data and END signal from injector...")
     try:
@@ -207,12 +870,27 @@ def main():
     except KeyboardInterrupt:
         print("Interrupted, disconnecting...")
         client.disconnect()
-
-    raw_readings = userdata["raw"]
-    clean_readings = userdata["clean"]
-
-    print(f"Total readings received: {len(raw_readings)}")
-    print(f"Non-outlier readings (<= 50): {len(clean_readings)}")
+        publisher.close()
+        if userdata["checkpointer"] is not None:
+            with userdata["lock"]:
+                userdata["checkpointer"].save(checkpoint_state(userdata))
+
+    if userdata["raw_log"] is not None:
+        userdata["raw_log"].close()
+
+    print(f"Total readings received: {userdata['raw_count']}")
+    print(f"Non-outlier readings ({OUTLIER_DETECTOR}): {userdata['clean_count']}")
+    print(f"Late readings dropped: {userdata['aggregator'].late_dropped}")
+    print(f"Pipeline: {metrics.summary()}")
+    if userdata["checkpointer"] is not None:
+        checkpointer = userdata["checkpointer"]
+        print(f"Replayed readings skipped: {userdata['aggregator'].replayed_skipped}")
+        if checkpointer.saves:
+            avg_ms = checkpointer.save_seconds / checkpointer.saves * 1000
+            print(f"Checkpoints written: {checkpointer.saves} ({avg_ms:.3f} ms each)")
+        if checkpointer.appends:
+            avg_ms = checkpointer.append_seconds / checkpointer.appends * 1000
+            print(f"Checkpoint deltas logged: {checkpointer.appends} ({avg_ms:.3f} ms each)")
 
 
 if __name__ == "__main__":
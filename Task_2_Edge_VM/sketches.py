@@ -0,0 +1,131 @@
+'''
+    Mergeable summaries for windowed statistics.
+
+    KllSketch answers quantile queries over a stream in bounded memory
+    (about 3k items for parameter k, whatever the stream length) with a
+    rank error of roughly 1.7 / k, and two sketches can be merged, which
+    lets the micro-batch path build a partial sketch per batch and fold it
+    into the window. While fewer than k items have been added nothing is
+    compacted and quantiles are exact.
+'''
+
+import math
+import random
+from bisect import bisect_left
+from itertools import accumulate
+
+
+class KllSketch(object):
+    '''
+    KLL quantile sketch (Karnin, Lang & Liberty, 2016).
+
+    Level h holds items of weight 2**h. When the sketch is full, the lowest
+    level over its capacity is sorted and every other item (random offset)
+    is promoted to the level above, halving its size while keeping ranks
+    unbiased. Capacities shrink geometrically by `c` towards the lower
+    levels.
+    '''
+
+    def __init__(self, k=200, c=2.0 / 3.0, seed=None):
+        self.k = max(int(k), 8)
+        self.c = c
+        self.count = 0
+        self.compactors = [[]]
+        self.size = 0
+        self._seed = seed
+        self._rng = None  # created on first compaction; most windows never need one
+        self._update_max_size()
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(int(math.ceil(self.k * self.c ** depth)), 2)
+
+    def _update_max_size(self):
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def update_many(self, values):
+        n = len(values)
+        if not n:
+            return
+        self.compactors[0].extend(values)
+        self.count += n
+        self.size += n
+        if self.size >= self.max_size:
+            self._compress()
+
+    def merge(self, other):
+        """Fold another sketch into this one."""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for mine, theirs in zip(self.compactors, other.compactors):
+            mine.extend(theirs)
+        self.count += other.count
+        self.size = sum(len(level) for level in self.compactors)
+        self._update_max_size()
+        if self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        while self.size >= self.max_size:
+            for h in range(len(self.compactors)):
+                if len(self.compactors[h]) >= self._capacity(h):
+                    if h + 1 == len(self.compactors):
+                        self.compactors.append([])
+                        self._update_max_size()
+                    items = sorted(self.compactors[h])
+                    odd = len(items) % 2
+                    if self._rng is None:
+                        self._rng = random.Random(self._seed)
+                    offset = self._rng.getrandbits(1)
+                    # An odd item out stays behind so weights add up exactly
+                    self.compactors[h] = items[:odd]
+                    self.compactors[h + 1].extend(items[odd + offset::2])
+                    self.size = sum(len(level) for level in self.compactors)
+                    break
+
+    def quantiles(self, qs):
+        """Approximate values at the given quantiles (0..1), or Nones if empty."""
+        if len(self.compactors) == 1:
+            # Nothing compacted yet: exact nearest-rank quantiles
+            values = sorted(self.compactors[0])
+            if not values:
+                return [None] * len(qs)
+            n = len(values)
+            return [values[max(math.ceil(min(max(q, 0.0), 1.0) * n) - 1, 0)] for q in qs]
+
+        weighted = sorted(
+            (value, 1 << h) for h, level in enumerate(self.compactors) for value in level
+        )
+        if not weighted:
+            return [None] * len(qs)
+        values = [value for value, _ in weighted]
+        cumulative = list(accumulate(weight for _, weight in weighted))
+        total = cumulative[-1]
+        result = []
+        for q in qs:
+            rank = min(max(q, 0.0), 1.0) * total
+            index = min(bisect_left(cumulative, rank), len(values) - 1)
+            result.append(values[index])
+        return result
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def to_state(self):
+        return {"k": self.k, "count": self.count, "levels": self.compactors}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state["k"])
+        sketch.count = state["count"]
+        sketch.compactors = [list(level) for level in state["levels"]]
+        sketch.size = sum(len(level) for level in sketch.compactors)
+        sketch._update_max_size()
+        return sketch
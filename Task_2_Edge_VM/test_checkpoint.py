@@ -0,0 +1,65 @@
+'''
+    A preprocessor that crashes before its first checkpoint snapshot must
+    still restore the emitted marks it logged, so replayed readings do not
+    send the same daily averages twice.
+
+    Usage: python -m pytest test_checkpoint.py
+'''
+
+import contextlib
+import json
+import os
+
+import preprocessor
+from bench_preprocessor import Message
+from checkpoint import Checkpointer
+
+START_MS = 1_601_510_400_000
+
+
+class ConfirmedPublisher(object):
+    '''Records what is published; the broker confirms everything at once.'''
+
+    def __init__(self):
+        self.records = []
+        self.pending = []
+
+    def publish(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        pass
+
+
+def messages(days=4):
+    # Every 15 minutes for `days` days, one sensor
+    return [
+        Message(f"{preprocessor.MQTT_TOPIC}/s1",
+                json.dumps({"Timestamp": START_MS + i * 900_000, "Value": 10.0 + i % 7}).encode("utf-8"))
+        for i in range(days * 96)
+    ]
+
+
+def run(path, msgs):
+    publisher = ConfirmedPublisher()
+    userdata = preprocessor.build_userdata(publisher, 0, Checkpointer(path, interval=3600))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        restored = preprocessor.restore_checkpoint(userdata)
+        for msg in msgs:
+            preprocessor.process_message(None, userdata, msg)
+    return restored, publisher.records
+
+
+def test_crash_before_first_snapshot(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    msgs = messages()
+
+    # No snapshot is due within the first hour: only deltas are logged
+    restored, first = run(path, msgs)
+    assert not restored and first
+    assert not os.path.exists(path) and os.path.exists(f"{path}.log")
+
+    # The restarted process sees the same readings again
+    restored, second = run(path, msgs)
+    assert restored
+    assert second == []
@@ -0,0 +1,45 @@
+'''
+    SortedWindow's skiplist must agree with a plain sorted list on the
+    median and on band counts, including duplicates and band edges equal
+    to a stored value; the Hampel filter must keep NaN / inf out of it.
+
+    Usage: python -m pytest test_outliers.py
+'''
+
+import random
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+import pytest
+
+from outliers import HampelDetector, SortedWindow
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 96, 513])
+def test_sorted_window_matches_sorted_list(size):
+    rng = random.Random(size)
+    window = SortedWindow(size)
+    fifo = deque()
+    ref = []
+    for _ in range(5000):
+        value = rng.choice([rng.gauss(10, 5), float(rng.randint(0, 20))])
+        if len(fifo) == size:
+            del ref[bisect_left(ref, fifo.popleft())]
+        fifo.append(value)
+        insort(ref, value)
+        window.push(value)
+
+        n = len(ref)
+        assert len(window) == n
+        assert window.median() == (ref[n // 2] if n % 2 else (ref[n // 2 - 1] + ref[n // 2]) / 2.0)
+        low = value if rng.random() < 0.2 else rng.uniform(-5, 25)
+        high = value if rng.random() < 0.2 else rng.uniform(-5, 25)
+        assert window.count_within(low, high) == max(bisect_left(ref, high) - bisect_right(ref, low), 0)
+
+
+def test_hampel_skips_non_finite():
+    detector = HampelDetector(window=8, min_periods=2)
+    for value in [10.0, 11.0, float("nan"), 12.0, float("inf"), 10.5]:
+        detector.is_outlier(value)
+    assert len(detector.window) == 4
+    assert detector.window.median() == 10.75
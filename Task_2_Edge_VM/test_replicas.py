@@ -0,0 +1,44 @@
+'''
+    Preprocessor replicas, fed like a shared subscription or partitioned
+    by sensor, must together emit exactly the windows of a single
+    instance: the same set, each window once.
+
+    Usage: python -m pytest test_replicas.py
+'''
+
+import contextlib
+import json
+import os
+
+import pytest
+
+import preprocessor
+from bench_preprocessor import Message, json_messages, make_readings
+from bench_replicas import CollectingPublisher, NullClient, broker, window_map
+
+
+@pytest.fixture(scope="module")
+def messages():
+    ts, values = make_readings(6_000, 12)
+    msgs = json_messages(ts, values)
+    msgs.sort(key=lambda m: json.loads(m.payload)["Timestamp"])
+    return msgs
+
+
+def single_instance(msgs):
+    publisher = CollectingPublisher()
+    userdata = preprocessor.build_userdata(publisher, 0)
+    end = json.dumps({"Type": "END"}).encode("utf-8")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for msg in msgs + [Message(preprocessor.MQTT_TOPIC, end)]:
+            preprocessor.process_message(NullClient(), userdata, msg)
+    return publisher.records
+
+
+@pytest.mark.parametrize("mode", ["shared", "partition"])
+def test_replicas_match_single_instance(messages, mode):
+    baseline = window_map(single_instance(messages))
+    assert baseline
+    _, records = broker(messages, 3, mode)
+    assert len(records) == len(baseline)
+    assert window_map(records) == baseline
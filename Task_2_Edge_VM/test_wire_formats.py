@@ -0,0 +1,70 @@
+'''
+    JSON readings and the injector's binary batches must aggregate to the
+    same windows, under the same sensor key, whether the injector uses
+    per-sensor topics or the shared one.
+
+    Usage: python -m pytest test_wire_formats.py
+'''
+
+import contextlib
+import json
+import os
+import sys
+
+import pytest
+
+import preprocessor
+from bench_preprocessor import Message, NullPublisher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Task_1_Edge"))
+from publisher import encode_batch, sensor_topic  # noqa: E402
+
+# Needs sanitizing for a topic level: space, "/" and "#"
+SENSORS = ["Newcastle Rd #3/North", "plain-sensor"]
+START_MS = 1_601_510_400_000
+
+
+def readings(sensor, n=300):
+    # Every 15 minutes, a little over three days
+    return [
+        {"Sensor": sensor, "Timestamp": START_MS + i * 900_000, "Value": round(5 + (i * 7) % 23 * 0.5, 2)}
+        for i in range(n)
+    ]
+
+
+def messages(payload_format, per_sensor, batch=50):
+    result = []
+    for sensor in SENSORS:
+        topic = sensor_topic(preprocessor.MQTT_TOPIC, sensor, per_sensor)
+        rows = readings(sensor)
+        if payload_format == "json":
+            result += [Message(topic, json.dumps(r).encode("utf-8")) for r in rows]
+        else:
+            result += [Message(topic, encode_batch(rows[i:i + batch], sensor))
+                       for i in range(0, len(rows), batch)]
+    return result
+
+
+def aggregate(msgs, microbatch_readings):
+    publisher = NullPublisher()
+    userdata = preprocessor.build_userdata(publisher, microbatch_readings)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for msg in msgs:
+            preprocessor.process_message(None, userdata, msg)
+        if userdata["batcher"] is not None:
+            preprocessor.flush_batch(userdata)
+        preprocessor.send_windows(userdata, userdata["aggregator"].flush())
+    return {
+        # The RabbitMQ message_id is built from these two
+        (r["Sensor"], r["Timestamp"]): (r["Count"], round(r["Value"], 4), r["Min"], r["Max"])
+        for r in publisher.records
+    }
+
+
+@pytest.mark.parametrize("per_sensor", [True, False])
+@pytest.mark.parametrize("microbatch_readings", [0, 1000])
+def test_binary_matches_json(per_sensor, microbatch_readings):
+    from_json = aggregate(messages("json", per_sensor), microbatch_readings)
+    from_binary = aggregate(messages("binary", per_sensor), microbatch_readings)
+    assert {sensor for sensor, _ in from_json} == set(SENSORS)
+    assert from_binary == from_json
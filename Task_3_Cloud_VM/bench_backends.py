@@ -0,0 +1,104 @@
+'''
+    Benchmark: Prophet vs the NumPy Holt-Winters backend.
+
+    Both backends forecast the same synthetic daily series (weekly and
+    yearly cycles, a trend and noise) through ml_engine.forecast_many,
+    holding out the last `horizon` days. Each backend runs in its own
+    child process so its import time and peak memory (including Stan's
+    worker processes) are measured separately. Reported per backend:
+    import + fit/forecast time, peak RSS, MAE and sMAPE on the held-out
+    days, and how often the truth falls inside the 80% interval.
+
+    Usage: python bench_backends.py [series] [days] [horizon]
+'''
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BACKENDS = ("holt_winters", "prophet")
+
+
+def make_series(n_series, days, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(days)
+    frames = []
+    for i in range(n_series):
+        y = (
+            25
+            + rng.uniform(-0.01, 0.01) * t
+            + 6 * np.sin(2 * np.pi * t / 365.25 + rng.uniform(0, 2 * np.pi))
+            + 2 * np.sin(2 * np.pi * t / 7 + rng.uniform(0, 2 * np.pi))
+            + rng.normal(0, 1.5, days)
+        )
+        frames.append(pd.DataFrame({
+            "series_id": f"sensor-{i:04d}",
+            "ds": pd.date_range("2021-01-01", periods=days, freq="D"),
+            "y": y,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def run(backend, n_series, days, horizon):
+    """Child process: fit one backend, print its results as JSON."""
+    started = time.perf_counter()
+    import logging
+
+    from ml_engine import forecast_many
+    if backend == "prophet":
+        import prophet  # noqa: F401  (counted as part of the backend's cost)
+        logging.getLogger("cmdstanpy").disabled = True
+    imported = time.perf_counter()
+
+    data = make_series(n_series, days)
+    cutoff = data["ds"].max() - pd.Timedelta(days=horizon)
+    train = data[data["ds"] <= cutoff]
+    forecast, failures = forecast_many(train, periods=horizon, workers=1, backend=backend)
+    elapsed = time.perf_counter() - imported
+
+    merged = forecast.merge(data[data["ds"] > cutoff], on=["series_id", "ds"])
+    error = merged["yhat"] - merged["y"]
+    smape = (2 * error.abs() / (merged["yhat"].abs() + merged["y"].abs())).mean() * 100
+    inside = ((merged["y"] >= merged["yhat_lower"]) & (merged["y"] <= merged["yhat_upper"])).mean()
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    print(json.dumps({
+        "import": imported - started, "fit": elapsed, "peak_mb": peak_kb / 1024,
+        "mae": float(error.abs().mean()), "smape": float(smape), "coverage": float(inside),
+        "failed": len(failures),
+    }))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        run(sys.argv[2], *map(int, sys.argv[3:6]))
+        return
+    n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 730
+    horizon = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+
+    print(f"{n_series} series of {days} days, forecasting the last {horizon}")
+    print(f"{'backend':>13}{'import s':>10}{'fit s':>9}{'series/s':>10}{'peak MB':>9}"
+          f"{'MAE':>8}{'sMAPE %':>9}{'80% cov':>9}")
+    for backend in BACKENDS:
+        out = subprocess.run(
+            [sys.executable, __file__, "--run", backend, str(n_series), str(days), str(horizon)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        print(
+            f"{backend:>13}{r['import']:>10.2f}{r['fit']:>9.2f}{n_series / r['fit']:>10.1f}"
+            f"{r['peak_mb']:>9.0f}{r['mae']:>8.3f}{r['smape']:>9.2f}{r['coverage']:>9.2f}"
+            + (f"  ({r['failed']} failed)" if r["failed"] else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
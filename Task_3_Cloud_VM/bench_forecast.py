@@ -0,0 +1,71 @@
+'''
+    Benchmark: forecasting many series with ml_engine.forecast_many.
+
+    Generates synthetic daily PM2.5 series (a yearly cycle, a weekly
+    cycle and noise, of varying length), forecasts them all with 1, 2,
+    4, ... up to N worker processes and reports series/s and the speed-up
+    over one worker. The forecasts must not depend on the worker count.
+    One deliberately broken series checks that a failure stays isolated.
+
+    Usage: python bench_forecast.py [series] [days] [max workers]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ml_engine import forecast_many
+
+
+def make_series(n_series, days, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(n_series):
+        length = int(days * rng.uniform(0.5, 1.0))
+        t = np.arange(length)
+        y = (
+            20
+            + 6 * np.sin(2 * np.pi * t / 365.25 + rng.uniform(0, 2 * np.pi))
+            + 2 * np.sin(2 * np.pi * t / 7)
+            + rng.normal(0, 1.5, length)
+        )
+        frames.append(pd.DataFrame({
+            "series_id": f"sensor-{i:04d}",
+            "ds": pd.date_range("2020-01-01", periods=length, freq="D"),
+            "y": y,
+        }))
+    # Too short to fit: must fail on its own without taking others down
+    frames.append(pd.DataFrame({"series_id": "broken", "ds": [pd.Timestamp("2020-01-01")], "y": [1.0]}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 730
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+
+    data = make_series(n_series, days)
+    print(f"{n_series} series of up to {days} days ({len(data)} rows), {os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'seconds':>10}{'series/s':>10}{'speed-up':>10}  failed  match")
+    baseline = None
+    base_elapsed = None
+    workers = 1
+    while workers <= max_workers:
+        started = time.perf_counter()
+        forecast, failures = forecast_many(data, workers=workers)
+        elapsed = time.perf_counter() - started
+        if baseline is None:
+            baseline, base_elapsed = forecast, elapsed
+        match = forecast.shape == baseline.shape and np.allclose(forecast["yhat"], baseline["yhat"])
+        print(
+            f"{workers:>8}{elapsed:>10.2f}{n_series / elapsed:>10.2f}"
+            f"{base_elapsed / elapsed:>10.2f}  {sorted(failures)!s:>6}  {match}"
+        )
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+'''
+    Streaming RabbitMQ consumer for the window averages.
+
+    Messages are pushed with basic_consume under a prefetch window instead
+    of one basic_get round trip each, decoded straight into growable NumPy
+    columns, and acknowledged with one multiple-ack per commit. A commit
+    first appends the new rows to the history store (ts_store), so a
+    message is only acked once its records are on disk; if the process
+    dies before that, the broker redelivers it.
+'''
+
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+import pika
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# One row per window record; fields missing from a record are NaN
+RECORD_DTYPE = np.dtype([
+    ("Timestamp", "<i8"),
+    ("Sensor", "<i4"),
+    ("Count", "<i8"),
+    ("Value", "<f8"),
+    ("Min", "<f8"),
+    ("Max", "<f8"),
+    ("Variance", "<f8"),
+    ("P50", "<f8"),
+    ("P95", "<f8"),
+    ("P99", "<f8"),
+])
+STAT_FIELDS = ("Value", "Min", "Max", "Variance", "P50", "P95", "P99")
+
+
+def decode_body(properties, body):
+    """
+    Records in one message: a single JSON record, or a batch of JSON lines
+    (application/x-ndjson) from the preprocessor's outbox, optionally
+    gzip / zstd compressed as named by content_encoding.
+    """
+    encoding = (properties.content_encoding or "identity").lower()
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd-compressed message but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompress(body, max_output_size=64 << 20)
+    elif encoding != "identity":
+        raise ValueError(f"unsupported content encoding {encoding!r}")
+
+    text = body.decode("utf-8")
+    if properties.content_type == "application/x-ndjson":
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [json.loads(text)]
+
+
+class RecordBuffer(object):
+    '''
+    Columnar record store: a preallocated structured array that doubles
+    when full, with sensor names kept as small integer codes.
+
+    With a `store` (a TimeSeriesStore), `persist()` writes the rows added
+    since the last call to it.
+    '''
+
+    def __init__(self, store=None, capacity=1024):
+        self.store = store
+        self._rows = np.zeros(max(int(capacity), 16), dtype=RECORD_DTYPE)
+        self._size = 0
+        self._persisted = 0
+        self.sensors = []
+        self._codes = {}
+
+    def __len__(self):
+        return self._size
+
+    def _sensor_code(self, name):
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.sensors)
+            self.sensors.append(name)
+        return code
+
+    def _reserve(self, n):
+        if self._size + n > len(self._rows):
+            grown = np.zeros(max(len(self._rows) * 2, self._size + n), dtype=RECORD_DTYPE)
+            grown[:self._size] = self._rows[:self._size]
+            self._rows = grown
+
+    def append(self, record):
+        """Add one decoded record; returns False if it has no usable Timestamp/Value."""
+        try:
+            ts = int(record["Timestamp"])
+            value = float(record["Value"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        self._reserve(1)
+        stats = [record.get(field) for field in STAT_FIELDS[1:]]
+        self._rows[self._size] = (
+            ts,
+            self._sensor_code(str(record.get("Sensor") or "")),
+            int(record.get("Count") or 1),
+            value,
+            *[np.nan if v is None else v for v in stats],
+        )
+        self._size += 1
+        return True
+
+    def rows(self):
+        return self._rows[:self._size]
+
+    def frame(self):
+        """
+        All records as a DataFrame, keeping the last copy of any
+        (Sensor, Timestamp) that was delivered more than once.
+        """
+        rows = self.rows()
+        df = pd.DataFrame({name: rows[name] for name in RECORD_DTYPE.names})
+        df["Sensor"] = pd.Categorical.from_codes(rows["Sensor"], categories=self.sensors)
+        if not self.sensors or self.sensors == [""]:
+            df = df.drop(columns="Sensor")
+            return df.drop_duplicates(subset="Timestamp", keep="last", ignore_index=True)
+        return df.drop_duplicates(subset=["Sensor", "Timestamp"], keep="last", ignore_index=True)
+
+    def persist(self):
+        """Durably store the rows added since the last call."""
+        if self.store is None or self._persisted == self._size:
+            return
+        self.store.append(self._rows[self._persisted:self._size], self.sensors)
+        self._persisted = self._size
+
+
+class DailyAverageConsumer(object):
+    '''
+    basic_consume with manual acks.
+
+    `collect()` receives until the queue has been idle for `idle_timeout`
+    seconds. Every `commit_every` messages (default: half the prefetch,
+    never more than all of it, so the broker never stalls on a full
+    window) it calls `commit()`, which persists the buffer and acks
+    everything received so far with a single multiple-ack. Without a
+    buffer store, nothing is acked until `commit()` is called after the
+    data has been used, so the prefetch is unlimited: a full window would
+    stop deliveries and end `collect()` part-way through the backlog.
+    `close()` returns unacked messages to the queue.
+    '''
+
+    def __init__(self, params, queue, prefetch=1000, commit_every=0, idle_timeout=2.0,
+                 buffer=None):
+        self.queue = queue
+        self.buffer = buffer if buffer is not None else RecordBuffer()
+        # 0: no limit, which is what the ack-at-the-end mode needs
+        self.prefetch = max(int(prefetch), 0) if self.buffer.store is not None else 0
+        self.commit_every = int(commit_every) or max(self.prefetch // 2, 1)
+        if self.prefetch:
+            self.commit_every = min(self.commit_every, self.prefetch)
+        self.idle_timeout = idle_timeout
+        self.messages = 0
+        self.failed = 0
+        self.duplicates = 0
+        # A preprocessor restored from a checkpoint may resend windows it
+        # had not seen confirmed; they carry the same message_id
+        self._seen_ids = set()
+        self._last_tag = None
+        self._uncommitted = 0
+
+        self._connection = pika.BlockingConnection(params)
+        self._channel = self._connection.channel()
+        self._channel.queue_declare(queue=queue, durable=True)
+        self._channel.basic_qos(prefetch_count=self.prefetch)
+
+    def collect(self):
+        periodic = self.buffer.store is not None
+        for method, properties, body in self._channel.consume(
+            self.queue, auto_ack=False, inactivity_timeout=self.idle_timeout
+        ):
+            if method is None:
+                break  # queue drained
+            self._last_tag = method.delivery_tag
+            self._uncommitted += 1
+            if properties.message_id is not None:
+                if properties.message_id in self._seen_ids:
+                    self.duplicates += 1
+                    continue
+                self._seen_ids.add(properties.message_id)
+            try:
+                records = decode_body(properties, body)
+            except Exception as e:
+                print(f"Failed to decode message: {e}")
+                self.failed += 1
+                continue
+
+            for record in records:
+                self.buffer.append(record)
+            self.messages += 1
+            if periodic and self._uncommitted >= self.commit_every:
+                self.commit()
+
+        self._channel.cancel()
+        if self.prefetch and self._uncommitted >= self.prefetch:
+            print(
+                f"Warning: stopped with the prefetch window full ({self._uncommitted} "
+                "unacked messages); the broker may still hold more"
+            )
+        if periodic:
+            self.commit()
+        elif self._uncommitted:
+            print(f"Warning: {self._uncommitted} messages stay unacked until commit()")
+        return self.buffer
+
+    def commit(self):
+        """Persist the buffer, then ack every message received so far."""
+        if not self._uncommitted:
+            return
+        # Undecodable messages are acked with the rest: redelivering them
+        # would not make them decode
+        self.buffer.persist()
+        self._channel.basic_ack(delivery_tag=self._last_tag, multiple=True)
+        self._uncommitted = 0
+
+    def close(self):
+        if self._connection.is_open:
+            self._connection.close()
@@ -0,0 +1,283 @@
+'''
+    Serve precomputed forecasts over HTTP.
+
+    The predictor writes every forecast it makes to a ForecastStore (one
+    .npz file per series plus index.json mapping each series to a hash of
+    its forecast). Requests are answered from an in-memory LRU cache of
+    those arrays: a hit is a dict lookup and a binary search for the date
+    range, no Prophet predict() call. An entry is only dropped when its
+    series gets a new forecast (its hash in the index changes) or when it
+    is evicted for space.
+
+        GET /forecast?sensor=<id>&start=YYYY-MM-DD&end=YYYY-MM-DD
+        GET /forecast/combined?start=YYYY-MM-DD&end=YYYY-MM-DD
+        GET /sensors
+        GET /health
+
+    The combined series of all sensors is stored under COMBINED_SERIES,
+    which is reserved: no sensor's forecast is stored or served under it,
+    and /forecast without a sensor returns the combined series (with
+    "sensor": null in the reply). Run standalone with
+    `python forecast_server.py`, or with FORECAST_PORT set the
+    long-running predictor serves from the same process and
+    invalidates entries as soon as it retrains.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import numpy as np
+import pandas as pd
+
+FORECAST_DIR = os.getenv("FORECAST_DIR", "pm25_forecasts")
+FORECAST_HOST = os.getenv("FORECAST_HOST", "0.0.0.0")
+FORECAST_PORT = int(os.getenv("FORECAST_PORT", "8080"))
+# Series kept in memory
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "256"))
+# Seconds between checks of the store's index for new forecasts
+FORECAST_REFRESH = float(os.getenv("FORECAST_REFRESH", "5"))
+
+# Store key of the combined series; reserved, never a sensor id
+COMBINED_SERIES = "_all"
+FORECAST_COLUMNS = ("yhat", "yhat_lower", "yhat_upper")
+
+
+class ForecastStore(object):
+    '''
+    Forecasts on disk: <directory>/<series>.npz holding ds (epoch seconds)
+    and the FORECAST_COLUMNS, and index.json with {series: version}.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+
+    def _path(self, series_id):
+        return os.path.join(self.directory, f"{quote(str(series_id), safe='') or '_'}.npz")
+
+    def versions(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, forecasts):
+        """
+        Store {series_id: forecast Dataframe (ds + FORECAST_COLUMNS)};
+        returns the series whose forecast changed.
+        """
+        with self._lock:
+            versions = self.versions()
+            changed = []
+            for series_id, forecast in forecasts.items():
+                arrays = {"ds": pd.to_datetime(forecast["ds"]).to_numpy("datetime64[s]").astype("<i8")}
+                for column in FORECAST_COLUMNS:
+                    arrays[column] = forecast[column].to_numpy(dtype="<f8")
+                # Not the intervals: Prophet samples them anew on every
+                # predict(), even from an unchanged model
+                digest = hashlib.sha1(arrays["ds"].tobytes())
+                digest.update(arrays["yhat"].tobytes())
+                version = digest.hexdigest()
+                if versions.get(str(series_id)) == version:
+                    continue  # same model as before: nothing to invalidate
+
+                path = self._path(series_id)
+                with open(f"{path}.tmp", "wb") as f:
+                    np.savez(f, **arrays)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f"{path}.tmp", path)
+                versions[str(series_id)] = version
+                changed.append(series_id)
+
+            if changed:
+                tmp_path = f"{self._index_path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(versions, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self._index_path)
+        return changed
+
+    def load(self, series_id):
+        """
+        {column: array} for a series, plus "day" with ds formatted once
+        for the responses, or None if it has no forecast.
+        """
+        try:
+            with np.load(self._path(series_id)) as data:
+                entry = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        entry["day"] = entry["ds"].astype("datetime64[s]").astype("datetime64[D]").astype(str)
+        return entry
+
+
+class ForecastCache(object):
+    '''
+    LRU cache of ForecastStore entries.
+
+    `get()` loads a missing series from the store; `invalidate()` drops
+    one after it was retrained; `refresh()` drops every series whose
+    version in the store's index no longer matches the cached one.
+
+    Each series has an invalidation generation. `get()` notes it before
+    loading (outside the lock) and only caches the result if no
+    invalidation happened meanwhile, so a load that raced a retrain
+    cannot put the old forecast back.
+    '''
+
+    def __init__(self, store, capacity=256):
+        self.store = store
+        self.capacity = max(int(capacity), 1)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._versions = store.versions()
+        self._generations = {}  # series_id -> invalidations so far
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, series_id):
+        with self._lock:
+            entry = self._entries.get(series_id)
+            if entry is not None:
+                self._entries.move_to_end(series_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self._generations.get(series_id, 0)
+
+        # Load outside the lock so other readers are not held up
+        entry = self.store.load(series_id)
+        if entry is None:
+            return None
+        with self._lock:
+            if self._generations.get(series_id, 0) != generation:
+                # Invalidated while loading: serve this request, but let the
+                # next one load the new forecast
+                return entry
+            self._entries[series_id] = entry
+            self._entries.move_to_end(series_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, series_ids):
+        with self._lock:
+            for series_id in series_ids:
+                self._entries.pop(series_id, None)
+                self._generations[series_id] = self._generations.get(series_id, 0) + 1
+
+    def refresh(self):
+        versions = self.store.versions()
+        stale = [s for s, v in versions.items() if self._versions.get(s) != v]
+        stale += [s for s in self._versions if s not in versions]
+        self._versions = versions
+        if stale:
+            self.invalidate(stale)
+        return stale
+
+    def series(self):
+        return sorted(self._versions)
+
+
+def _parse_day(value):
+    if value is None:
+        return None
+    return int(pd.Timestamp(value).value // 1_000_000_000)
+
+
+def query(entry, start=None, end=None):
+    """The forecast points with start <= ds <= end, as a list of dicts."""
+    ds = entry["ds"]
+    lo = 0 if start is None else int(np.searchsorted(ds, start, side="left"))
+    hi = len(ds) if end is None else int(np.searchsorted(ds, end, side="right"))
+    days = entry["day"][lo:hi]
+    columns = [entry[name][lo:hi].tolist() for name in FORECAST_COLUMNS]
+    names = ("ds",) + FORECAST_COLUMNS
+    return [dict(zip(names, values)) for values in zip(days.tolist(), *columns)]
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    cache = None  # set by serve()
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/health":
+            self._reply(200, {"status": "ok", "hits": self.cache.hits, "misses": self.cache.misses})
+        elif url.path == "/sensors":
+            self._reply(200, {"sensors": [s for s in self.cache.series() if s != COMBINED_SERIES]})
+        elif url.path in ("/forecast", "/forecast/combined"):
+            sensor = None if url.path == "/forecast/combined" else params.get("sensor")
+            if sensor == COMBINED_SERIES:
+                self._reply(400, {"error": f"{sensor!r} is reserved, use /forecast/combined"})
+                return
+            try:
+                start = _parse_day(params.get("start"))
+                end = _parse_day(params.get("end"))
+            except ValueError as e:
+                self._reply(400, {"error": f"bad date: {e}"})
+                return
+            entry = self.cache.get(COMBINED_SERIES if sensor is None else sensor)
+            if entry is None:
+                what = "the combined series" if sensor is None else f"sensor {sensor!r}"
+                self._reply(404, {"error": f"no forecast for {what}"})
+                return
+            self._reply(200, {"sensor": sensor, "points": query(entry, start, end)})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass  # one line per request is too much for the container log
+
+
+def serve(cache, host=FORECAST_HOST, port=FORECAST_PORT, refresh=FORECAST_REFRESH):
+    """Start the HTTP server (and index polling) on daemon threads; returns the server."""
+    handler = type("BoundForecastHandler", (ForecastHandler,), {"cache": cache})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def poll():
+        while True:
+            time.sleep(refresh)
+            stale = cache.refresh()
+            if stale:
+                print(f"Forecast cache: {len(stale)} series updated")
+
+    if refresh > 0:
+        threading.Thread(target=poll, daemon=True).start()
+    print(f"Serving forecasts on http://{host}:{server.server_address[1]}")
+    return server
+
+
+def main():
+    cache = ForecastCache(ForecastStore(FORECAST_DIR), FORECAST_CACHE_SIZE)
+    server = serve(cache)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
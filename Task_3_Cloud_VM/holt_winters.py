@@ -0,0 +1,179 @@
+'''
+    Damped-trend Holt-Winters forecasting in NumPy, many series at once.
+
+    Additive level, damped additive trend and additive weekly season
+    (ETS(A,Ad,A)). The smoothing parameters are picked per series by a
+    grid search that runs every series against every grid point in one
+    pass: the state is a (series, grid points) array and the recursion
+    is a loop over days only, so fitting a thousand series costs about
+    as much Python as fitting one.
+
+    fit_many() / forecast_many() work on a 2-D array of aligned daily
+    series; HoltWinters wraps them in the subset of the Prophet API that
+    MLPredictor uses, so it can stand in as a backend.
+'''
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+SEASON = 7  # daily data, weekly season
+ALPHAS = (0.05, 0.1, 0.2, 0.35, 0.5, 0.7, 0.9)
+BETAS = (0.01, 0.05, 0.15, 0.3)
+GAMMAS = (0.0, 0.05, 0.15, 0.3)
+PHIS = (0.8, 0.9, 0.98)
+Z_80 = 1.2816  # Prophet's default interval_width is 0.8
+
+
+def _initial_state(y, season):
+    """Level, trend and season from the first two seasons of each row of `y`."""
+    first = y[:, :season].mean(axis=1)
+    second = y[:, season:2 * season].mean(axis=1)
+    level = first
+    trend = (second - first) / season
+    seasonal = y[:, :season] - first[:, None]
+    return level, trend, seasonal
+
+
+def _run(y, alpha, beta, gamma, phi, season, keep_fitted=False):
+    '''
+    One-step-ahead recursion for every row of `y` (series, days) against
+    parameter arrays of shape (series, k). Returns the sum of squared
+    one-step errors (series, k), the final level, trend and season and,
+    with keep_fitted, the one-step fitted values (series, k, days).
+    '''
+    n, t = y.shape
+    k = alpha.shape[1]
+    level0, trend0, seasonal0 = _initial_state(y, season)
+    level = np.repeat(level0[:, None], k, axis=1)
+    trend = np.repeat(trend0[:, None], k, axis=1)
+    seasonal = np.repeat(seasonal0[:, None, :], k, axis=1)
+    sse = np.zeros((n, k))
+    fitted = np.empty((n, k, t)) if keep_fitted else None
+    for i in range(t):
+        s = seasonal[:, :, i % season]
+        damped = phi * trend
+        prediction = level + damped + s
+        if keep_fitted:
+            fitted[:, :, i] = prediction
+        error = y[:, i, None] - prediction
+        sse += error * error
+        new_level = level + damped + alpha * error
+        trend = damped + alpha * beta * error
+        seasonal[:, :, i % season] = s + gamma * error
+        level = new_level
+    return sse, level, trend, seasonal, fitted
+
+
+def fit_many(y, season=SEASON):
+    '''
+    Fit every row of `y` (series, days; no NaNs, at least two seasons).
+
+    :return: dict of per-series arrays: alpha, beta, gamma, phi, level,
+        trend, season (series, season), sigma (one-step residual std),
+        fitted (series, days) and n (days)
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim != 2 or y.shape[1] < 2 * season:
+        raise ValueError(f"need a (series, days) array with at least {2 * season} days")
+    n = y.shape[0]
+    grid = np.array(list(itertools.product(ALPHAS, BETAS, GAMMAS, PHIS)))
+    alpha, beta, gamma, phi = (np.broadcast_to(grid[:, j], (n, len(grid))) for j in range(4))
+    sse, _, _, _, _ = _run(y, alpha, beta, gamma, phi, season)
+    best = grid[np.argmin(sse, axis=1)]
+
+    # Once more with the chosen parameters for the final state
+    chosen = [best[:, j:j + 1] for j in range(4)]
+    sse, level, trend, seasonal, fitted = _run(y, *chosen, season, keep_fitted=True)
+    t = y.shape[1]
+    return {
+        "alpha": best[:, 0], "beta": best[:, 1], "gamma": best[:, 2], "phi": best[:, 3],
+        "level": level[:, 0], "trend": trend[:, 0], "season": seasonal[:, 0, :],
+        "sigma": np.sqrt(sse[:, 0] / max(t - 1, 1)),
+        "fitted": fitted[:, 0, :], "n": t,
+    }
+
+
+def forecast_many(model, periods, season=SEASON, z=Z_80):
+    '''
+    Forecast `periods` days past the end of the fitted series.
+
+    :return: (yhat, yhat_lower, yhat_upper), each (series, periods)
+    '''
+    h = np.arange(1, periods + 1)
+    phi = model["phi"][:, None]
+    # Sum of phi**1..phi**h: the damped trend contribution after h days
+    damping = np.cumsum(phi ** h[None, :], axis=1)
+    positions = (model["n"] + h - 1) % season
+    yhat = model["level"][:, None] + damping * model["trend"][:, None] + model["season"][:, positions]
+
+    # ETS(A,Ad,A) forecast variance: sigma^2 * (1 + sum_{j<h} c_j^2) with
+    # c_j = alpha * (1 + beta * (phi + ... + phi^j)) + gamma [j a season multiple]
+    alpha = model["alpha"][:, None]
+    beta = model["beta"][:, None]
+    gamma = model["gamma"][:, None]
+    c = alpha * (1 + beta * damping) + gamma * ((h % season) == 0)[None, :]
+    variance = 1 + np.concatenate([np.zeros((len(c), 1)), np.cumsum(c * c, axis=1)[:, :-1]], axis=1)
+    spread = z * model["sigma"][:, None] * np.sqrt(variance)
+    return yhat, yhat - spread, yhat + spread
+
+
+def regular_daily(ds, y):
+    """Put a series on a gap-free daily grid, interpolating missing days."""
+    series = pd.Series(np.asarray(y, dtype=np.float64), index=pd.DatetimeIndex(ds).normalize())
+    series = series.groupby(level=0).mean()
+    days = pd.date_range(series.index[0], series.index[-1], freq="D")
+    return days, series.reindex(days).interpolate(limit_direction="both").to_numpy()
+
+
+class HoltWinters(object):
+    '''
+    Holt-Winters backend for MLPredictor, shaped like the parts of Prophet
+    it uses: fit(df), make_future_dataframe(periods), predict(future) and
+    plot(forecast, figsize).
+    '''
+
+    def __init__(self, season=SEASON):
+        self.season = season
+        self.model = None
+        self.history = None
+
+    def fit(self, df):
+        days, y = regular_daily(df["ds"], df["y"])
+        self.history = pd.DataFrame({"ds": days, "y": y})
+        self.model = fit_many(y[None, :], self.season)
+        return self
+
+    def make_future_dataframe(self, periods=15):
+        last = self.history["ds"].iloc[-1]
+        future = pd.date_range(last + pd.Timedelta(days=1), periods=periods, freq="D")
+        return pd.DataFrame({"ds": pd.concat([self.history["ds"], pd.Series(future)], ignore_index=True)})
+
+    def predict(self, future):
+        n = self.model["n"]
+        periods = max(len(future) - n, 0)
+        yhat, lower, upper = forecast_many(self.model, periods, self.season)
+        fitted = self.model["fitted"][0]
+        spread = Z_80 * self.model["sigma"][0]
+        return pd.DataFrame({
+            "ds": future["ds"].to_numpy(),
+            "yhat": np.concatenate([fitted, yhat[0]]),
+            "yhat_lower": np.concatenate([fitted - spread, lower[0]]),
+            "yhat_upper": np.concatenate([fitted + spread, upper[0]]),
+        })
+
+    def plot(self, forecast, figsize=(10, 6)):
+        import matplotlib.pyplot as plt
+
+        fig = plt.figure(figsize=figsize)
+        ax = fig.add_subplot(111)
+        ax.plot(self.history["ds"], self.history["y"], "k.", label="Observed")
+        ax.plot(forecast["ds"], forecast["yhat"], ls="-", c="#0072B2", label="Forecast")
+        ax.fill_between(forecast["ds"], forecast["yhat_lower"], forecast["yhat_upper"],
+                        color="#0072B2", alpha=0.2)
+        ax.grid(True, which="major", c="gray", ls="-", lw=1, alpha=0.2)
+        ax.set_xlabel("ds")
+        ax.set_ylabel("y")
+        fig.tight_layout()
+        return fig
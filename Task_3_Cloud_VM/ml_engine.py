@@ -7,7 +7,21 @@
     Official guide book of Prophet: https://facebook.github.io/prophet/docs/quick_start.html#python-api
 '''
 
-from prophet import Prophet
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+import holt_winters
+
+# Forecasting engines MLPredictor can use; Prophet is only imported when used
+BACKENDS = ("prophet", "holt_winters")
 
 
 class MLPredictor(object):
@@ -24,32 +38,269 @@ class MLPredictor(object):
         fig = predictor.plot_result(forecast)
         fig.savefig(os.path.join("Your target dir path", "Your target file name))
 
+    With a model_dir, the fitted model is kept there between runs
+    (model.json plus meta.json with a hash of the data it was fitted on):
+
+        - same data as last time: the saved model is loaded, no fit
+        - last time's data with new rows appended: the fit is warm-started
+          from the saved model's parameters
+        - anything else: a fit from scratch
+
+    After train(), fit_mode is "skipped", "warm" or "cold" and
+    fit_seconds the time train() took.
+
+    backend="holt_winters" swaps Prophet for the damped-trend Holt-Winters
+    model in holt_winters.py: no Stan, and a fit in milliseconds, so it
+    is always fitted from scratch and model_dir is not used.
+
     '''
 
-    def __init__(self, data_df):
+    def __init__(self, data_df, model_dir=None, verbose=True, backend="prophet"):
         '''
         :param data_df: Dataframe type dataset
+        :param model_dir: Directory to cache the fitted model in, or None
+        :param verbose: Print progress
+        :param backend: One of BACKENDS
         '''
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown forecasting backend: {backend}")
+        self.__backend = backend
+        self.__verbose = verbose
         self.__train_data = self.__convert_col_name(data_df)
-        self.__trainer = Prophet(changepoint_prior_scale=12)
+        self.__trainer = self.__new_trainer()
+        self.__model_dir = model_dir
+        self.fit_mode = None
+        self.fit_seconds = 0.0
+
+    def __new_trainer(self):
+        if self.__backend == "holt_winters":
+            return holt_winters.HoltWinters()
+        from prophet import Prophet
+
+        return Prophet(changepoint_prior_scale=12)
 
     def train(self):
-        self.__trainer.fit(self.__train_data)
+        started = time.perf_counter()
+        if self.__model_dir is None or self.__backend != "prophet":
+            self.__trainer.fit(self.__train_data)
+            self.fit_mode = "cold"
+        else:
+            self.__train_cached()
+        self.fit_seconds = time.perf_counter() - started
+        if self.__verbose:
+            print(f"Model fit: {self.fit_mode} in {self.fit_seconds:.2f}s")
+
+    def __train_cached(self):
+        row_hashes = pd.util.hash_pandas_object(
+            self.__train_data[["ds", "y"]], index=False
+        ).to_numpy()
+        data_hash = hashlib.sha256(row_hashes.tobytes()).hexdigest()
+        meta = self.__load_meta()
+
+        if meta is not None and meta["data_hash"] == data_hash:
+            try:
+                self.__trainer = self.__load_model()
+                self.fit_mode = "skipped"
+                return
+            except (OSError, ValueError) as e:
+                print(f"Could not load the cached model: {e}")
+
+        appended = (
+            meta is not None
+            and meta["rows"] < len(row_hashes)
+            and hashlib.sha256(row_hashes[:meta["rows"]].tobytes()).hexdigest() == meta["data_hash"]
+        )
+        self.fit_mode = "cold"
+        if appended:
+            try:
+                init = self.__stan_init(self.__load_model())
+                self.__trainer.fit(self.__train_data, init=init)
+                self.fit_mode = "warm"
+            except Exception as e:
+                # e.g. a seasonality switched on by the longer history
+                # changes the parameter shapes
+                print(f"Warm start failed ({e}); fitting from scratch")
+                self.__trainer = self.__new_trainer()
+        if self.fit_mode == "cold":
+            self.__trainer.fit(self.__train_data)
+        self.__save(data_hash, len(row_hashes))
+
+    def __stan_init(self, model):
+        '''
+        Parameters of a fitted model as initial values for the next fit
+        (https://facebook.github.io/prophet/docs/additional_topics.html)
+        '''
+        init = {}
+        for name in ["k", "m", "sigma_obs"]:
+            init[name] = model.params[name][0][0]
+        for name in ["delta", "beta"]:
+            init[name] = model.params[name][0]
+        return init
+
+    def __load_meta(self):
+        try:
+            with open(os.path.join(self.__model_dir, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __load_model(self):
+        from prophet.serialize import model_from_json
+
+        with open(os.path.join(self.__model_dir, "model.json")) as f:
+            return model_from_json(f.read())
+
+    def __save(self, data_hash, rows):
+        from prophet.serialize import model_to_json
+
+        os.makedirs(self.__model_dir, exist_ok=True)
+        # Model first: meta.json must never describe a model we do not have
+        for name, text in [
+            ("model.json", model_to_json(self.__trainer)),
+            ("meta.json", json.dumps({"data_hash": data_hash, "rows": rows,
+                                      "fit_mode": self.fit_mode, "saved_at": time.time()})),
+        ]:
+            path = os.path.join(self.__model_dir, name)
+            with open(f"{path}.tmp", "w") as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{path}.tmp", path)
 
     def __convert_col_name(self, data_df):
         data_df.rename(columns={"Timestamp": "ds", "Value": "y"}, inplace=True)
-        print(f"After rename columns \n{data_df.columns}")
+        if self.__verbose:
+            print(f"After rename columns \n{data_df.columns}")
         return data_df
 
     def __make_future(self, periods=15):
         future = self.__trainer.make_future_dataframe(periods=periods)
         return future
 
-    def predict(self):
-        future = self.__make_future()
+    def predict(self, periods=15):
+        future = self.__make_future(periods)
         forecast = self.__trainer.predict(future)
         return forecast
 
     def plot_result(self, forecast):
         fig = self.__trainer.plot(forecast, figsize=(15, 6))
         return fig
+
+
+def _forecast_chunk(chunk, periods, model_dir):
+    '''
+    Train and predict every (series_id, frame) in `chunk`; runs in a worker.
+    Returns (forecast frames, {series_id: error}), one failing series does
+    not stop the others.
+    '''
+    # One INFO line per Stan run drowns everything else out. cmdstanpy
+    # installs its own INFO handler unless the logger already has one
+    stan_logger = logging.getLogger("cmdstanpy")
+    if not stan_logger.handlers:
+        stan_logger.addHandler(logging.NullHandler())
+    stan_logger.setLevel(logging.WARNING)
+    forecasts, failures = [], {}
+    for series_id, frame in chunk:
+        try:
+            series_dir = None if model_dir is None else os.path.join(model_dir, quote(str(series_id), safe=""))
+            predictor = MLPredictor(frame, model_dir=series_dir, verbose=False)
+            predictor.train()
+            forecast = predictor.predict(periods)[["ds", "yhat", "yhat_lower", "yhat_upper"]]
+            forecasts.append(forecast.assign(series_id=series_id))
+        except Exception as e:
+            failures[series_id] = f"{type(e).__name__}: {e}"
+    return forecasts, failures
+
+
+def _forecast_holt_winters(series, periods):
+    '''
+    Holt-Winters for every (series_id, frame) in `series` at once: series
+    of equal length (after filling gaps) are stacked and fitted together.
+    '''
+    forecasts, failures = [], {}
+    by_length = {}
+    for series_id, frame in series:
+        try:
+            days, y = holt_winters.regular_daily(frame["ds"], frame["y"])
+        except Exception as e:
+            failures[series_id] = f"{type(e).__name__}: {e}"
+            continue
+        if len(y) < 2 * holt_winters.SEASON:
+            failures[series_id] = f"ValueError: {len(y)} days, need {2 * holt_winters.SEASON}"
+            continue
+        by_length.setdefault(len(y), []).append((series_id, days, y))
+
+    for group in by_length.values():
+        try:
+            model = holt_winters.fit_many(np.stack([y for _, _, y in group]))
+            yhat, lower, upper = holt_winters.forecast_many(model, periods)
+        except Exception as e:
+            failures.update({series_id: f"{type(e).__name__}: {e}" for series_id, _, _ in group})
+            continue
+        spread = holt_winters.Z_80 * model["sigma"]
+        for i, (series_id, days, _) in enumerate(group):
+            future = pd.date_range(days[-1] + pd.Timedelta(days=1), periods=periods, freq="D")
+            fitted = model["fitted"][i]
+            forecasts.append(pd.DataFrame({
+                "series_id": series_id,
+                "ds": days.append(future),
+                "yhat": np.concatenate([fitted, yhat[i]]),
+                "yhat_lower": np.concatenate([fitted - spread[i], lower[i]]),
+                "yhat_upper": np.concatenate([fitted + spread[i], upper[i]]),
+            }))
+    return forecasts, failures
+
+
+def forecast_many(data_df, periods=15, workers=None, chunks_per_worker=4, model_dir=None,
+                  backend="prophet"):
+    '''
+    Forecast many series at once.
+
+    :param data_df: long-format Dataframe with series_id, ds and y columns
+    :param periods: days to forecast past the end of each series
+    :param workers: worker processes (default: CPU count); 1 runs in-process
+    :param chunks_per_worker: series are dealt into workers * this many
+        chunks, so each worker is sent a chunk of frames rather than the
+        whole Dataframe once per series, and long series spread evenly
+    :param model_dir: per-series model cache directories go under it
+    :param backend: "holt_winters" fits all series together in this
+        process (workers, chunks_per_worker and model_dir are not used)
+    :return: (forecast Dataframe with series_id, ds, yhat, yhat_lower and
+        yhat_upper columns, {series_id: error message} of failed series)
+    '''
+    workers = workers or os.cpu_count() or 1
+    series = [(series_id, frame[["ds", "y"]].reset_index(drop=True))
+              for series_id, frame in data_df.groupby("series_id", sort=True)]
+    # Longest first, dealt round-robin: every chunk gets a similar amount of work
+    series.sort(key=lambda item: len(item[1]), reverse=True)
+    n_chunks = max(min(len(series), workers * max(int(chunks_per_worker), 1)), 1)
+    chunks = [series[i::n_chunks] for i in range(n_chunks)]
+
+    forecasts, failures = [], {}
+    if backend == "holt_winters":
+        forecasts, failures = _forecast_holt_winters(series, periods)
+    elif backend not in BACKENDS:
+        raise ValueError(f"Unknown forecasting backend: {backend}")
+    elif workers == 1:
+        results = (_forecast_chunk(chunk, periods, model_dir) for chunk in chunks)
+        for chunk_forecasts, chunk_failures in results:
+            forecasts.extend(chunk_forecasts)
+            failures.update(chunk_failures)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_forecast_chunk, chunk, periods, model_dir) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    chunk_forecasts, chunk_failures = future.result()
+                except Exception as e:
+                    # The worker itself died: everything in its chunk failed
+                    chunk_forecasts = []
+                    chunk_failures = {series_id: f"{type(e).__name__}: {e}" for series_id, _ in chunk}
+                forecasts.extend(chunk_forecasts)
+                failures.update(chunk_failures)
+
+    columns = ["series_id", "ds", "yhat", "yhat_lower", "yhat_upper"]
+    if not forecasts:
+        return pd.DataFrame(columns=columns), failures
+    forecast = pd.concat(forecasts, ignore_index=True)[columns]
+    return forecast.sort_values(["series_id", "ds"], ignore_index=True), failures
@@ -1,81 +1,137 @@
-import json
 import os
 import sys
+import time
 
 import pika
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from ml_engine import MLPredictor
+from consumer import DailyAverageConsumer, RecordBuffer
+from forecast_server import COMBINED_SERIES, ForecastCache, ForecastStore, serve
+from ml_engine import MLPredictor, forecast_many
+from ts_store import TimeSeriesStore
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "pm25_daily_avg")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "student")
 RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "student")
+# Unacked messages the broker may push ahead of us (unlimited without a
+# history store, since nothing is acked until the round is done)
+RABBITMQ_PREFETCH = int(os.getenv("RABBITMQ_PREFETCH", "1000"))
+# Messages between commits (0: half the prefetch)
+RABBITMQ_COMMIT_EVERY = int(os.getenv("RABBITMQ_COMMIT_EVERY", "0"))
+# Seconds without a message after which the queue counts as drained
+RABBITMQ_IDLE_TIMEOUT = float(os.getenv("RABBITMQ_IDLE_TIMEOUT", "2"))
+# History store the received windows are added to before they are acked,
+# and trained on; empty: use only what is in the queue, in memory, and ack
+# it once the forecast has been made
+HISTORY_DIR = os.getenv("HISTORY_DIR", "pm25_history")
+# Days of history (before the newest record) to train on; 0: all of it
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "0"))
+# Fitted model cache, see MLPredictor; empty: always fit from scratch
+MODEL_DIR = os.getenv("MODEL_DIR", "pm25_model")
+# "prophet" or "holt_winters" (NumPy, much cheaper for bulk forecasting)
+FORECAST_BACKEND = os.getenv("FORECAST_BACKEND", "prophet")
+# Also forecast every sensor on its own, over FORECAST_WORKERS processes
+# (0: one per CPU)
+FORECAST_PER_SENSOR = os.getenv("FORECAST_PER_SENSOR", "0") == "1"
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", "0"))
+# Where forecasts are kept for the forecast server; empty: not kept
+FORECAST_DIR = os.getenv("FORECAST_DIR", "pm25_forecasts")
+# Serve forecasts over HTTP from this process (long-running mode); 0: don't
+FORECAST_PORT = int(os.getenv("FORECAST_PORT", "0"))
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "256"))
+# Seconds between rounds of collect / retrain / forecast; 0: run once
+RETRAIN_INTERVAL = float(os.getenv("RETRAIN_INTERVAL", "0"))
 
 
 def collect_daily_averages():
     print("Connecting to RabbitMQ...")
     credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    params = pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        virtual_host="/",
+        credentials=credentials,
+    )
+    store = TimeSeriesStore(HISTORY_DIR) if HISTORY_DIR else None
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=RABBITMQ_PORT,
-                virtual_host="/",
-                credentials=credentials,
-            )
+        consumer = DailyAverageConsumer(
+            params,
+            RABBITMQ_QUEUE,
+            prefetch=RABBITMQ_PREFETCH,
+            commit_every=RABBITMQ_COMMIT_EVERY,
+            idle_timeout=RABBITMQ_IDLE_TIMEOUT,
+            buffer=RecordBuffer(store),
         )
     except Exception as e:
         print(f"Could not connect to RabbitMQ: {e}")
         sys.exit(1)
 
-    channel = connection.channel()
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-
-    records = []
-
     print("Collecting messages from RabbitMQ...")
-    while True:
-        method_frame, properties, body = channel.basic_get(
-            queue=RABBITMQ_QUEUE, auto_ack=True
-        )
-        if method_frame is None:
-            # no more messages in queue
-            break
+    buffer = consumer.collect()
+    print(
+        f"Received {consumer.messages} messages, {len(buffer)} records"
+        + (f", {consumer.failed} undecodable" if consumer.failed else "")
+    )
+    if consumer.duplicates:
+        print(f"Dropped {consumer.duplicates} duplicate messages")
 
-        try:
-            msg = json.loads(body.decode("utf-8"))
-        except Exception as e:
-            print(f"Failed to decode message: {e}")
-            continue
+    if store is not None:
+        df = load_history(store)
+    else:
+        # The same window can arrive twice if the preprocessor crashed between
+        # handing it on and recording that; frame() keeps the last copy
+        df = buffer.frame()
+        if len(df) < len(buffer):
+            print(f"Dropped {len(buffer) - len(df)} duplicate records")
 
-        records.append(msg)
+    if df.empty:
+        return consumer, df
 
-    connection.close()
+    print("Raw averaged daily PM2.5 data (head):")
+    print(df.head())
 
-    if not records:
-        print("No messages found in queue. Exiting.")
-        sys.exit(0)
+    return consumer, df
 
-    print("Raw averaged daily PM2.5 data:")
-    for r in records:
-        print(r)
 
-    return records
+def load_history(store):
+    """The HISTORY_DAYS up to the newest stored record (all with 0)."""
+    span = store.span()
+    if span is None:
+        return store.frame()
+    start = span[1] - HISTORY_DAYS * 86400 if HISTORY_DAYS else None
+    started = time.perf_counter()
+    df = store.frame(start=start)
+    print(
+        f"Loaded {len(df)} records of {len(store.sensors)} sensors from {store.root} "
+        f"in {(time.perf_counter() - started) * 1000:.1f} ms"
+    )
+    return df
 
 
 def build_dataframe(records):
-    df = pd.DataFrame(records)
+    df = records if isinstance(records, pd.DataFrame) else pd.DataFrame(records)
+
+    # Per-sensor windows from the preprocessor: combine them into one series,
+    # weighting each sensor's average by its reading count
+    if "Sensor" in df.columns:
+        weights = df["Count"] if "Count" in df.columns else pd.Series(1, index=df.index)
+        df = (
+            df.assign(_weighted=df["Value"] * weights, _weight=weights)
+            .groupby("Timestamp", as_index=False)[["_weighted", "_weight"]]
+            .sum()
+        )
+        df["Value"] = df["_weighted"] / df["_weight"]
+        df = df[["Timestamp", "Value"]]
+    df = df.sort_values("Timestamp", ignore_index=True)
 
     df["Timestamp"] = pd.to_datetime(df["Timestamp"], unit="s", utc=True)
     df["Timestamp"] = df["Timestamp"].dt.tz_localize(None)
 
-    print("Averaged daily PM2.5 data:")
-    for _, row in df.iterrows():
-        ts_str = row["Timestamp"].strftime("%Y-%m-%d %H:%M:%S")
-        print(f"{ts_str} -> {row['Value']:.2f}")
+    print(f"Averaged daily PM2.5 data: {len(df)} days")
+    print(df.head())
     return df
 
 def plot_daily_averages(df):
@@ -93,26 +149,120 @@ def plot_daily_averages(df):
     plt.close()
 
 
-def run_ml_prediction(df):
+def save_forecasts(serving, forecasts):
+    """Keep {series_id: forecast} for the server; drop retrained series from its cache."""
+    if serving is None:
+        return
+    changed = serving["store"].save(forecasts)
+    if serving["cache"] is not None and changed:
+        serving["cache"].refresh()
+    if changed:
+        print(f"Updated stored forecasts of {len(changed)} series")
+
+
+def run_ml_prediction(df, fit_stats=None, serving=None):
     forecast_output_path="pm25_forecast.png"
     pm25_df = df.copy()
-    predictor = MLPredictor(pm25_df)
-    predictor.train()
+    predictor = MLPredictor(pm25_df, model_dir=MODEL_DIR or None, backend=FORECAST_BACKEND)
+    try:
+        predictor.train()
+    except ValueError as e:
+        if FORECAST_BACKEND != "holt_winters":
+            raise
+        # Under two seasons of history; Prophet can fit a short series
+        print(f"Holt-Winters cannot fit the combined series ({e}); using Prophet this round")
+        predictor = MLPredictor(pm25_df, model_dir=MODEL_DIR or None, backend="prophet")
+        predictor.train()
+    if fit_stats is not None:
+        fit_stats[predictor.fit_mode] = fit_stats.get(predictor.fit_mode, 0) + 1
+        fit_stats["seconds"] = fit_stats.get("seconds", 0.0) + predictor.fit_seconds
     forecast = predictor.predict()
 
     print("Forecast head:")
     print(forecast[["ds", "yhat"]].head())
+    save_forecasts(serving, {COMBINED_SERIES: forecast})
 
     print(f"Plotting forecast and saving to {forecast_output_path} ...")
     fig = predictor.plot_result(forecast)
     fig.savefig(forecast_output_path)
+    plt.close(fig)
 
 
-def main():
-    records = collect_daily_averages()
+def run_sensor_forecasts(records, serving=None):
+    output_path = "pm25_forecast_by_sensor.csv"
+    if "Sensor" not in records.columns:
+        print("Records carry no sensor ids; skipping per-sensor forecasts")
+        return
+    long_df = pd.DataFrame({
+        "series_id": records["Sensor"].astype(str),
+        "ds": pd.to_datetime(records["Timestamp"], unit="s"),
+        "y": records["Value"],
+    })
+    started = time.perf_counter()
+    forecast, failures = forecast_many(
+        long_df,
+        workers=FORECAST_WORKERS or None,
+        model_dir=os.path.join(MODEL_DIR, "sensors") if MODEL_DIR else None,
+        backend=FORECAST_BACKEND,
+    )
+    n_series = long_df["series_id"].nunique()
+    print(
+        f"Forecast {n_series - len(failures)} of {n_series} sensors "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    for series_id, error in sorted(failures.items()):
+        print(f"  {series_id}: {error}")
+    print(f"Saving per-sensor forecasts to {output_path}")
+    forecast.to_csv(output_path, index=False)
+    if (forecast["series_id"] == COMBINED_SERIES).any():
+        # It would overwrite (or be overwritten by) the combined forecast
+        print(f"Not serving sensor {COMBINED_SERIES!r}: the name is reserved for the combined series")
+    save_forecasts(serving, {
+        series_id: frame for series_id, frame in forecast.groupby("series_id", sort=False)
+        if series_id != COMBINED_SERIES
+    })
+
+
+def run_round(fit_stats, serving=None):
+    """One collect / train / forecast round; False if there was no data."""
+    consumer, records = collect_daily_averages()
+    if records.empty:
+        consumer.close()
+        print("No messages found in queue.")
+        return False
     df = build_dataframe(records)
     plot_daily_averages(df)
-    run_ml_prediction(df)
+    run_ml_prediction(df, fit_stats, serving)
+    if FORECAST_PER_SENSOR:
+        run_sensor_forecasts(records, serving)
+    # Everything received has now been used (or stored): let the broker drop it
+    consumer.commit()
+    consumer.close()
+    return True
+
+
+def main():
+    fit_stats = {}
+    serving = None
+    if FORECAST_DIR:
+        store = ForecastStore(FORECAST_DIR)
+        serving = {"store": store, "cache": None}
+        if FORECAST_PORT and RETRAIN_INTERVAL:
+            # We invalidate the cache ourselves, no need to poll the index
+            serving["cache"] = ForecastCache(store, FORECAST_CACHE_SIZE)
+            serve(serving["cache"], port=FORECAST_PORT, refresh=0)
+    while True:
+        if not run_round(fit_stats, serving) and not RETRAIN_INTERVAL:
+            print("Exiting.")
+            sys.exit(0)
+        if not RETRAIN_INTERVAL:
+            break
+        print(
+            "Fits so far: "
+            + ", ".join(f"{fit_stats.get(mode, 0)} {mode}" for mode in ("cold", "warm", "skipped"))
+            + f"; {fit_stats.get('seconds', 0.0):.1f}s fitting in total"
+        )
+        time.sleep(RETRAIN_INTERVAL)
     print("Task 3 ML pipeline complete.")
 
 
@@ -0,0 +1,232 @@
+'''
+    Local history of the window records the predictor has received.
+
+    The queue only holds what arrived since the last run, so every record
+    is also kept here and forecasts train on the full history. Records are
+    stored as raw fixed-width rows (PARTITION_DTYPE), one file per sensor
+    and calendar month, sorted by Timestamp:
+
+        <root>/<sensor>/<YYYY-MM>.<generation>.bin
+        <root>/index.json
+
+    index.json lists every partition with its file, row count and min/max
+    Timestamp. A range read only opens the partitions whose span overlaps
+    the range, memory-maps them and cuts the range out with a binary
+    search, so loading years of history costs a few page faults rather
+    than a re-parse of every record.
+
+    The index is the commit point: rows appended past the count recorded
+    in it (a crash mid-append) are ignored and cut off on the next append,
+    and a partition that has to be rewritten (records arriving out of
+    order, or redelivered) goes to a new generation file that the index
+    only points to once it is complete.
+'''
+
+import json
+import os
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from consumer import RECORD_DTYPE
+
+INDEX_VERSION = 1
+# RECORD_DTYPE without the sensor code: the sensor is the partition
+PARTITION_DTYPE = np.dtype([(name, RECORD_DTYPE.fields[name][0])
+                            for name in RECORD_DTYPE.names if name != "Sensor"])
+
+
+def _fsync_dir(path):
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def _month(ts):
+    """'YYYY-MM' for each epoch-second timestamp."""
+    return np.asarray(ts, dtype="<i8").astype("datetime64[s]").astype("datetime64[M]").astype(str)
+
+
+def _dedupe_sorted(rows):
+    """Sort by Timestamp, keeping the last of rows with equal Timestamps."""
+    if len(rows) < 2:
+        return rows
+    reversed_rows = rows[::-1]
+    _, first = np.unique(reversed_rows["Timestamp"], return_index=True)
+    return reversed_rows[first]
+
+
+class TimeSeriesStore(object):
+    '''
+    Sensor/month partitioned record history.
+
+    `append(rows, sensors)` takes RECORD_DTYPE rows (as kept by
+    RecordBuffer, with `sensors` resolving their codes) and upserts them by
+    (Sensor, Timestamp). `read()` / `frame()` return the records in a
+    Timestamp range; a range within one partition is returned as a
+    read-only view of the memory-mapped file, without a copy.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._index_path = os.path.join(root, "index.json")
+        self.partitions = self._load_index()
+        self._superseded = []
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported history index version {index.get('version')}")
+        return index["partitions"]
+
+    def _save_index(self):
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "partitions": self.partitions}, f,
+                      separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+        _fsync_dir(self.root)
+
+    def _sensor_dir(self, sensor):
+        return os.path.join(self.root, quote(sensor, safe="") or "_")
+
+    def _path(self, sensor, entry):
+        return os.path.join(self._sensor_dir(sensor), entry["file"])
+
+    def __len__(self):
+        return sum(entry["rows"] for months in self.partitions.values() for entry in months.values())
+
+    @property
+    def sensors(self):
+        return sorted(self.partitions)
+
+    def span(self):
+        """(first, last) Timestamp stored, or None if the store is empty."""
+        entries = [e for months in self.partitions.values() for e in months.values()]
+        if not entries:
+            return None
+        return min(e["min"] for e in entries), max(e["max"] for e in entries)
+
+    def append(self, rows, sensors):
+        """Durably upsert RECORD_DTYPE `rows`; returns once the index is updated."""
+        if not len(rows):
+            return
+        months = _month(rows["Timestamp"])
+        codes = rows["Sensor"]
+        for code in np.unique(codes):
+            sensor = sensors[code]
+            of_sensor = codes == code
+            for month in np.unique(months[of_sensor]):
+                part = rows[of_sensor & (months == month)]
+                new = np.empty(len(part), dtype=PARTITION_DTYPE)
+                for name in PARTITION_DTYPE.names:
+                    new[name] = part[name]
+                self._write_partition(sensor, str(month), _dedupe_sorted(new))
+        self._save_index()
+        # Rewritten partitions are no longer referenced by the index
+        for path in self._superseded:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._superseded = []
+
+    def _write_partition(self, sensor, month, new):
+        months = self.partitions.setdefault(sensor, {})
+        entry = months.get(month)
+        os.makedirs(self._sensor_dir(sensor), exist_ok=True)
+
+        if entry is None or new["Timestamp"][0] > entry["max"]:
+            # In order: append to the partition file
+            if entry is None:
+                entry = {"file": f"{month}.0.bin", "rows": 0}
+            with open(self._path(sensor, entry), "ab") as f:
+                # Drop rows a crashed append left past the committed count
+                f.truncate(entry["rows"] * PARTITION_DTYPE.itemsize)
+                new.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            months[month] = {
+                "file": entry["file"],
+                "rows": entry["rows"] + len(new),
+                "min": int(new["Timestamp"][0]) if not entry["rows"] else entry["min"],
+                "max": int(new["Timestamp"][-1]),
+            }
+            _fsync_dir(self._sensor_dir(sensor))
+            return
+
+        # Out of order or redelivered: merge into a new generation of the file
+        old = np.fromfile(self._path(sensor, entry), dtype=PARTITION_DTYPE, count=entry["rows"])
+        merged = _dedupe_sorted(np.concatenate([old, new]))
+        generation = int(entry["file"].split(".")[1]) + 1
+        rewritten = {
+            "file": f"{month}.{generation}.bin",
+            "rows": len(merged),
+            "min": int(merged["Timestamp"][0]),
+            "max": int(merged["Timestamp"][-1]),
+        }
+        with open(self._path(sensor, rewritten), "wb") as f:
+            merged.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_dir(self._sensor_dir(sensor))
+        months[month] = rewritten
+        self._superseded.append(self._path(sensor, entry))
+
+    def _parts(self, start, end, sensors):
+        names = self.sensors if sensors is None else [s for s in sensors if s in self.partitions]
+        for sensor in names:
+            for month in sorted(self.partitions[sensor]):
+                entry = self.partitions[sensor][month]
+                if not entry["rows"]:
+                    continue
+                if (start is not None and entry["max"] < start) or (end is not None and entry["min"] > end):
+                    continue
+                rows = np.memmap(self._path(sensor, entry), dtype=PARTITION_DTYPE, mode="r",
+                                 shape=(entry["rows"],))
+                ts = rows["Timestamp"]
+                lo = 0 if start is None else np.searchsorted(ts, start, side="left")
+                hi = len(rows) if end is None else np.searchsorted(ts, end, side="right")
+                if hi > lo:
+                    yield sensor, rows[lo:hi]
+
+    def read(self, start=None, end=None, sensors=None):
+        """
+        Records with start <= Timestamp <= end (inclusive; None: open) as
+        (sensor names, list of PARTITION_DTYPE arrays), one array per
+        partition in sensor then time order. The arrays are views of the
+        memory-mapped files.
+        """
+        names, arrays = [], []
+        for sensor, rows in self._parts(start, end, sensors):
+            names.append(sensor)
+            arrays.append(rows)
+        return names, arrays
+
+    def frame(self, start=None, end=None, sensors=None):
+        """The same records as one DataFrame with a categorical Sensor column."""
+        names, arrays = self.read(start, end, sensors)
+        if not arrays:
+            return pd.DataFrame({name: np.empty(0, dtype=PARTITION_DTYPE.fields[name][0])
+                                 for name in PARTITION_DTYPE.names}).assign(Sensor=pd.Categorical([]))
+        rows = arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+        df = pd.DataFrame({name: rows[name] for name in PARTITION_DTYPE.names}, copy=False)
+        categories = sorted(set(names))
+        codes = np.repeat([categories.index(n) for n in names], [len(a) for a in arrays])
+        df["Sensor"] = pd.Categorical.from_codes(codes, categories=categories)
+        return df
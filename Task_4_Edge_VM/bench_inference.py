@@ -0,0 +1,130 @@
+'''
+    Benchmark: per-reading TFLite inference vs micro-batched inference.
+
+    Feeds the same synthetic readings through on_message() as one JSON
+    message per reading, first with the per-reading path (one invoke()
+    per reading) and then through InferenceBatcher at several batch
+    sizes. If pm25_thresholds.json is there (derive_thresholds.py), the
+    threshold fast path runs too, per reading and batched. Reports
+    readings/s, p50/p99 latency per reading (arrival to label) and checks
+    that every path assigns the same labels.
+
+    With a rate (readings/s) the messages are paced instead of sent as
+    fast as possible, which shows the INFER_MAX_DELAY_MS latency cap at
+    work when batches do not fill up.
+
+    Usage: python bench_inference.py [readings] [max delay ms] [rate] [batch sizes...]
+'''
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pm25_inference
+
+
+class Message(object):
+    def __init__(self, payload):
+        self.topic = pm25_inference.MQTT_TOPIC
+        self.payload = payload
+
+
+class NullClient(object):
+    def publish(self, topic, payload, retain=False):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def make_messages(n, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.clip(rng.gamma(2.0, 4.5, n), 0, None)
+    start = 1_600_000_000_000
+    return [
+        Message(json.dumps({"Timestamp": start + i * 60_000, "Value": round(float(v), 2)}).encode("utf-8"))
+        for i, v in enumerate(values)
+    ]
+
+
+def new_userdata(batch_size, max_delay, thresholds):
+    if thresholds is None:
+        interpreter, input_details, output_details = pm25_inference.load_tflite_model(batch_size)
+    else:
+        interpreter = input_details = output_details = None
+    userdata = {
+        "interpreter": interpreter,
+        "input_details": input_details,
+        "output_details": output_details,
+        "thresholds": thresholds,
+        "batch_size": batch_size,
+        "results": pm25_inference.InferenceResults(plot_cap=0),
+        "batcher": None,
+    }
+    if batch_size > 1:
+        userdata["batcher"] = pm25_inference.InferenceBatcher(userdata, batch_size, max_delay).start()
+    return userdata
+
+
+def run(messages, batch_size, max_delay, rate, thresholds=None):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        userdata = new_userdata(batch_size, max_delay, thresholds)
+    client = NullClient()
+    latencies = []
+    interval = 1.0 / rate if rate else 0.0
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for i, msg in enumerate(messages):
+            if interval:
+                # Busy-wait: sleep() is far too coarse at these rates
+                due = started + i * interval
+                while time.perf_counter() < due:
+                    pass
+            arrived = time.perf_counter()
+            pm25_inference.on_message(client, userdata, msg)
+            if batch_size == 1:
+                latencies.append(time.perf_counter() - arrived)
+        batcher = userdata["batcher"]
+        if batcher is not None:
+            batcher.close()
+            latencies = batcher.latencies
+        elapsed = time.perf_counter() - started
+    return elapsed, np.array(latencies) * 1000, userdata["results"].columns()[2]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    max_delay = (float(sys.argv[2]) if len(sys.argv) > 2 else 20.0) / 1000.0
+    rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    sizes = [int(a) for a in sys.argv[4:]] or [8, 64, 256]
+
+    messages = make_messages(n)
+    print(
+        f"{n} readings, max delay {max_delay * 1000:.0f} ms, "
+        + (f"paced at {rate:,.0f} readings/s" if rate else "unpaced")
+        + f", {os.cpu_count()} CPUs"
+    )
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        thresholds = pm25_inference.load_thresholds()
+    runs = [("model", size, None) for size in [1] + sizes]
+    if thresholds is not None:
+        runs += [("thresholds", size, thresholds) for size in (1, max(sizes))]
+    print(f"{'classifier':>11}{'batch':>7}{'readings/s':>12}{'p50 ms':>9}{'p99 ms':>9}  same labels")
+    baseline = None
+    for classifier, batch_size, run_thresholds in runs:
+        elapsed, latencies, codes = run(messages, batch_size, max_delay, rate, run_thresholds)
+        if baseline is None:
+            baseline = codes
+        print(
+            f"{classifier:>11}{batch_size:>7}{n / elapsed:>12,.0f}{np.percentile(latencies, 50):>9.3f}"
+            f"{np.percentile(latencies, 99):>9.3f}  {np.array_equal(codes, baseline)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+'''
+    Benchmark: start-up cost of the inference service.
+
+    Each configuration runs in a fresh child process that imports
+    pm25_inference, loads its classifier and classifies one reading,
+    like the service does before the first message is handled. Reported:
+    module import time, time from process start to the first label, and
+    the child's peak RSS. A final column adds the deferred matplotlib
+    import and the two end-of-run charts.
+
+    Configurations that need a package which is not installed are
+    reported as skipped.
+
+    Usage: python bench_startup.py
+'''
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+CONFIGS = [
+    # (name, TFLITE_RUNTIME, CLASSIFIER)
+    ("tflite_runtime", "tflite_runtime", "model"),
+    ("tensorflow", "tensorflow", "model"),
+    ("thresholds", "auto", "auto"),
+]
+
+CHILD = r"""
+import json, os, resource, sys, tempfile, time
+started = time.perf_counter()
+import pm25_inference
+imported = time.perf_counter()
+userdata = {"interpreter": None, "input_details": None, "output_details": None,
+            "thresholds": None, "batch_size": 1,
+            "results": pm25_inference.InferenceResults()}
+if pm25_inference.CLASSIFIER == "auto":
+    userdata["thresholds"] = pm25_inference.load_thresholds()
+    if userdata["thresholds"] is None:
+        raise SystemExit("no usable pm25_thresholds.json")
+pm25_inference.classify_reading(userdata, 1600000000, 12.5)
+first = time.perf_counter()
+rss_first = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+os.chdir(tempfile.mkdtemp())
+pm25_inference.make_plots_and_summary(userdata)
+plotted = time.perf_counter()
+print(json.dumps({
+    "import": imported - started, "first": first - started, "plots": plotted - first,
+    "runtime": type(userdata["interpreter"]).__module__ if userdata["interpreter"] is not None else "-",
+    "rss_first": rss_first / 1024, "rss_plots": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def run(runtime, classifier):
+    env = dict(os.environ, TFLITE_RUNTIME=runtime, CLASSIFIER=classifier)
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD], env=env, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        last = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+        return None, last
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["wall"] = wall
+    return result, None
+
+
+def main():
+    print(f"{'config':>15}{'import ms':>11}{'1st label ms':>14}{'process s':>11}"
+          f"{'peak MB':>9}{'+plots ms':>11}{'+plots MB':>11}")
+    for name, runtime, classifier in CONFIGS:
+        result, error = run(runtime, classifier)
+        if result is None:
+            print(f"{name:>15}  skipped: {error}")
+            continue
+        print(
+            f"{name:>15}{result['import'] * 1000:>11.0f}{result['first'] * 1000:>14.0f}"
+            f"{result['wall']:>11.2f}{result['rss_first']:>9.0f}"
+            f"{result['plots'] * 1000:>11.0f}{result['rss_plots']:>11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+'''
+    Derive the class thresholds of the scalar PM2.5 model.
+
+    The model maps one standardized PM2.5 value to GREEN / RED / YELLOW,
+    so its decision function is a handful of intervals on a line. This
+    tool scans the model over the standardized image of a feasible PM2.5
+    range, bisects every class change down to adjacent float32 inputs
+    and writes the boundaries to a JSON file that pm25_inference uses to
+    classify with one np.searchsorted instead of an interpreter call.
+
+    The result is then checked against the interpreter, and nothing is
+    written unless they agree on all of:
+        - every reading with two decimals in the range (the injector's
+          precision), through the same standardization as the service
+        - the 4096 float32 inputs on either side of each boundary
+        - a dense grid and random float32 inputs over the whole range
+
+    Usage: python derive_thresholds.py [value min] [value max] [output]
+'''
+
+import hashlib
+import json
+import sys
+
+import numpy as np
+
+import pm25_inference
+
+SCAN_POINTS = 1 << 21
+CHUNK = 1 << 16
+NEIGHBOURS = 4096
+
+
+class ModelLabels(object):
+    '''Class indices from the interpreter for any number of float32 inputs.'''
+
+    def __init__(self):
+        self.interpreter, inputs, outputs = pm25_inference.load_tflite_model(CHUNK)
+        self.input_detail = inputs[0]
+        self.output_index = outputs[0]["index"]
+        self._input = np.zeros((CHUNK, 1), dtype=self.input_detail["dtype"])
+        self.calls = 0
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32).ravel()
+        result = np.empty(len(x), dtype=np.int64)
+        for start in range(0, len(x), CHUNK):
+            part = x[start:start + CHUNK]
+            self._input[:len(part), 0] = pm25_inference.model_input(part, self.input_detail)
+            self._input[len(part):] = 0
+            self.interpreter.set_tensor(self.input_detail["index"], self._input)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output_index)
+            result[start:start + len(part)] = np.argmax(output[:len(part)], axis=1)
+            self.calls += 1
+        return result
+
+
+def standardized(values):
+    """The float32 model inputs pm25_inference feeds for raw `values`."""
+    return pm25_inference.standardize_value(np.asarray(values, dtype=np.float64)).astype(np.float32)
+
+
+def next_up(x):
+    return np.nextafter(np.float32(x), np.float32(np.inf), dtype=np.float32)
+
+
+def bisect_boundary(model, lo, hi):
+    """Smallest float32 in (lo, hi] whose class differs from lo's."""
+    lo, hi = np.float32(lo), np.float32(hi)
+    lo_class = model([lo])[0]
+    while next_up(lo) < hi:
+        mid = np.float32((np.float64(lo) + np.float64(hi)) / 2)
+        if mid <= lo or mid >= hi:
+            mid = next_up(lo)
+        if model([mid])[0] == lo_class:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def derive(model, x_min, x_max):
+    grid = np.linspace(x_min, x_max, SCAN_POINTS, dtype=np.float64).astype(np.float32)
+    grid = np.unique(grid)
+    classes = model(grid)
+    changes = np.flatnonzero(classes[1:] != classes[:-1])
+    bounds = []
+    for i in changes:
+        # Bisection also catches a narrow class between two grid points if
+        # the class at the left end still differs from the right end
+        lo = grid[i]
+        while True:
+            boundary = bisect_boundary(model, lo, grid[i + 1])
+            bounds.append(boundary)
+            if model([boundary])[0] == classes[i + 1]:
+                break
+            lo = boundary
+    labels = [int(classes[0])] + [int(model([b])[0]) for b in bounds]
+    return np.array(bounds, dtype=np.float32), labels
+
+
+def lookup(bounds, labels, x):
+    return np.asarray(labels)[np.searchsorted(bounds, x, side="right")]
+
+
+def verify(model, bounds, labels, value_min, value_max, x_min, x_max):
+    """Inputs checked; raises if the thresholds disagree with the model anywhere."""
+    rng = np.random.default_rng(0)
+    values = np.round(np.arange(round(value_min * 100), round(value_max * 100) + 1) / 100.0, 2)
+    around = []
+    for b in bounds:
+        below = [b]
+        above = [b]
+        for _ in range(NEIGHBOURS):
+            below.append(np.nextafter(below[-1], np.float32(-np.inf), dtype=np.float32))
+            above.append(next_up(above[-1]))
+        around.extend(below + above)
+    checks = [
+        ("two-decimal readings", standardized(values)),
+        ("around boundaries", np.array(around, dtype=np.float32)),
+        ("dense grid", np.linspace(x_min, x_max, 4 * SCAN_POINTS + 7).astype(np.float32)),
+        ("random", rng.uniform(x_min, x_max, SCAN_POINTS).astype(np.float32)),
+    ]
+    total = 0
+    for name, x in checks:
+        x = x[(x >= x_min) & (x <= x_max)]
+        expected = model(x)
+        got = lookup(bounds, labels, x)
+        mismatches = np.flatnonzero(expected != got)
+        if len(mismatches):
+            first = x[mismatches[0]]
+            raise SystemExit(
+                f"{name}: {len(mismatches)} of {len(x)} inputs disagree, first at x={first!r} "
+                f"(model {expected[mismatches[0]]}, thresholds {got[mismatches[0]]})"
+            )
+        print(f"  {name}: {len(x)} inputs agree")
+        total += len(x)
+    return total
+
+
+def main():
+    value_min = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    value_max = float(sys.argv[2]) if len(sys.argv) > 2 else 1000.0
+    output = sys.argv[3] if len(sys.argv) > 3 else pm25_inference.THRESHOLDS_PATH
+
+    model = ModelLabels()
+    x_min, x_max = standardized([value_min, value_max])
+    bounds, labels = derive(model, x_min, x_max)
+    names = pm25_inference.LABEL_CLASSES[labels].tolist()
+    print(f"PM2.5 {value_min}..{value_max} -> model inputs {x_min!r}..{x_max!r}")
+    for b, before, after in zip(bounds, names, names[1:]):
+        value = float(b) * pm25_inference.SCALER_SCALE + pm25_inference.SCALER_MEAN
+        print(f"  {before} -> {after} at input {b!r} (PM2.5 ~ {value:.4f})")
+
+    checked = verify(model, bounds, labels, value_min, value_max, x_min, x_max)
+    with open(pm25_inference.TFLITE_MODEL_PATH, "rb") as f:
+        model_sha256 = hashlib.sha256(f.read()).hexdigest()
+    thresholds = {
+        "model_sha256": model_sha256,
+        "scaler_mean": pm25_inference.SCALER_MEAN,
+        "scaler_scale": pm25_inference.SCALER_SCALE,
+        # Inputs are float32; these round-trip exactly through JSON
+        "input_min": float(x_min),
+        "input_max": float(x_max),
+        "bounds": [float(b) for b in bounds],
+        "labels": names,
+        "checked_inputs": checked,
+    }
+    with open(output, "w") as f:
+        json.dump(thresholds, f, indent=2)
+    print(f"Wrote {len(bounds)} thresholds to {output} ({checked} inputs checked, {model.calls} invokes)")
+
+
+if __name__ == "__main__":
+    main()
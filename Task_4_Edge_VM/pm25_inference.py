@@ -1,20 +1,60 @@
+import hashlib
 import json
 import os
 import sys
+import threading
+import time
+from bisect import bisect_right
 from datetime import datetime, timezone
 
 import numpy as np
-import matplotlib.pyplot as plt
 import paho.mqtt.client as mqtt
-import tensorflow as tf
 
 MQTT_BROKER = os.getenv("MQTT_BROKER", "emqx")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "uo/pm25")
 
 TFLITE_MODEL_PATH = os.getenv("TFLITE_MODEL_PATH", "pm25_model.tflite")
+# Where the interpreter comes from: "auto" prefers the small tflite_runtime
+# package and falls back to full TensorFlow; "tflite_runtime" or
+# "tensorflow" insist on one
+TFLITE_RUNTIME = os.getenv("TFLITE_RUNTIME", "auto")
+
+# Class boundaries derived from the model by derive_thresholds.py. With
+# CLASSIFIER=auto they are used when the file matches the model, and the
+# interpreter is only loaded for readings outside the range they cover;
+# "model" always runs the interpreter
+THRESHOLDS_PATH = os.getenv("THRESHOLDS_PATH", "pm25_thresholds.json")
+CLASSIFIER = os.getenv("CLASSIFIER", "auto")
+
+# Readings classified per interpreter invoke(); 1 classifies every reading
+# on its own as it arrives
+INFER_BATCH_SIZE = int(os.getenv("INFER_BATCH_SIZE", "64"))
+# Latency cap: a partial batch is classified once its oldest reading has
+# waited this long
+INFER_MAX_DELAY_MS = float(os.getenv("INFER_MAX_DELAY_MS", "20"))
+
+# Points kept for the time-series plot: beyond this a uniform random sample
+# (reservoir) of the readings is plotted, so memory stays bounded however
+# long the run. The class counts always cover every reading. 0 keeps all
+RESULTS_PLOT_CAP = int(os.getenv("RESULTS_PLOT_CAP", "100000"))
+
+# Wire formats we accept; advertised (retained) under MQTT_CAPS_TOPIC so the
+# injector can switch to binary batches. JSON is always understood.
+MQTT_CLIENT_ID = "PM25_Inference"
+MQTT_CAPS_TOPIC = os.getenv("MQTT_CAPS_TOPIC", "uo/caps")
+SUPPORTED_FORMATS = ["pm25-batch/2", "pm25-batch/1", "json"]
+
+# Version 2 batches put a sensor ID (length at bytes 8-9) between the
+# header and the records; classification does not need it
+WIRE_MAGIC = b"PM25"
+WIRE_VERSION = 2
+WIRE_HEADER_SIZE = 10
+WIRE_HEADER_SIZE_V1 = 8
+WIRE_DTYPE = np.dtype([("Timestamp", "<i8"), ("Value", "<f4")])
 
 LABEL_CLASSES = np.array(["GREEN", "RED", "YELLOW"])
+LABEL_COLOURS = np.array(["green", "red", "gold"])
 SCALER_MEAN = 8.73966472
 SCALER_SCALE = 6.06153744
 
@@ -22,101 +62,456 @@ def standardize_value(value: float) -> float:
     return (value - SCALER_MEAN) / SCALER_SCALE
 
 
-def load_tflite_model():
-    interpreter = tf.lite.Interpreter(model_path=TFLITE_MODEL_PATH)
+def interpreter_class(runtime=TFLITE_RUNTIME):
+    """The TFLite Interpreter class; imported on first use only."""
+    if runtime in ("auto", "tflite_runtime"):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+            return Interpreter
+        except ImportError:
+            if runtime == "tflite_runtime":
+                raise
+    import tensorflow as tf
+
+    return tf.lite.Interpreter
+
+
+def load_tflite_model(batch_size=1, verbose=True):
+    interpreter = interpreter_class()(model_path=TFLITE_MODEL_PATH)
+    if batch_size > 1:
+        # The model's batch dimension is dynamic (-1): size it once for a
+        # whole batch, partial batches are padded
+        interpreter.resize_tensor_input(
+            interpreter.get_input_details()[0]["index"], [batch_size, 1]
+        )
     interpreter.allocate_tensors()
 
     input_details = interpreter.get_input_details()
     output_details = interpreter.get_output_details()
 
-    print("Loaded TFLite model:")
-    print("  Input:", input_details)
-    print("  Output:", output_details)
+    if verbose:
+        print(f"Loaded TFLite model ({type(interpreter).__module__}):")
+        print("  Input:", input_details)
+        print("  Output:", output_details)
 
     return interpreter, input_details, output_details
 
 
+def load_thresholds(path=THRESHOLDS_PATH):
+    """
+    The thresholds from derive_thresholds.py, or None if there are none
+    or they were derived for another model or scaler.
+    """
+    try:
+        with open(path) as f:
+            thresholds = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable thresholds {path}: {e}")
+        return None
+
+    try:
+        with open(TFLITE_MODEL_PATH, "rb") as f:
+            model_sha256 = hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        model_sha256 = thresholds["model_sha256"]  # model not shipped: trust the file
+    if (
+        thresholds["model_sha256"] != model_sha256
+        or thresholds["scaler_mean"] != SCALER_MEAN
+        or thresholds["scaler_scale"] != SCALER_SCALE
+    ):
+        print(f"Ignoring {path}: derived for a different model or scaler")
+        return None
+
+    label_index = {name: i for i, name in enumerate(LABEL_CLASSES)}
+    print(f"Classifying with {len(thresholds['bounds'])} thresholds from {path}")
+    return {
+        "bounds": np.array(thresholds["bounds"], dtype=np.float32),
+        "bounds_list": [float(b) for b in thresholds["bounds"]],
+        "labels": np.array([label_index[name] for name in thresholds["labels"]]),
+        "min": np.float32(thresholds["input_min"]),
+        "max": np.float32(thresholds["input_max"]),
+    }
+
+
+def model_input(x, input_detail):
+    """Float32 inputs `x` as the model's input type (quantized for a full-int8 model)."""
+    dtype = input_detail["dtype"]
+    if dtype == np.float32:
+        return x
+    scale, zero_point = input_detail["quantization"]
+    info = np.iinfo(dtype)
+    return np.clip(np.round(x / scale) + zero_point, info.min, info.max).astype(dtype)
+
+
+def sized_interpreter(userdata, n):
+    '''
+    (interpreter, input detail, output index, input buffer) for a chunk of
+    `n` readings: the smallest power-of-two batch >= n, capped at the
+    batch size, so a partial batch or a single fallback reading is padded
+    to at most twice its size rather than to a full batch. Interpreters
+    are created on first use and kept in userdata["interpreters"].
+    '''
+    if userdata["interpreter"] is None:
+        # Fast path in use, but a reading fell outside its range
+        interpreter, input_details, output_details = load_tflite_model(userdata["batch_size"])
+        userdata.update(interpreter=interpreter, input_details=input_details,
+                        output_details=output_details)
+    full = int(userdata["input_details"][0]["shape"][0])
+    size = min(1 << (n - 1).bit_length(), full)
+    interpreters = userdata.setdefault("interpreters", {})
+    sized = interpreters.get(size)
+    if sized is None:
+        if size == full:
+            interpreter = userdata["interpreter"]
+            input_details, output_details = userdata["input_details"], userdata["output_details"]
+        else:
+            interpreter, input_details, output_details = load_tflite_model(size, verbose=False)
+        input_detail = input_details[0]
+        sized = interpreters[size] = (
+            interpreter, input_detail, output_details[0]["index"],
+            np.zeros((size, 1), dtype=input_detail["dtype"]),
+        )
+    return sized
+
+
+def model_label_indices(userdata, x):
+    """Class indices from the interpreter for float32 inputs `x`, in chunks of its batch size."""
+    full = userdata["batch_size"] if userdata["interpreter"] is None else \
+        int(userdata["input_details"][0]["shape"][0])
+    result = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), full):
+        part = x[start:start + full]
+        interpreter, input_detail, output_index, input_data = sized_interpreter(userdata, len(part))
+        input_data[:len(part), 0] = model_input(part, input_detail)
+        input_data[len(part):] = 0
+        interpreter.set_tensor(input_detail["index"], input_data)
+        interpreter.invoke()
+        output_data = interpreter.get_tensor(output_index)
+        result[start:start + len(part)] = np.argmax(output_data[:len(part)], axis=1)
+    return result
+
+
+def predict_code(userdata, value):
+    """Class index (into LABEL_CLASSES) for one raw PM2.5 value, without the array overhead."""
+    x = float(np.float32(standardize_value(value)))
+    thresholds = userdata.get("thresholds")
+    if thresholds is not None and thresholds["min"] <= x <= thresholds["max"]:
+        return int(thresholds["labels"][bisect_right(thresholds["bounds_list"], x)])
+    return int(model_label_indices(userdata, np.array([x], dtype=np.float32))[0])
+
+
+def predict_codes(userdata, values):
+    """Class indices (uint8, into LABEL_CLASSES) for raw PM2.5 `values`."""
+    x = standardize_value(np.asarray(values, dtype=np.float64)).astype(np.float32)
+    thresholds = userdata.get("thresholds")
+    if thresholds is None:
+        return model_label_indices(userdata, x).astype(np.uint8)
+
+    indices = thresholds["labels"][np.searchsorted(thresholds["bounds"], x, side="right")]
+    # Also catches NaN, which compares false both ways
+    outside = ~((x >= thresholds["min"]) & (x <= thresholds["max"]))
+    if outside.any():
+        indices[outside] = model_label_indices(userdata, x[outside])
+    return indices.astype(np.uint8)
+
+
+class InferenceResults(object):
+    '''
+    Classified readings as columns: epoch milliseconds (int64), value
+    (float32) and class code (uint8, into LABEL_CLASSES), in preallocated
+    arrays that double when full.
+
+    `counts` (per class) and `total` are kept for every reading. With
+    `plot_cap` > 0 at most that many readings are stored: once full, each
+    new reading replaces a random stored one with probability
+    plot_cap / total (reservoir sampling), so the stored readings stay a
+    uniform sample of everything seen. `columns()` returns them in time
+    order.
+    '''
+
+    def __init__(self, plot_cap=RESULTS_PLOT_CAP, capacity=4096, seed=0):
+        self.plot_cap = max(int(plot_cap), 0)
+        if self.plot_cap:
+            capacity = min(capacity, self.plot_cap)
+        self._ts = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=np.float32)
+        self._codes = np.empty(capacity, dtype=np.uint8)
+        self._size = 0
+        self._rng = np.random.default_rng(seed)
+        self.counts = np.zeros(len(LABEL_CLASSES), dtype=np.int64)
+        self.total = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def sampled(self):
+        return self._size < self.total
+
+    def _reserve(self, n):
+        if self._size + n > len(self._ts):
+            capacity = max(len(self._ts) * 2, self._size + n)
+            if self.plot_cap:
+                capacity = min(capacity, self.plot_cap)
+            for name in ("_ts", "_values", "_codes"):
+                old = getattr(self, name)
+                grown = np.empty(capacity, dtype=old.dtype)
+                grown[:self._size] = old[:self._size]
+                setattr(self, name, grown)
+
+    def append(self, ts, values, codes):
+        """Add readings: epoch timestamps (seconds or milliseconds), values and class codes."""
+        ts = np.asarray(ts, dtype=np.int64)
+        ts = np.where(ts > 1_000_000_000_000, ts, ts * 1000)
+        values = np.asarray(values, dtype=np.float32)
+        codes = np.asarray(codes, dtype=np.uint8)
+        n = len(codes)
+        self.counts += np.bincount(codes, minlength=len(self.counts))
+        seen = self.total
+        self.total += n
+
+        # Stored directly while there is room
+        room = n if not self.plot_cap else max(min(n, self.plot_cap - self._size), 0)
+        if room:
+            self._reserve(room)
+            end = self._size + room
+            self._ts[self._size:end] = ts[:room]
+            self._values[self._size:end] = values[:room]
+            self._codes[self._size:end] = codes[:room]
+            self._size = end
+        if room == n:
+            return
+
+        # Reservoir full: reading number i (0-based) takes slot j ~ U[0, i]
+        # if j falls inside the reservoir
+        slots = self._rng.integers(0, np.arange(seen + room, seen + n) + 1)
+        keep = slots < self.plot_cap
+        slots = slots[keep]
+        self._ts[slots] = ts[room:][keep]
+        self._values[slots] = values[room:][keep]
+        self._codes[slots] = codes[room:][keep]
+
+    def append_one(self, ts, value, code):
+        if not self.plot_cap or self._size < self.plot_cap:
+            self._reserve(1)
+            self._ts[self._size] = ts if ts > 1_000_000_000_000 else ts * 1000
+            self._values[self._size] = value
+            self._codes[self._size] = code
+            self._size += 1
+            self.counts[code] += 1
+            self.total += 1
+        else:
+            self.append([ts], [value], [code])
+
+    def columns(self):
+        """(epoch ms, values, codes) of the stored readings, sorted by time."""
+        order = np.argsort(self._ts[:self._size], kind="stable")
+        return self._ts[order], self._values[order], self._codes[order]
+
+
+def caps_topic():
+    return f"{MQTT_CAPS_TOPIC}/{MQTT_CLIENT_ID}"
+
+
+def advertise_formats(client):
+    caps = {"Client": MQTT_CLIENT_ID, "Formats": SUPPORTED_FORMATS}
+    client.publish(caps_topic(), json.dumps(caps), retain=True)
+
+
+def withdraw_formats(client):
+    client.publish(caps_topic(), b"", retain=True)
+
+
+def decode_payload(payload):
+    """
+    Decode an MQTT payload into (control, readings).
+
+    Binary batches are viewed in place as a structured array; anything else
+    is a single JSON reading or control message.
+    """
+    if payload[:4] == WIRE_MAGIC:
+        version = payload[4]
+        count = int.from_bytes(payload[6:8], "little")
+        if version == 1:
+            offset = WIRE_HEADER_SIZE_V1
+        elif version == WIRE_VERSION:
+            offset = WIRE_HEADER_SIZE + int.from_bytes(payload[8:10], "little")
+        else:
+            raise ValueError(f"unsupported batch version {version}")
+        batch = np.frombuffer(payload, dtype=WIRE_DTYPE, count=count, offset=offset)
+        return None, zip(batch["Timestamp"].tolist(), batch["Value"].tolist())
+
+    data = json.loads(payload.decode("utf-8"))
+    if isinstance(data, dict) and data.get("Type") == "END":
+        return data, []
+    return None, [(data.get("Timestamp"), data.get("Value"))]
+
+
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
-        client.subscribe(MQTT_TOPIC)
+        client.subscribe(f"{MQTT_TOPIC}/#")
+        advertise_formats(client)
     else:
         print(f"Failed to connect to MQTT broker, reason code: {reason_code}")
 
 
 def on_message(client, userdata, msg):
     try:
-        payload = msg.payload.decode("utf-8")
-        data = json.loads(payload)
+        control, readings = decode_payload(msg.payload)
     except Exception as e:
         print(f"Failed to parse MQTT message: {e}")
         return
 
-    if isinstance(data, dict) and data.get("Type") == "END":
+    batcher = userdata.get("batcher")
+    if control is not None:
         print("Received END signal from injector (inference).")
+        if batcher is not None:
+            batcher.close()
+            batcher.report()
         make_plots_and_summary(userdata)
+        withdraw_formats(client)
         client.disconnect()
         return
 
-    ts = data.get("Timestamp")
-    value = data.get("Value")
-    if ts is None or value is None:
+    if batcher is not None:
+        batcher.add(readings)
         return
+    for ts, value in readings:
+        classify_reading(userdata, ts, value)
 
-    try:
-        value = float(value)
-        ts_raw = int(ts)
-    except (TypeError, ValueError):
-        return
 
+def to_datetime(ts_raw):
     if ts_raw > 1_000_000_000_000:
         ts_sec = ts_raw / 1000.0
     else:
         ts_sec = ts_raw
-    dt = datetime.fromtimestamp(ts_sec, tz=timezone.utc)
-
-    x_scaled = standardize_value(value)
-
-    interpreter = userdata["interpreter"]
-    input_details = userdata["input_details"]
-    output_details = userdata["output_details"]
-
-    input_index = input_details[0]["index"]
-    output_index = output_details[0]["index"]
+    return datetime.fromtimestamp(ts_sec, tz=timezone.utc)
 
-    input_data = np.array([[x_scaled]], dtype=np.float32)
-    interpreter.set_tensor(input_index, input_data)
-    interpreter.invoke()
-    output_data = interpreter.get_tensor(output_index)
 
-    pred_idx = int(np.argmax(output_data, axis=1)[0])
-    pred_label = LABEL_CLASSES[pred_idx]
+def classify_reading(userdata, ts, value):
+    if ts is None or value is None:
+        return
 
-    print(f"[INFER] {dt.isoformat()}  PM2.5={value:.2f} -> {pred_label}")
+    try:
+        value = float(value)
+        ts_raw = int(ts)
+    except (TypeError, ValueError):
+        return
 
-    userdata["timestamps"].append(dt)
-    userdata["values"].append(value)
-    userdata["pred_labels"].append(pred_label)
+    dt = to_datetime(ts_raw)
+
+    code = predict_code(userdata, value)
+
+    print(f"[INFER] {dt.isoformat()}  PM2.5={value:.2f} -> {LABEL_CLASSES[code]}")
+
+    userdata["results"].append_one(ts_raw, value, code)
+
+
+class InferenceBatcher(object):
+    '''
+    Collects readings and classifies them `batch_size` at a time with one
+    invoke(). A batch goes as soon as it is full, or once its oldest
+    reading has waited `max_delay` seconds (checked by a timer thread),
+    so a slow trickle of readings is not held back. Results are recorded
+    in arrival order, and each reading's wait + inference time is kept
+    for the latency summary.
+    '''
+
+    def __init__(self, userdata, batch_size, max_delay):
+        self.userdata = userdata
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._timestamps = []
+        self._values = []
+        self._arrivals = []
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.batches = 0
+        self.latencies = []
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, readings):
+        now = time.perf_counter()
+        with self._lock:
+            for ts, value in readings:
+                if ts is None or value is None:
+                    continue
+                try:
+                    value = float(value)
+                    ts_raw = int(ts)
+                except (TypeError, ValueError):
+                    continue
+                self._timestamps.append(ts_raw)
+                self._values.append(value)
+                self._arrivals.append(now)
+                if len(self._values) >= self.batch_size:
+                    self._classify()
+
+    def flush(self):
+        with self._lock:
+            if self._values:
+                self._classify()
+
+    def _classify(self):
+        n = len(self._values)
+        codes = predict_codes(self.userdata, self._values)
+
+        done = time.perf_counter()
+        self.latencies.extend(done - arrival for arrival in self._arrivals)
+        self.userdata["results"].append(self._timestamps, self._values, codes)
+        self.batches += 1
+        counts = np.bincount(codes, minlength=len(LABEL_CLASSES))
+        summary = ", ".join(f"{name}={count}" for name, count in zip(LABEL_CLASSES, counts) if count)
+        print(f"[INFER] {n} readings up to {to_datetime(self._timestamps[-1]).isoformat()} -> {summary}")
+        self._timestamps, self._values, self._arrivals = [], [], []
+
+    def _run(self):
+        while not self._closed.wait(self.max_delay / 10):
+            with self._lock:
+                if self._arrivals and time.perf_counter() - self._arrivals[0] >= self.max_delay:
+                    self._classify()
+
+    def close(self):
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def report(self):
+        if not self.latencies:
+            return
+        latencies = np.array(self.latencies) * 1000
+        print(
+            f"Classified {len(latencies)} readings in {self.batches} batches; "
+            f"latency p50 {np.percentile(latencies, 50):.2f} ms, "
+            f"p99 {np.percentile(latencies, 99):.2f} ms"
+        )
 
 
 def make_plots_and_summary(userdata):
-    timestamps = userdata["timestamps"]
-    values = userdata["values"]
-    pred_labels = userdata["pred_labels"]
+    results = userdata["results"]
 
-    if not timestamps:
+    if not results.total:
         print("No inference data collected. No plots will be generated.")
         return
 
-    class_counts = {cls: 0 for cls in LABEL_CLASSES}
-    for lbl in pred_labels:
-        class_counts[lbl] += 1
+    # Only needed here, at the very end: keep it out of the start-up path
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
 
-    for cls, count in class_counts.items():
+    labels = LABEL_CLASSES.tolist()
+    counts = results.counts.tolist()
+    for cls, count in zip(labels, counts):
         print(f"  {cls}: {count}")
 
     fig1, ax1 = plt.subplots(figsize=(6, 4))
-    labels = list(class_counts.keys())
-    counts = [class_counts[l] for l in labels]
     bars = ax1.bar(labels, counts)
     ax1.set_ylabel("Count")
     ax1.set_title("Predicted PM2.5 Quality Distribution")
@@ -126,19 +521,17 @@ def make_plots_and_summary(userdata):
     plt.close(fig1)
     print("Saved predicted_class_counts.png")
 
+    ts, values, codes = results.columns()
     fig2, ax2 = plt.subplots(figsize=(10, 5))
-    color_map = {
-        "GREEN": "green",
-        "YELLOW": "gold",
-        "RED": "red",
-    }
-
-    for dt, val, lbl in zip(timestamps, values, pred_labels):
-        ax2.scatter(dt, val, c=color_map.get(lbl, "black"), s=10)
+    ax2.scatter(ts.astype("datetime64[ms]"), values, c=LABEL_COLOURS[codes], s=10)
 
+    title = "PM2.5 over Time with Predicted Quality"
+    if results.sampled:
+        title += f" ({len(results):,} of {results.total:,} readings)"
+        print(f"Plotting a random sample of {len(results)} of {results.total} readings")
     ax2.set_xlabel("Time")
     ax2.set_ylabel("PM2.5 Value")
-    ax2.set_title("PM2.5 over Time with Predicted Quality")
+    ax2.set_title(title)
     plt.tight_layout()
     fig2.savefig("pm25_time_series_predictions.png")
     plt.close(fig2)
@@ -146,24 +539,35 @@ def make_plots_and_summary(userdata):
 
 
 def main():
-    interpreter, input_details, output_details = load_tflite_model()
+    batch_size = max(INFER_BATCH_SIZE, 1)
+    thresholds = load_thresholds() if CLASSIFIER == "auto" else None
+    if thresholds is None:
+        interpreter, input_details, output_details = load_tflite_model(batch_size)
+    else:
+        interpreter = input_details = output_details = None  # loaded if ever needed
 
     userdata = {
         "interpreter": interpreter,
         "input_details": input_details,
         "output_details": output_details,
-        "timestamps": [],
-        "values": [],
-        "pred_labels": [],
+        "thresholds": thresholds,
+        "batch_size": batch_size,
+        "results": InferenceResults(),
+        "batcher": None,
     }
+    if batch_size > 1:
+        userdata["batcher"] = InferenceBatcher(
+            userdata, batch_size, INFER_MAX_DELAY_MS / 1000.0
+        ).start()
 
     client = mqtt.Client(
-        client_id="PM25_Inference",
+        client_id=MQTT_CLIENT_ID,
         userdata=userdata,
         callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
     )
     client.on_connect = on_connect
     client.on_message = on_message
+    client.will_set(caps_topic(), None, retain=True)
 
     print("Connecting to MQTT broker...")
     try:
@@ -0,0 +1,140 @@
+'''
+    Benchmark: the TFLite model variants written by generate_tflite.py.
+
+    For each pm25_model_<variant>.tflite (float32, float16, dynamic, int8)
+    this measures, on the CPU it runs on:
+        - file size
+        - single-reading latency: one invoke() per reading, p50 / p99
+        - batch throughput: readings/s with the input resized to a batch
+        - accuracy on the held-out set (pm25_test_set.npz), agreement
+          with the float32 variant and the confusion matrix
+
+    The full-integer variant takes int8 input: readings are quantized with
+    the input tensor's scale / zero point by pm25_inference's model_input. The
+    table is printed and written to tflite_variants.md.
+
+    Usage: python bench_tflite_variants.py [single invokes] [batch size] [output]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+# The edge service's interpreter choice (TFLITE_RUNTIME) and input
+# quantization, so the numbers are for the code that is deployed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Task_4_Edge_VM"))
+from pm25_inference import interpreter_class, model_input  # noqa: E402
+
+VARIANTS = ("float32", "float16", "dynamic", "int8")
+THROUGHPUT_READINGS = 1 << 18
+
+
+class Model(object):
+    '''One variant with its input sized for `batch_size` readings per invoke().'''
+
+    def __init__(self, path, batch_size):
+        self.interpreter = interpreter_class()(model_path=path)
+        input_index = self.interpreter.get_input_details()[0]["index"]
+        self.interpreter.resize_tensor_input(input_index, [batch_size, 1])
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = batch_size
+        self._input = np.zeros((batch_size, 1), dtype=self.input_detail["dtype"])
+
+    def invoke(self, part):
+        self._input[:len(part), 0] = model_input(part, self.input_detail)
+        self._input[len(part):] = 0
+        self.interpreter.set_tensor(self.input_detail["index"], self._input)
+        self.interpreter.invoke()
+        # Quantized outputs keep the order of the scores, so argmax needs
+        # no dequantization
+        return np.argmax(self.interpreter.get_tensor(self.output_index)[:len(part)], axis=1)
+
+    def classify(self, x):
+        return np.concatenate([self.invoke(x[i:i + self.batch_size])
+                               for i in range(0, len(x), self.batch_size)])
+
+
+def confusion(y_true, y_pred, classes):
+    return np.bincount(y_true * classes + y_pred, minlength=classes * classes).reshape(classes, classes)
+
+
+def bench(path, x_test, y_test, classes, n_single, batch_size):
+    single = Model(path, 1)
+    readings = x_test[np.arange(n_single) % len(x_test)]
+    latencies = np.empty(n_single)
+    for i in range(n_single):
+        started = time.perf_counter()
+        single.invoke(readings[i:i + 1])
+        latencies[i] = time.perf_counter() - started
+
+    batched = Model(path, batch_size)
+    y_pred = batched.classify(x_test)
+    x = x_test[np.arange(THROUGHPUT_READINGS) % len(x_test)]
+    started = time.perf_counter()
+    batched.classify(x)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "size": os.path.getsize(path),
+        "p50": np.percentile(latencies, 50) * 1e6,
+        "p99": np.percentile(latencies, 99) * 1e6,
+        "throughput": len(x) / elapsed,
+        "pred": y_pred,
+        "accuracy": float(np.mean(y_pred == y_test)),
+        "confusion": confusion(y_test, y_pred, classes),
+    }
+
+
+def main():
+    n_single = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    output = sys.argv[3] if len(sys.argv) > 3 else "tflite_variants.md"
+
+    with np.load("pm25_test_set.npz", allow_pickle=False) as data:
+        x_test = data["x"].astype(np.float32).ravel()
+        y_test = data["y"].astype(np.int64)
+        class_names = data["class_names"].tolist()
+
+    results = {}
+    for variant in VARIANTS:
+        path = f"pm25_model_{variant}.tflite"
+        if not os.path.exists(path):
+            print(f"{path} missing: run generate_tflite.py first")
+            continue
+        results[variant] = bench(path, x_test, y_test, len(class_names), n_single, batch_size)
+    if not results:
+        return
+    reference = results.get("float32", next(iter(results.values())))["pred"]
+
+    lines = [
+        f"{len(x_test)} test readings, {n_single} single invokes, batch {batch_size}, "
+        f"{interpreter_class().__module__}, {os.cpu_count()} CPUs",
+        "",
+        "| variant | size KB | p50 us | p99 us | batch readings/s | accuracy | agrees with float32 |",
+        "|---|---:|---:|---:|---:|---:|---:|",
+    ]
+    for variant, r in results.items():
+        lines.append(
+            f"| {variant} | {r['size'] / 1024:.2f} | {r['p50']:.1f} | {r['p99']:.1f} "
+            f"| {r['throughput']:,.0f} | {r['accuracy']:.4f} | {np.mean(r['pred'] == reference):.4f} |"
+        )
+    for variant, r in results.items():
+        lines += ["", f"Confusion matrix, {variant} (rows true, columns predicted):", "",
+                  "| | " + " | ".join(class_names) + " |",
+                  "|---" * (len(class_names) + 1) + "|"]
+        for name, row in zip(class_names, r["confusion"]):
+            lines.append(f"| {name} | " + " | ".join(str(c) for c in row) + " |")
+
+    table = "\n".join(lines)
+    print(table)
+    with open(output, "w") as f:
+        f.write(table + "\n")
+    print(f"\nWrote {output}")
+
+
+if __name__ == "__main__":
+    main()
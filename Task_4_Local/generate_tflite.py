@@ -79,11 +79,52 @@ history = model.fit(
 )
 
 model.save('pm25_model.keras')
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-tflite_model_quant = converter.convert()
-with open('pm25_model.tflite', 'wb') as f:
-    f.write(tflite_model_quant)
+
+
+# TFLite variants of the model, compared by bench_tflite_variants.py:
+#   float32  - plain conversion
+#   float16  - weights stored as float16
+#   dynamic  - int8 weights, float activations (what the edge has used)
+#   int8     - full-integer: int8 weights, activations, input and output
+TFLITE_VARIANTS = ['float32', 'float16', 'dynamic', 'int8']
+CALIBRATION_SAMPLES = 1000
+
+
+def representative_dataset():
+    # Calibrates the int8 activation ranges on real training readings (the
+    # SMOTE samples would skew them towards the synthetic RED cluster)
+    rng = np.random.default_rng(42)
+    n = min(CALIBRATION_SAMPLES, len(X_train_scaled))
+    for i in rng.choice(len(X_train_scaled), n, replace=False):
+        yield [X_train_scaled[i:i + 1].astype(np.float32)]
+
+
+def convert_tflite(variant):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+for variant in TFLITE_VARIANTS:
+    tflite_model = convert_tflite(variant)
+    with open(f'pm25_model_{variant}.tflite', 'wb') as f:
+        f.write(tflite_model)
+    if variant == 'dynamic':
+        # The model deployed to the edge
+        with open('pm25_model.tflite', 'wb') as f:
+            f.write(tflite_model)
+
+# Held-out set for bench_tflite_variants.py, already standardized
+np.savez('pm25_test_set.npz', x=X_test_scaled.astype(np.float32), y=y_test,
+         class_names=class_names.astype(str), scaler_mean=scaler.mean_, scaler_scale=scaler.scale_)
 
 
 y_pred_probs = model.predict(X_test_scaled)
@@ -101,12 +142,12 @@ plt.savefig("confusion_matrix.png")
 
 
 original_size = os.path.getsize('pm25_model.keras')
-tflite_size = os.path.getsize('pm25_model.tflite')
+tflite_sizes = [os.path.getsize(f'pm25_model_{variant}.tflite') for variant in TFLITE_VARIANTS]
 
-plt.figure(figsize=(6, 4))
-sizes = [original_size / 1024, tflite_size / 1024]
-labels = ['Original Keras', 'Quantized TFLite']
-bar = plt.bar(labels, sizes, color=['blue', 'orange'])
+plt.figure(figsize=(8, 4))
+sizes = [original_size / 1024] + [size / 1024 for size in tflite_sizes]
+labels = ['Original Keras'] + [f'TFLite {variant}' for variant in TFLITE_VARIANTS]
+bar = plt.bar(labels, sizes, color=['blue'] + ['orange'] * len(TFLITE_VARIANTS))
 plt.ylabel('Size in KB')
 plt.ylim(0, 40)
 plt.title('Model Size Comparison')